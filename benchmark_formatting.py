@@ -0,0 +1,226 @@
+"""Замер скорости форматирования ответов AI
+
+Сравнивает прежнюю цепочку (format_ai_response на ~50 re.sub + перевод блоков
+кода в HTML) с однопроходным formatting.format_ai_response. Ответы собираются
+из реальных ответов в chat_history.json до размеров 10, 25 и 50 КБ.
+
+    python benchmark_formatting.py [путь к chat_history.json]
+"""
+import json
+import re
+import sys
+import timeit
+
+from formatting import format_ai_response
+
+SIZES_KB = (10, 25, 50)
+
+
+# === ПРЕЖНЯЯ РЕАЛИЗАЦИЯ ===
+def legacy_format_ai_response(text: str) -> str:
+    """Форматировать ответ AI для красивого отображения в Telegram"""
+    
+    # Сохраняем блоки кода
+    code_blocks = []
+    def save_code(match):
+        code_blocks.append(match.group(0))
+        return f"___CODE_BLOCK_{len(code_blocks)-1}___"
+    
+    # Временно заменяем блоки кода (```код```)
+    text = re.sub(r'```[\s\S]*?```', save_code, text)
+    
+    # Убираем ВСЕ математические обертки $$ и $ полностью
+    text = re.sub(r'\$\$([^\$]+)\$\$', r'\1', text)
+    text = re.sub(r'\$([^\$]+)\$', r'\1', text)
+    text = text.replace('$$', '').replace('$', '')
+    
+    # Обрабатываем \frac{числитель}{знаменатель} -> (числитель/знаменатель)
+    text = re.sub(r'\\frac\{([^}]+)\}\{([^}]+)\}', r'(\1/\2)', text)
+    
+    # Обрабатываем \sqrt{число} -> √(число)
+    text = re.sub(r'\\sqrt\{([^}]+)\}', r'√(\1)', text)
+    
+    # Обрабатываем степени: ^{число} или ^число -> используем Unicode
+    def convert_superscript(match):
+        num = match.group(1) if match.lastindex else match.group(0)[1]
+        superscripts = {'0':'⁰','1':'¹','2':'²','3':'³','4':'⁴','5':'⁵','6':'⁶','7':'⁷','8':'⁸','9':'⁹','+':'⁺','-':'⁻','=':'⁼','(':'⁽',')':'⁾'}
+        return ''.join(superscripts.get(c, c) for c in str(num))
+    
+    text = re.sub(r'\^\{([^}]+)\}', convert_superscript, text)
+    text = re.sub(r'\^([0-9])', convert_superscript, text)
+    
+    # Обрабатываем индексы: _{число} -> используем Unicode
+    def convert_subscript(match):
+        num = match.group(1)
+        subscripts = {'0':'₀','1':'₁','2':'₂','3':'₃','4':'₄','5':'₅','6':'₆','7':'₇','8':'₈','9':'₉','+':'₊','-':'₋','=':'₌','(':'₍',')':'₎'}
+        return ''.join(subscripts.get(c, c) for c in str(num))
+    
+    text = re.sub(r'_\{([^}]+)\}', convert_subscript, text)
+    
+    # Полная замена LaTeX команд на понятные символы
+    latex_replacements = {
+        # Операции (ВАЖНО: делаем первыми)
+        r'\\times': ' * ', r'\\cdot': ' * ', r'\\div': ' / ', r'\\pm': ' ± ',
+        r'\\ldots': '...', r'\\dots': '...',
+        
+        # Сравнения
+        r'\\leq': '≤', r'\\geq': '≥', r'\\neq': '≠', r'\\approx': '≈', r'\\equiv': '≡',
+        
+        # Стрелки
+        r'\\rightarrow': '→', r'\\leftarrow': '←', r'\\to': '→',
+        
+        # Греческие буквы
+        r'\\alpha': 'α', r'\\beta': 'β', r'\\gamma': 'γ', r'\\delta': 'δ',
+        r'\\theta': 'θ', r'\\pi': 'π', r'\\sigma': 'σ', r'\\omega': 'ω',
+        
+        # Тригонометрия
+        r'\\sin': 'sin', r'\\cos': 'cos', r'\\tan': 'tan', r'\\cot': 'cot',
+        
+        # Геометрия
+        r'\\angle': '∠', r'\\circ': '°', r'\\degree': '°', r'\\triangle': '△',
+        
+        # Скобки
+        r'\\left\(': '(', r'\\right\)': ')', r'\\left\[': '[', r'\\right\]': ']',
+        r'\\left\{': '{', r'\\right\}': '}',
+        r'\\left': '', r'\\right': '',
+        
+        # Текст
+        r'\\text\{([^}]+)\}': r'\1',
+    }
+    
+    # Применяем все замены
+    for pattern, replacement in latex_replacements.items():
+        text = re.sub(pattern, replacement, text)
+    
+    # Убираем ВСЕ оставшиеся LaTeX команды (начинающиеся с \)
+    text = re.sub(r'\\[a-zA-Z_]+', '', text)
+    
+    # Убираем оставшиеся обратные слеши
+    text = text.replace('\\', '')
+    
+    # Убираем фигурные скобки {} (оставшиеся после обработки)
+    text = text.replace('{', '').replace('}', '')
+    
+    # Форматируем заголовки
+    text = re.sub(r'^###\s*(.+)$', r'\n📌 \1\n', text, flags=re.MULTILINE)
+    text = re.sub(r'^##\s*(.+)$', r'\n📍 \1\n', text, flags=re.MULTILINE)
+    text = re.sub(r'^#\s*(.+)$', r'\n📢 \1\n', text, flags=re.MULTILINE)
+    
+    # Убираем жирный текст (двойные звездочки)
+    text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
+    
+    # Форматируем списки
+    text = re.sub(r'^[-*]\s+(.+)$', r'  • \1', text, flags=re.MULTILINE)
+    
+    # Возвращаем блоки кода
+    for i, code_block in enumerate(code_blocks):
+        text = text.replace(f"___CODE_BLOCK_{i}___", code_block)
+    
+    # Убираем лишние пустые строки
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    
+    return text.strip()
+
+
+def legacy_render_message_part(part: str) -> tuple:
+    """Подготовить часть ответа к отправке: (текст, parse_mode)"""
+    # Проверяем, есть ли блоки кода в тексте
+    if '```' not in part:
+        # Если нет блоков кода, отправляем как обычный текст
+        return part, None
+
+    # Если есть блоки кода, используем HTML форматирование
+    html_part = part
+    
+    # Функция для экранирования HTML внутри кода
+    def escape_html_in_code(match):
+        code_content = match.group(2) if match.lastindex >= 2 else match.group(1)
+        # Экранируем HTML символы
+        code_content = code_content.replace('&', '&amp;')
+        code_content = code_content.replace('<', '&lt;')
+        code_content = code_content.replace('>', '&gt;')
+        
+        if match.lastindex >= 2:
+            # Блок с языком
+            return f'<pre><code class="language-{match.group(1)}">{code_content}</code></pre>'
+        else:
+            # Блок без языка
+            return f'<pre>{code_content}</pre>'
+    
+    # Обрабатываем блоки кода с языком
+    html_part = re.sub(
+        r'```(\w+)\n([\s\S]*?)```',
+        escape_html_in_code,
+        html_part
+    )
+    
+    # Обрабатываем блоки кода без языка
+    html_part = re.sub(
+        r'```\n?([\s\S]*?)```',
+        escape_html_in_code,
+        html_part
+    )
+    
+    # Обрабатываем инлайн код `код`
+    def escape_inline_code(match):
+        code = match.group(1)
+        code = code.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        return f'<code>{code}</code>'
+    
+    html_part = re.sub(r'`([^`]+)`', escape_inline_code, html_part)
+    
+    return html_part, 'HTML'
+
+def legacy_pipeline(text: str) -> str:
+    return legacy_render_message_part(legacy_format_ai_response(text))[0]
+
+
+# === ЗАМЕР ===
+def load_replies(path: str) -> list:
+    """Ответы ассистента из базы истории чатов"""
+    with open(path, 'r', encoding='utf-8') as f:
+        history = json.load(f)
+    return [
+        message["content"]
+        for messages in history.values()
+        for message in messages
+        if message.get("role") == "assistant" and message.get("content")
+    ]
+
+
+def build_answer(replies: list, size_kb: int) -> str:
+    """Склеить реальные ответы в один размером не меньше size_kb"""
+    parts, size, index = [], 0, 0
+    while size < size_kb * 1024:
+        reply = replies[index % len(replies)]
+        parts.append(reply)
+        size += len(reply.encode('utf-8'))
+        index += 1
+    return "\n\n".join(parts)
+
+
+def measure(func, text: str) -> float:
+    """Лучшее время одного вызова, мс"""
+    timer = timeit.Timer(lambda: func(text))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=5, number=number)) / number * 1000
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "chat_history.json"
+    replies = load_replies(path)
+    if not replies:
+        print(f"В {path} нет ответов ассистента")
+        return
+
+    print(f"Ответов в базе: {len(replies)}")
+    print(f"{'Размер':>8} {'Было, мс':>10} {'Стало, мс':>10} {'Ускорение':>10}")
+    for size_kb in SIZES_KB:
+        text = build_answer(replies, size_kb)
+        before = measure(legacy_pipeline, text)
+        after = measure(format_ai_response, text)
+        print(f"{size_kb:>6}КБ {before:>10.2f} {after:>10.2f} {before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
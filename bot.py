@@ -1,45 +1,71 @@
 import asyncio
+import ast
 import logging
-import re
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, \
-    CallbackQuery, FSInputFile
-from aiogram.filters import CommandStart
+    CallbackQuery, FSInputFile, Update
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage
+try:
+    # Нужен только для STATE_BACKEND=redis
+    import redis
+    from aiogram.fsm.storage.redis import RedisStorage
+except ImportError:
+    redis = None
+    RedisStorage = None
+try:
+    # Долговременная память чата, нужен numpy
+    import vector_memory
+except ImportError:
+    vector_memory = None
+try:
+    # Точный подсчёт токенов для моделей OpenAI, без него - приблизительный
+    import tiktoken
+except ImportError:
+    tiktoken = None
 import aiohttp
-import requests
+from aiohttp import web
 import json
 import os
 from datetime import datetime, timedelta
 import subprocess
+import shutil
+import sys
 import signal
-from PIL import Image
-import pytesseract
-import io
-
-# Настройка пути к Tesseract
-if os.name == 'nt':  # Windows
-    # Проверяем стандартные пути установки Tesseract
-    possible_paths = [
-        r'C:\Program Files\Tesseract-OCR\tesseract.exe',
-        r'C:\Program Files (x86)\Tesseract-OCR\tesseract.exe',
-        r'C:\Tesseract-OCR\tesseract.exe'
-    ]
-    for path in possible_paths:
-        if os.path.exists(path):
-            pytesseract.pytesseract.tesseract_cmd = path
-            break
-else:
-    # На Linux (Railway, Heroku и т.д.) Tesseract устанавливается через apt
-    # и доступен в PATH, поэтому явно указывать путь не нужно
-    pass
+import socket
+import sqlite3
+import heapq
+import itertools
+import concurrent.futures
+import gzip
+import hashlib
+import hmac
+import importlib.metadata
+import multiprocessing
+import threading
+import weakref
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from itertools import islice
+import math
+import random
+import time
+
+import ocr_worker
+import formatting
+import text_search
+from formatting import format_ai_response, html_to_text
 
 # Настройки
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "8157269355:AAFOCDNdApPolAeBBjbY1An-OfYIokLvfKc")
 # OnlySq API ключ
 API_KEY = os.getenv("API_KEY", "openai")  
-API_URL = "http://api.onlysq.ru/ai/v2"  # OnlySq API v2
+API_URL = os.getenv("API_URL", "http://api.onlysq.ru/ai/v2")  # OnlySq API v2
 DEFAULT_MODEL = "gpt-5.2-chat"
 AVAILABLE_MODELS = {
     "gpt-5.2-chat": {"name": "🚀 GPT-5.2 Chat", "cost": 1, "desc": "Новейшая модель GPT-5.2 от OpenAI"},
@@ -48,23 +74,147 @@ AVAILABLE_MODELS = {
     "deepseek-v3": {"name": "🐼 DeepSeek V3", "cost": 1, "desc": "Мощная модель от DeepSeek"},
     "grok-3": {"name": "🤖 Grok 3", "cost": 1, "desc": "Продвинутая модель от xAI"}
 }
+# Бюджет токенов на историю в запросе и кодировка tiktoken для точного подсчёта
+MODEL_CONTEXT = {
+    "gpt-5.2-chat": {"budget": 16000, "encoding": "o200k_base"},
+    "gpt-4o": {"budget": 16000, "encoding": "o200k_base"},
+    "gemini-3-pro": {"budget": 16000},
+    "deepseek-v3": {"budget": 12000},
+    "grok-3": {"budget": 12000},
+}
+DEFAULT_CONTEXT_BUDGET = 8000  # Для моделей, которых нет в MODEL_CONTEXT
+CONTEXT_MAX_MESSAGES = 100  # Сколько последних сообщений рассматривать для контекста
+CONTEXT_SUMMARY_BUDGET = 500  # Токенов на сводку не поместившихся реплик
+CONTEXT_SUMMARY_LINE = 150  # Символов от каждой реплики в сводке
+MESSAGE_TOKEN_OVERHEAD = 4  # Служебные токены на каждое сообщение (роль, разделители)
+TOKEN_CACHE_SIZE = 50000  # Сообщений в кэше подсчёта токенов
+MEMORY_DIR = os.getenv("MEMORY_DIR", "vector_memory")  # Векторные индексы памяти; у каждой копии бота свой (см. README)
+MEMORY_MAX_ITEMS = 5000  # Сообщений в памяти одного пользователя
+MEMORY_MAX_USERS = 200  # Индексов пользователей в оперативной памяти
+MEMORY_BACKFILL = 2000  # Сколько старых сообщений индексировать при первом обращении
+MEMORY_TOP_K = 4  # Сколько найденных сообщений добавлять в запрос
+MEMORY_MIN_SCORE = 0.12  # Минимальное косинусное сходство с вопросом
+MEMORY_BUDGET = 800  # Токенов на найденные сообщения
+MEMORY_LINE = 600  # Символов от каждого найденного сообщения
+MEMORY_SAVE_INTERVAL = 60  # Запись изменённых индексов на диск, секунд
 DB_FILE = "chat_history.json"
-DATABASE_FILE = "database.json"  # Объединенная база пользователей и ботов
+HISTORY_WAL_FILE = "chat_history.wal.jsonl"  # Журнал новых сообщений, сжимается в DB_FILE
+HISTORY_COMPACT_THRESHOLD = 1000  # Записей в журнале до внепланового сжатия
+HISTORY_COMPACT_INTERVAL = 300  # Плановое сжатие журнала, секунд
+HISTORY_SUMMARY_TRIGGER = 60  # Сообщений в истории, после которых старые сворачиваются в сводку
+HISTORY_KEEP_RECENT = 20  # Последние сообщения, которые остаются в истории как есть
+HISTORY_SUMMARY_INTERVAL = 60  # Проверка историй на сворачивание, секунд
+HISTORY_SUMMARY_INPUT_CHARS = 24000  # Текста реплик в одном запросе на сводку
+HISTORY_SUMMARY_MESSAGE_CHARS = 2000  # Символов от одной реплики в запросе на сводку
+HISTORY_ARCHIVE_DIR = "chat_archive"  # Свёрнутые в сводку реплики, gzip JSONL на пользователя
+SEARCH_PAGE_SIZE = 5  # Результатов /search на странице
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "deepseek-v3")  # Модель для сводок (из AVAILABLE_MODELS)
+DATABASE_FILE = "database.json"  # Старая JSON база, импортируется в SQLite при первом запуске
+SQLITE_FILE = "bot_data.db"  # База пользователей, токенов и ботов
+SQLITE_BUSY_TIMEOUT = 30  # Ожидание блокировки базы другими процессами бота, секунд
+STATE_BACKEND = os.getenv("STATE_BACKEND", "local")  # local - один процесс, redis - несколько копий бота на одном хосте (см. README)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")  # Любой сервер с протоколом Redis
+QUOTA_RESET_HOURS = 24  # Период обновления токенов
+QUOTA_RESET_BUCKET = 600  # Размер временной корзины фонового сброса, секунд
+QUOTA_RESET_BATCH = 500  # Пользователей за одну транзакцию сброса
 SETTINGS_FILE = "bot_settings.json"
+SETTINGS_CACHE_TTL = 10  # Как часто перечитывать bot_settings.json в горячих местах, секунд
+EXPORT_DIR = "exports"  # Части архива экспорта до отправки
+EXPORT_PART_BYTES = 45 * 1024 * 1024  # Размер части экспорта (Telegram принимает от бота файлы до 50 МБ)
 BOTS_DIR = "user_bots"
+BOTS_LOG_DIR = os.path.join(BOTS_DIR, "logs")  # Вывод пользовательских ботов
+SUPERVISOR_ENABLED = os.getenv("SUPERVISOR_ENABLED", "1") == "1"  # Участвовать в выборе копии бота, которая ведёт надзор
+SUPERVISOR_INTERVAL = 5  # Проверка процессов ботов, секунд
+SUPERVISOR_LEASE_TTL = 30  # Срок аренды надзора: после падения ведущей копии надзор перейдёт к другой, секунд
+USER_BOT_RUNTIME = os.getenv("USER_BOT_RUNTIME", "process")  # process - процесс на бота, host - общие процессы (боты хоста не изолированы друг от друга)
+USER_BOT_HOSTS = int(os.getenv("USER_BOT_HOSTS", "2"))  # Общих процессов в режиме host
+USER_BOT_SECRET_ENV = ("TELEGRAM_TOKEN", "API_KEY", "REDIS_URL", "WEBHOOK_SECRET")  # Не передаются процессам ботов
+USER_BOT_HOST_SCRIPT = "user_bot_host.py"  # Процесс, в котором работают боты в режиме host
+USER_BOT_HOST_MEMORY_MB = int(os.getenv("USER_BOT_HOST_MEMORY_MB", "2048"))  # Память одного хоста
+USER_BOT_HOST_MAX_FILES = 4096  # Открытых файлов и сокетов на хост
+USER_BOT_MEMORY_MB = int(os.getenv("USER_BOT_MEMORY_MB", "512"))  # Адресное пространство бота
+USER_BOT_CPU_SECONDS = int(os.getenv("USER_BOT_CPU_SECONDS", "3600"))  # Процессорного времени до перезапуска
+USER_BOT_MAX_FILES = 256  # Открытых файлов и сокетов
+USER_BOT_NICE = 5  # Пониженный приоритет относительно главного бота
+USER_BOT_LOG_MAX_BYTES = 1024 * 1024  # Размер лога до ротации
+USER_BOT_LOG_BACKUPS = 3  # Сколько старых логов хранить
+USER_BOT_RESTART_DELAY = 5  # Первая пауза перед перезапуском упавшего бота, секунд
+USER_BOT_RESTART_MAX_DELAY = 300  # Максимальная пауза перед перезапуском
+USER_BOT_MAX_CRASHES = 5  # Падений подряд, после которых бот останавливается
+USER_BOT_STABLE_AFTER = 60  # Проработав столько секунд, бот считается стабильным
+BOT_BUILD_WORKERS = int(os.getenv("BOT_BUILD_WORKERS", "3"))  # Одновременно создаваемых ботов
+BOT_BUILD_MAX_PENDING = 50  # Заданий на создание в очереди, сверх - отказ
+BOT_BASE_REQUIREMENTS = ["aiogram", "aiohttp"]  # Пакеты, нужные любому пользовательскому боту
+PIP_INSTALL_TIMEOUT = 300  # Ожидание установки пакетов, секунд
+WHEELHOUSE_DIR = "wheelhouse"  # Скачанные колёса пакетов для пользовательских ботов
+USER_BOT_ENV_DIR = "user_bot_env"  # Окружение (venv) с пакетами пользовательских ботов, отдельно от пакетов главного бота
+DEPENDENCY_CACHE_SIZE = 1000  # Разборов кода ботов в памяти
+USER_BOT_STOP_TIMEOUT = 10  # Ожидание завершения по SIGTERM до SIGKILL
 MAX_MESSAGE_LENGTH = 4000
+PRIORITY_ADMIN, PRIORITY_PAID, PRIORITY_FREE = 0, 1, 2  # Приоритеты в очереди к API
+DEFAULT_MODEL_RATE_LIMIT = {"rpm": 60, "burst": 10}  # Для моделей без model_rate_limits в настройках
+DEFAULT_UPSTREAM_QUEUE = {"max_wait": 30, "max_depth": 200}  # Ожидание в очереди (сек) и её размер
+DEFAULT_HEDGING = {"enabled": False, "min_samples": 20, "default_delay": 15}  # Дублирование медленных запросов
+RESPONSE_CACHE_DIR = "response_cache"  # Дисковый уровень кэша ответов
+DEFAULT_RESPONSE_CACHE = {  # Кэш ответов для повторяющихся запросов (response_cache в настройках)
+    "enabled": True, "ttl": 86400, "max_items": 1000, "disk": False,
+    "features": {"forward": False, "ask": False, "ocr": False}  # Включаются в bot_settings.json
+}
+SEND_GLOBAL_RATE = 30  # Сообщений в секунду на весь бот (лимит Telegram)
+SEND_PRIVATE_CHAT_RATE = 1  # Сообщений в секунду в личный чат
+SEND_GROUP_CHAT_RATE = 20 / 60  # Сообщений в секунду в группу (20 в минуту)
+SEND_CHAT_BURST = 3  # Сообщений подряд в чат без ожидания
+SEND_MAX_RETRIES = 3  # Повторов отправки при флуд-контроле и сетевых ошибках
+SEND_RETRY_JITTER = 1.0  # Случайная добавка к паузе перед повтором, секунд
+SEND_BUCKETS_LIMIT = 10000  # Чатов, после которого забываем восстановившиеся лимиты
+STREAM_EDIT_INTERVAL = 1.5  # Минимальная пауза между правками сообщения при потоковом выводе, секунд
+API_TIMEOUT = 60  # Таймаут запроса к API, секунд
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))  # Всего соединений в пуле
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "30"))  # Соединений к одному хосту
+HTTP_KEEPALIVE_TIMEOUT = 75  # Сколько держать простаивающее соединение, секунд
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(min(4, os.cpu_count() or 1))))  # Процессов распознавания
+OCR_MAX_PENDING = OCR_WORKERS * 4  # Задач в работе и в очереди, сверх этого фото отклоняются
+OCR_TIMEOUT = 30  # Лимит времени Tesseract на одно изображение, секунд
+OCR_CACHE_MAX_ITEMS = 5000  # Распознанных изображений в кэше
+OCR_CACHE_MAX_BYTES = 20 * 1024 * 1024  # Общий объём текста в кэше
 ADMIN_ID = 8087962709
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # Свой сервер Bot API (или fake_telegram.py для проверки)
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling или webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес бота; если задан, webhook регистрируется при запуске
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", os.getenv("WEBHOOK_PORT", "8080")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "50"))  # Обновлений в обработке одновременно
+WEBHOOK_MAX_PENDING = WEBHOOK_MAX_CONCURRENCY * 10  # Сверх этого отвечаем 503, Telegram повторит доставку
+WEBHOOK_SHUTDOWN_TIMEOUT = 30  # Ожидание начатых обновлений при остановке, секунд
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=TELEGRAM_TOKEN)
-dp = Dispatcher()
+bot = Bot(
+    token=TELEGRAM_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+
+
+def require_redis():
+    if redis is None:
+        raise RuntimeError("Для STATE_BACKEND=redis установите пакет redis (pip install redis)")
+
+
+def create_fsm_storage():
+    """Состояния FSM: в памяти процесса или общие для всех копий бота в Redis"""
+    if STATE_BACKEND == "redis":
+        require_redis()
+        return RedisStorage.from_url(REDIS_URL)
+    return MemoryStorage()
+
+
+dp = Dispatcher(storage=create_fsm_storage())
 
 # Создаем папку для ботов
 os.makedirs(BOTS_DIR, exist_ok=True)
 
-# Храним процессы запущенных ботов
-running_bots = {}
 
 
 # === FSM STATES ===
@@ -130,54 +280,787 @@ def load_db():
 
 
 def save_db(data):
-    """Сохранить в JSON"""
-    with open(DB_FILE, 'w', encoding='utf-8') as f:
+    """Сохранить в JSON (атомарно, через временный файл)"""
+    tmp_file = DB_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, DB_FILE)
+
+
+class ChatHistoryStore:
+    """История чатов в памяти + журнал изменений (JSONL) с фоновым сжатием в chat_history.json
+
+    Каждая запись - это одна строка в конце журнала, поэтому её стоимость
+    не зависит от размера истории. Снапшот (chat_history.json) переписывается
+    только при сжатии журнала в фоне.
+    """
+
+    def __init__(self, snapshot_file: str, wal_file: str):
+        self.snapshot_file = snapshot_file
+        self.wal_file = wal_file
+        self.compacting_file = wal_file + '.compacting'
+        self._users = {}
+        self._wal = None
+        self._wal_records = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._compaction = None
+        self._loop = None  # Цикл событий для сжатия, запрошенного из потока
+
+    def load(self):
+        """Загрузить снапшот и применить журнал"""
+        if self._loaded:
+            return
 
+        with self._lock:
+            # Первые вызовы могут прийти одновременно из разных потоков - журнал применяет один
+            if self._loaded:
+                return
+            for user_id_str, messages in load_db().items():
+                self._users[user_id_str] = deque(messages)
+
+            # Журнал от прерванного сжатия мог уже попасть в снапшот - применяем его без дублей
+            leftover = self._replay(self.compacting_file, dedupe=True)
+            self._wal_records = self._replay(self.wal_file, dedupe=False)
+            self._wal = open(self.wal_file, 'a', encoding='utf-8')
+            self._loaded = True
+
+        if leftover:
+            self.flush()
+
+        logging.info(f"История чатов загружена: {len(self._users)} пользователей, "
+                     f"{self._wal_records} записей в журнале")
+
+    def _replay(self, path: str, dedupe: bool) -> int:
+        """Применить записи журнала, вернуть их количество"""
+        if not os.path.exists(path):
+            return 0
+
+        count = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Оборванная последняя строка после аварийного завершения
+                    logging.warning(f"Пропущена повреждённая запись журнала {path}")
+                    continue
+                self._apply(record, dedupe)
+                count += 1
+        return count
+
+    def _apply(self, record: dict, dedupe: bool):
+        """Применить одну запись журнала к памяти"""
+        user_id_str = record["user_id"]
+        op = record["op"]
+
+        if op == "add":
+            messages = self._users.setdefault(user_id_str, deque())
+            if dedupe and messages and messages[-1]["timestamp"] >= record["timestamp"]:
+                return
+            messages.append({
+                "role": record["role"],
+                "content": record["content"],
+                "timestamp": record["timestamp"]
+            })
+        elif op == "clear":
+            if user_id_str in self._users:
+                self._users[user_id_str].clear()
+        elif op == "summarize":
+            self._replace_with_summary(self._users.get(user_id_str), record["since"], record["until"], record["summary"])
+
+    @staticmethod
+    def _replace_with_summary(messages: deque, since: str, until: str, summary: dict) -> int:
+        """Заменить прежнюю сводку и сообщения с since по until новой сводкой"""
+        if not messages:
+            return 0
+        # История могла измениться (очистка, повторное применение журнала) - тогда не трогаем
+        first = next((message for message in messages if not message.get("summary")), None)
+        if first is None or first["timestamp"] != since:
+            return 0
+        removed = 0
+        while messages and (messages[0].get("summary") or messages[0]["timestamp"] <= until):
+            messages.popleft()
+            removed += 1
+        messages.appendleft(summary)
+        return removed
+
+    def _write_wal(self, record: dict):
+        """Дописать запись в журнал"""
+        self._wal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._wal.flush()
+        self._wal_records += 1
+
+        if self._wal_records >= HISTORY_COMPACT_THRESHOLD:
+            self._schedule_compaction()
+
+    def append(self, user_id: int, role: str, content: str) -> dict:
+        """Добавить сообщение"""
+        self.load()
+        user_id_str = str(user_id)
+        message = {
+            "role": role,
+            "content": content,
+            "timestamp": datetime.now().isoformat()
+        }
 
-def save_message(user_id: int, role: str, content: str):
-    """Сохранить сообщение"""
-    db = load_db()
-    user_id_str = str(user_id)
+        with self._lock:
+            self._users.setdefault(user_id_str, deque()).append(message)
+            self._write_wal({"op": "add", "user_id": user_id_str, **message})
+        return message
+
+    def recent(self, user_id: int, limit: int = 20) -> list:
+        """Последние limit сообщений пользователя"""
+        self.load()
+        # Копируем под блокировкой: append/summarize/clear меняют deque из других потоков
+        with self._lock:
+            messages = self._users.get(str(user_id))
+            if not messages:
+                return []
+            return list(islice(reversed(messages), limit))[::-1]
+
+    def count(self, user_id) -> int:
+        """Число сообщений пользователя"""
+        self.load()
+        with self._lock:
+            return len(self._users.get(str(user_id), ()))
+
+    def user_ids(self) -> list:
+        self.load()
+        with self._lock:
+            return list(self._users)
+
+    def summarize(self, user_id, since: str, until: str, summary: dict) -> int:
+        """Свернуть сообщения с since по until в сводку, вернуть число удалённых"""
+        self.load()
+        user_id_str = str(user_id)
+        with self._lock:
+            removed = self._replace_with_summary(self._users.get(user_id_str), since, until, summary)
+            if removed:
+                self._write_wal({"op": "summarize", "user_id": user_id_str, "since": since,
+                                 "until": until, "summary": summary})
+        return removed
+
+    def clear(self, user_id: int):
+        """Очистить историю пользователя"""
+        self.load()
+        user_id_str = str(user_id)
+
+        with self._lock:
+            if user_id_str in self._users:
+                self._users[user_id_str].clear()
+                self._write_wal({"op": "clear", "user_id": user_id_str})
+
+    def snapshot(self) -> dict:
+        """Копия всей истории: {user_id: [сообщения]}"""
+        self.load()
+        with self._lock:
+            return {user_id_str: list(messages) for user_id_str, messages in self._users.items()}
+
+    def _rotate(self) -> dict:
+        """Переключиться на новый журнал и снять копию данных для снапшота"""
+        with self._lock:
+            snapshot = {user_id_str: list(messages) for user_id_str, messages in self._users.items()}
+            self._wal.close()
+            os.replace(self.wal_file, self.compacting_file)
+            self._wal = open(self.wal_file, 'a', encoding='utf-8')
+            self._wal_records = 0
+        return snapshot
+
+    def _write_snapshot(self, snapshot: dict):
+        """Записать снапшот и удалить сжатый журнал"""
+        save_db(snapshot)
+        os.remove(self.compacting_file)
+
+    def _schedule_compaction(self):
+        """Запустить сжатие в фоне, если оно ещё не идёт (append вызывается из потоков)"""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._start_compaction)
+
+    def _start_compaction(self):
+        if self._compaction is None or self._compaction.done():
+            self._compaction = asyncio.get_running_loop().create_task(self.compact())
+
+    async def compact(self):
+        """Сжать журнал в снапшот, не блокируя event loop"""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.flush)
+        except Exception as e:
+            logging.error(f"Ошибка сжатия истории чатов: {e}")
+
+    async def run_compactor(self):
+        """Периодически сжимать журнал"""
+        self._loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(HISTORY_COMPACT_INTERVAL)
+            if self._wal_records:
+                await self.compact()
+
+    def flush(self):
+        """Синхронно сжать журнал в снапшот"""
+        if not self._loaded:
+            return
+        with self._snapshot_lock:
+            self._write_snapshot(self._rotate())
 
-    if user_id_str not in db:
-        db[user_id_str] = []
 
-    db[user_id_str].append({
-        "role": role,
-        "content": content,
-        "timestamp": datetime.now().isoformat()
-    })
+class RedisHistoryStore:
+    """История чатов в Redis (STATE_BACKEND=redis) - общая для всех копий бота
+
+    Сообщения пользователя хранятся списком JSON-строк под ключом
+    chat_history:<user_id>, запись - один RPUSH. Интерфейс тот же, что
+    у ChatHistoryStore; compact() выгружает историю в chat_history.json для экспорта.
+    """
+
+    PREFIX = "chat_history:"
+    IMPORTED_KEY = "chat_history_imported"
+    IMPORT_LOCK_KEY = "chat_history_importing"
+    IMPORT_LOCK_TTL = 600  # Если копия бота упала во время импорта, другая повторит его после этой паузы, секунд
+
+    def __init__(self, url: str):
+        require_redis()
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+
+    def _key(self, user_id) -> str:
+        return f"{self.PREFIX}{user_id}"
+
+    def load(self):
+        """Один раз перенести локальную историю (снапшот и журнал) в Redis
+
+        Импортирует одна копия бота (ключ блокировки). Данные и отметка об импорте
+        записываются одной транзакцией MULTI: при ошибке не остаётся ни половины
+        истории, ни отметки, и импорт повторится при следующем запуске.
+        """
+        if self.client.exists(self.IMPORTED_KEY):
+            return
+        if not self.client.set(self.IMPORT_LOCK_KEY, datetime.now().isoformat(), nx=True, ex=self.IMPORT_LOCK_TTL):
+            logging.info("Историю чатов переносит в Redis другая копия бота")
+            return
+        try:
+            if self.client.exists(self.IMPORTED_KEY):
+                return
+            snapshot = ChatHistoryStore(DB_FILE, HISTORY_WAL_FILE).snapshot()
+            pipe = self.client.pipeline(transaction=True)
+            for user_id_str, messages in snapshot.items():
+                if messages:
+                    pipe.rpush(self._key(user_id_str), *(json.dumps(m, ensure_ascii=False) for m in messages))
+            pipe.set(self.IMPORTED_KEY, datetime.now().isoformat())
+            pipe.execute()
+        finally:
+            self.client.delete(self.IMPORT_LOCK_KEY)
+        logging.info(f"История чатов перенесена в Redis: {len(snapshot)} пользователей")
+
+    def append(self, user_id: int, role: str, content: str) -> dict:
+        """Добавить сообщение"""
+        message = {
+            "role": role,
+            "content": content,
+            "timestamp": datetime.now().isoformat()
+        }
+        self.client.rpush(self._key(user_id), json.dumps(message, ensure_ascii=False))
+        return message
+
+    def recent(self, user_id: int, limit: int = 20) -> list:
+        """Последние limit сообщений пользователя"""
+        return [json.loads(item) for item in self.client.lrange(self._key(user_id), -limit, -1)]
+
+    def count(self, user_id) -> int:
+        """Число сообщений пользователя"""
+        return self.client.llen(self._key(user_id))
+
+    def user_ids(self) -> list:
+        return [key[len(self.PREFIX):] for key in self.client.scan_iter(match=f"{self.PREFIX}*", count=1000)]
+
+    def summarize(self, user_id, since: str, until: str, summary: dict) -> int:
+        """Свернуть сообщения с since по until в сводку, вернуть число удалённых"""
+        key = self._key(user_id)
+
+        def replace(pipe) -> int:
+            messages = deque(json.loads(item) for item in pipe.lrange(key, 0, -1))
+            removed = ChatHistoryStore._replace_with_summary(messages, since, until, summary)
+            if removed:
+                pipe.multi()
+                pipe.ltrim(key, removed, -1)
+                pipe.lpush(key, json.dumps(summary, ensure_ascii=False))
+            return removed
+
+        # WATCH: если историю очистят между чтением и записью, транзакция повторится
+        return self.client.transaction(replace, key, value_from_callable=True)
+
+    def clear(self, user_id: int):
+        """Очистить историю пользователя"""
+        self.client.delete(self._key(user_id))
+
+    def snapshot(self) -> dict:
+        """Копия всей истории: {user_id: [сообщения]}"""
+        snapshot = {}
+        for key in self.client.scan_iter(match=f"{self.PREFIX}*", count=1000):
+            snapshot[key[len(self.PREFIX):]] = [json.loads(item) for item in self.client.lrange(key, 0, -1)]
+        return snapshot
+
+    async def compact(self):
+        """Выгрузить историю в chat_history.json"""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, lambda: save_db(self.snapshot()))
+        except Exception as e:
+            logging.error(f"Ошибка выгрузки истории чатов из Redis: {e}")
+
+    async def run_compactor(self):
+        """Журнала нет - сжимать нечего"""
 
-    save_db(db)
+    def flush(self):
+        """Данные уже в Redis"""
 
 
-def get_history(user_id: int, limit: int = 20) -> list:
+def create_history_store():
+    """Хранилище истории по STATE_BACKEND"""
+    if STATE_BACKEND == "redis":
+        return RedisHistoryStore(REDIS_URL)
+    return ChatHistoryStore(DB_FILE, HISTORY_WAL_FILE)
+
+
+history_store = create_history_store()
+
+
+# Хранилища истории, памяти и поиска ходят в сеть (Redis) и на диск, поэтому
+# функции ниже выполняют их в потоке, не останавливая цикл событий
+def store_message(user_id: int, role: str, content: str) -> dict:
+    message = history_store.append(user_id, role, content)
+    if chat_memory is not None:
+        chat_memory.add(user_id, message)
+    if user_store.search_available:
+        try:
+            user_store.index_messages(user_id, [message])
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка индексации сообщения для поиска: {e}")
+    return message
+
+
+async def save_message(user_id: int, role: str, content: str):
+    """Сохранить сообщение"""
+    await asyncio.to_thread(store_message, user_id, role, content)
+    history_summarizer.notify(user_id)
+
+
+async def get_history(user_id: int, limit: int = 20) -> list:
     """Получить историю"""
-    db = load_db()
-    user_id_str = str(user_id)
+    messages = await asyncio.to_thread(history_store.recent, user_id, limit)
+    return [{"role": msg["role"], "content": msg["content"]} for msg in messages if not msg.get("summary")]
 
-    if user_id_str not in db:
-        return []
 
-    messages = db[user_id_str][-limit:]
-    return [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+def delete_history(user_id: int):
+    history_store.clear(user_id)
+    history_archive.delete(user_id)
+    if chat_memory is not None:
+        chat_memory.clear(user_id)
+    if user_store.search_available:
+        user_store.delete_search(user_id)
 
 
-def clear_history(user_id: int):
+async def clear_history(user_id: int):
     """Очистить историю"""
-    db = load_db()
-    user_id_str = str(user_id)
+    history_summarizer.forget(user_id)
+    await asyncio.to_thread(delete_history, user_id)
+
+
+# === КОНТЕКСТ ЗАПРОСА ===
+class TokenCounter:
+    """Подсчёт токенов с кэшем по тексту сообщения
+
+    Для моделей OpenAI используется tiktoken (если установлен), для остальных -
+    оценка по числу символов. Записи истории не меняются: счётчики хранятся
+    отдельно, в LRU по (кодировка, sha1 текста), поэтому каждое сообщение считается
+    один раз, а кэш не держит копии длинных текстов. Вызывается из потоков.
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._cache = OrderedDict()
+        self._encodings = {}
+        self._lock = threading.Lock()
+        self._encodings_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _encoding(self, name: str):
+        # При первом обращении tiktoken скачивает файл кодировки - один раз на имя
+        with self._encodings_lock:
+            if name not in self._encodings:
+                encoding = None
+                if tiktoken is not None:
+                    try:
+                        encoding = tiktoken.get_encoding(name)
+                    except Exception as e:
+                        logging.warning(f"Кодировка {name} недоступна, считаю токены приблизительно: {e}")
+                self._encodings[name] = encoding
+            return self._encodings[name]
+
+    def preload(self):
+        """Загрузить кодировки всех моделей заранее (при запуске, в потоке)"""
+        for name in {config["encoding"] for config in MODEL_CONTEXT.values() if config.get("encoding")}:
+            self._encoding(name)
+
+    @staticmethod
+    def estimate(text: str) -> int:
+        """Приблизительно: ~4 символа латиницы или ~3 символа кириллицы на токен"""
+        non_ascii = len(text.encode('utf-8')) - len(text)
+        return math.ceil((len(text) - non_ascii) / 4 + non_ascii / 3)
+
+    def count(self, text: str, model: str) -> int:
+        name = MODEL_CONTEXT.get(model, {}).get("encoding")
+        key = (name, hashlib.sha1(text.encode('utf-8')).digest())
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+
+        encoding = self._encoding(name) if name else None
+        tokens = len(encoding.encode(text, disallowed_special=())) if encoding else self.estimate(text)
+        with self._lock:
+            self._cache[key] = tokens
+            while len(self._cache) > self.max_items:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "items": len(self._cache)}
+
+
+token_counter = TokenCounter(TOKEN_CACHE_SIZE)
+
+
+class ContextBuilder:
+    """История для запроса в пределах бюджета токенов модели
+
+    Сообщения берутся от новых к старым, пока помещаются в бюджет; слишком
+    длинное сообщение (вставленный документ, текст с фото) сокращается.
+    Не поместившиеся старые реплики сворачиваются в короткую сводку.
+    """
+
+    def __init__(self, counter: TokenCounter):
+        self.counter = counter
+
+    def tokens(self, message: dict, model: str) -> int:
+        return self.counter.count(message["content"], model) + MESSAGE_TOKEN_OVERHEAD
+
+    def shorten(self, content: str, tokens: int, limit: int) -> str:
+        """Обрезать текст примерно до limit токенов"""
+        keep = max(1, len(content) * limit // max(tokens, 1))
+        return content[:keep] + " …[сокращено]"
+
+    def build(self, user_id: int, model: str, user_message: str, memories: list = None) -> list:
+        """Сообщения истории (без нового сообщения пользователя), умещающиеся в бюджет
+
+        memories - похожие старые сообщения из долговременной памяти, [(сходство, сообщение)]
+        """
+        budget = MODEL_CONTEXT.get(model, {}).get("budget", DEFAULT_CONTEXT_BUDGET)
+        budget -= self.counter.count(user_message, model) + MESSAGE_TOKEN_OVERHEAD
+        if budget <= 0:
+            return []
+        message_limit = budget // 4
+
+        history = history_store.recent(user_id, CONTEXT_MAX_MESSAGES)
+        selected = []
+        used = 0
+        index = len(history)
+        while index > 0:
+            message = history[index - 1]
+            if message.get("summary"):
+                break
+            tokens = self.tokens(message, model)
+            content = message["content"]
+            if tokens > message_limit:
+                content = self.shorten(content, tokens, message_limit)
+                tokens = message_limit + MESSAGE_TOKEN_OVERHEAD
+            if used + tokens > budget:
+                break
+            selected.append({"role": message["role"], "content": content})
+            used += tokens
+            index -= 1
+        selected.reverse()
+
+        # Сводка, сохранённая сжатием истории, и начала не поместившихся вопросов
+        parts = []
+        stored = next((message for message in history if message.get("summary")), None)
+        if stored and used < budget:
+            content = f"Краткое содержание предыдущего разговора:\n{stored['content']}"
+            tokens = self.tokens({"content": content}, model)
+            limit = max(0, budget - used)
+            if tokens > limit:
+                content = self.shorten(content, tokens, limit)
+                tokens = limit
+            parts.append(content)
+            used += tokens
+        if memories and used < budget:
+            # Только то, чего уже нет в контексте
+            oldest = history[index]["timestamp"] if index < len(history) else None
+            recalled = [message for _, message in memories if oldest is None or message["timestamp"] < oldest]
+            content, tokens = self.recall(recalled, min(MEMORY_BUDGET, budget - used), model)
+            if content:
+                parts.append(content)
+                used += tokens
+        older = [message for message in history[:index] if not message.get("summary")]
+        summary = self.summarize(older, min(CONTEXT_SUMMARY_BUDGET, budget - used), model)
+        if summary:
+            parts.append(summary)
+        if parts:
+            selected.insert(0, {"role": "system", "content": "\n\n".join(parts)})
+        return selected
+
+    def recall(self, messages: list, budget: int, model: str) -> tuple:
+        """Найденные в памяти сообщения в хронологическом порядке и их размер в токенах"""
+        header = "Из прошлых разговоров (используй, если относится к вопросу):"
+        lines = []
+        used = self.counter.count(header, model)
+        for message in messages[:MEMORY_TOP_K]:
+            author = "Пользователь" if message["role"] == "user" else "Ассистент"
+            line = f"[{message['timestamp'][:10]}] {author}: {' '.join(message['content'][:MEMORY_LINE].split())}"
+            tokens = self.counter.count(line, model)
+            if used + tokens > budget:
+                continue
+            lines.append((message["timestamp"], line))
+            used += tokens
+        if not lines:
+            return "", 0
+        lines.sort()
+        return "\n".join([header, *(line for _, line in lines)]), used
+
+    def summarize(self, messages: list, budget: int, model: str) -> str:
+        """Сводка старых реплик: начала последних вопросов пользователя"""
+        if not messages or budget <= 0:
+            return ""
+        header = "Ранее в разговоре пользователь спрашивал:"
+        lines = []
+        used = self.counter.count(header, model)
+        for message in reversed(messages):
+            if message["role"] != "user":
+                continue
+            line = "- " + " ".join(message["content"][:CONTEXT_SUMMARY_LINE].split())
+            tokens = self.counter.estimate(line)
+            if used + tokens > budget:
+                break
+            lines.append(line)
+            used += tokens
+        if not lines:
+            return ""
+        return "\n".join([header, *reversed(lines)])
+
+
+context_builder = ContextBuilder(token_counter)
+
+
+# === СЖАТИЕ ИСТОРИИ ===
+class HistoryArchive:
+    """Холодное хранилище: исходные реплики, свёрнутые в сводку (gzip JSONL на пользователя)"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, user_id) -> str:
+        return os.path.join(self.directory, f"{user_id}.jsonl.gz")
+
+    def append(self, user_id, messages: list):
+        """Дописать сообщения (новым gzip-блоком в конец файла)"""
+        os.makedirs(self.directory, exist_ok=True)
+        with gzip.open(self.path(user_id), 'at', encoding='utf-8') as f:
+            for message in messages:
+                f.write(json.dumps(message, ensure_ascii=False) + "\n")
+
+    def read(self, user_id) -> list:
+        path = self.path(user_id)
+        if not os.path.exists(path):
+            return []
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def delete(self, user_id):
+        try:
+            os.remove(self.path(user_id))
+        except FileNotFoundError:
+            pass
+
+    def user_ids(self) -> list:
+        if not os.path.isdir(self.directory):
+            return []
+        return [name[:-len(".jsonl.gz")] for name in os.listdir(self.directory) if name.endswith(".jsonl.gz")]
+
+
+history_archive = HistoryArchive(HISTORY_ARCHIVE_DIR)
+
+
+class HistorySummarizer:
+    """Фоновое сворачивание старой истории в сводку
+
+    Когда у пользователя больше HISTORY_SUMMARY_TRIGGER сообщений, всё, кроме
+    последних HISTORY_KEEP_RECENT, пересказывается моделью SUMMARY_MODEL вместе
+    с прежней сводкой. Новая сводка заменяет эти сообщения в истории, а сами
+    сообщения уходят в архив. Так размер истории и промпта ограничен.
+    """
+
+    SYSTEM_PROMPT = (
+        "Сожми переписку пользователя с ассистентом в краткое содержание на языке переписки. "
+        "Сохрани факты о пользователе, его цели, принятые решения, важные данные и незакрытые вопросы. "
+        "Не добавляй ничего от себя. Если дано прежнее краткое содержание, объедини его с новыми репликами. "
+        "Не больше 300 слов."
+    )
+
+    def __init__(self):
+        self._pending = set()
+        self._clears = {}  # user_id -> сколько раз история очищалась (пока идёт запрос на сводку)
+        self.summarized = 0
+        self.failed = 0
+
+    def notify(self, user_id):
+        """Проверить историю пользователя при следующем проходе"""
+        self._pending.add(str(user_id))
+
+    def forget(self, user_id):
+        """История очищена: не сворачивать её и не дописывать архив"""
+        user_id = str(user_id)
+        self._pending.discard(user_id)
+        self._clears[user_id] = self._clears.get(user_id, 0) + 1
+
+    async def run(self):
+        """Фоновая проверка пользователей с новыми сообщениями"""
+        loop = asyncio.get_running_loop()
+        try:
+            self._pending.update(await loop.run_in_executor(None, history_store.user_ids))
+        except Exception as e:
+            logging.error(f"Не удалось получить список историй: {e}")
+        while True:
+            while self._pending:
+                user_id = self._pending.pop()
+                try:
+                    await self.summarize_user(user_id)
+                except Exception as e:
+                    self.failed += 1
+                    logging.error(f"Ошибка сжатия истории {user_id}: {e}")
+            await asyncio.sleep(HISTORY_SUMMARY_INTERVAL)
+
+    async def summarize_user(self, user_id):
+        loop = asyncio.get_running_loop()
+        clears = self._clears.get(user_id, 0)
+        count = await loop.run_in_executor(None, history_store.count, user_id)
+        if count <= HISTORY_SUMMARY_TRIGGER:
+            return
+
+        messages = await loop.run_in_executor(None, history_store.recent, user_id, count)
+        older = messages[:-HISTORY_KEEP_RECENT]
+        previous = next((message for message in older if message.get("summary")), None)
+        turns = []
+        size = 0
+        for message in older:
+            if message.get("summary"):
+                continue
+            size += min(len(message["content"]), HISTORY_SUMMARY_MESSAGE_CHARS)
+            if turns and size > HISTORY_SUMMARY_INPUT_CHARS:
+                # Остальное свернём следующим проходом
+                self.notify(user_id)
+                break
+            turns.append(message)
+        if not turns:
+            return
+
+        text = await self.request_summary(previous, turns)
+        if not text:
+            self.failed += 1
+            return
+
+        until = turns[-1]["timestamp"]
+        summary = {"role": "system", "content": text, "timestamp": until, "summary": True}
+        # Пока ждали сводку, пользователь мог очистить историю (/clear) - удалённые реплики не архивируем
+        if self._clears.get(user_id, 0) != clears:
+            return
+        # Сначала архив: при сбое между шагами реплики лучше продублировать, чем потерять
+        await loop.run_in_executor(None, history_archive.append, user_id, turns)
+        if self._clears.get(user_id, 0) != clears:
+            # Очистка успела пройти, пока писался архив
+            await loop.run_in_executor(None, history_archive.delete, user_id)
+            return
+        removed = await loop.run_in_executor(
+            None, history_store.summarize, user_id, turns[0]["timestamp"], until, summary
+        )
+        if removed:
+            self.summarized += 1
+            logging.info(f"История {user_id}: {len(turns)} сообщений свёрнуто в сводку")
+
+    async def request_summary(self, previous: dict, turns: list) -> str:
+        lines = []
+        if previous:
+            lines.append(f"Прежнее краткое содержание:\n{previous['content']}\n")
+        lines.append("Новые реплики:")
+        for message in turns:
+            author = "Пользователь" if message["role"] == "user" else "Ассистент"
+            lines.append(f"{author}: {message['content'][:HISTORY_SUMMARY_MESSAGE_CHARS]}")
+
+        messages = [
+            {"role": "system", "content": self.SYSTEM_PROMPT},
+            {"role": "user", "content": "\n".join(lines)}
+        ]
+        result = await make_onlysq_request(messages, SUMMARY_MODEL, PRIORITY_FREE)
+        if not result.get("success"):
+            logging.warning(f"Сводка истории не получена: {result.get('error') or result.get('status')}")
+            return None
+        return result["data"]["choices"][0]["message"]["content"].strip()
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "summarized": self.summarized, "failed": self.failed}
+
+
+history_summarizer = HistorySummarizer()
+
+
+# === ДОЛГОВРЕМЕННАЯ ПАМЯТЬ ===
+def load_memory_backfill(user_id) -> list:
+    """Старые сообщения пользователя для первого построения индекса: архив и история"""
+    messages = history_archive.read(user_id)
+    messages += [message for message in history_store.recent(user_id, MEMORY_BACKFILL) if not message.get("summary")]
+    return messages[-MEMORY_BACKFILL:]
 
-    if user_id_str in db:
-        db[user_id_str] = []
-        save_db(db)
+
+def create_chat_memory():
+    if vector_memory is None:
+        logging.warning("numpy не установлен - долговременная память чата отключена")
+        return None
+    return vector_memory.VectorMemory(MEMORY_DIR, MEMORY_MAX_ITEMS, MEMORY_MAX_USERS, load_memory_backfill)
+
+
+chat_memory = create_chat_memory()
+
+
+async def recall_memories(user_id: int, text: str) -> list:
+    """Старые сообщения, похожие на вопрос: [(сходство, сообщение)]"""
+    if chat_memory is None:
+        return []
+    try:
+        # Запас кандидатов: часть из них может оказаться в контексте
+        return await asyncio.to_thread(chat_memory.search, user_id, text, MEMORY_TOP_K * 3, MEMORY_MIN_SCORE)
+    except Exception as e:
+        logging.error(f"Ошибка поиска в памяти чата: {e}")
+        return []
 
 
+async def run_memory_saver():
+    """Периодически записывать изменённые индексы памяти"""
+    while True:
+        await asyncio.sleep(MEMORY_SAVE_INTERVAL)
+        try:
+            await asyncio.to_thread(chat_memory.save_dirty)
+        except Exception as e:
+            logging.error(f"Ошибка записи памяти чата: {e}")
 
 # === РАБОТА С ЕДИНОЙ БАЗОЙ ДАННЫХ ===
 def load_database():
-    """Загрузить базу данных"""
+    """Загрузить старую JSON базу (используется только для импорта в SQLite)"""
     if os.path.exists(DATABASE_FILE):
         try:
             with open(DATABASE_FILE, 'r', encoding='utf-8') as f:
@@ -196,48 +1079,558 @@ def load_database():
     return {"users": {}}
 
 
-def save_database(data):
-    """Сохранить базу данных с резервным копированием"""
-    # Создаем резервную копию перед сохранением
-    if os.path.exists(DATABASE_FILE):
-        import shutil
-        backup_file = DATABASE_FILE + '.backup'
+class UserStore:
+    """Пользователи, токены моделей и боты в SQLite
+
+    Каждое изменение - это обновление одной строки по индексу,
+    а списание токена выполняется одним атомарным UPDATE.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL DEFAULT 'unknown',
+            total_requests INTEGER NOT NULL DEFAULT 0,
+            last_reset TEXT NOT NULL,
+            registration_date TEXT NOT NULL,
+            selected_model TEXT NOT NULL,
+            last_forwarded TEXT,
+            merge_messages INTEGER NOT NULL DEFAULT 0,
+            plan TEXT NOT NULL DEFAULT 'free'
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_last_reset ON users(last_reset);
+
+        CREATE TABLE IF NOT EXISTS model_tokens (
+            user_id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            tokens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, model)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS bots (
+            bot_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            token TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            model TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            is_running INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_bots_user ON bots(user_id);
+
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+
+        -- Боты, остановленные хостом user_bot_host.py после падений: владельцев уведомляет главный бот
+        CREATE TABLE IF NOT EXISTS bot_notifications (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            bot_id TEXT NOT NULL,
+            crashes INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        );
+    """
+
+    # Полнотекстовый поиск по истории (/search): индексируются основы слов с префиксом
+    # владельца (u123_борщ, '_' - часть слова) и владелец (для удаления), остальное хранится
+    # для показа результатов. detail=column - без позиций слов, индекс меньше.
+    SEARCH_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS chat_search USING fts5(
+            terms, owner, role UNINDEXED, timestamp UNINDEXED, content UNINDEXED,
+            detail = 'column', tokenize = "unicode61 tokenchars '_'"
+        );
+    """
+
+    # Колонки, добавленные в схему позже: для баз, созданных до их появления
+    ADDED_COLUMNS = {
+        "users": {
+            "merge_messages": "INTEGER NOT NULL DEFAULT 0",
+            "plan": "TEXT NOT NULL DEFAULT 'free'",
+        },
+        "bots": {
+            "pid": "INTEGER",
+        },
+    }
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._search = False
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Соединение открывается при первом обращении"""
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    conn = sqlite3.connect(
+                        self.path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False, isolation_level=None
+                    )
+                    conn.row_factory = sqlite3.Row
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                    conn.executescript(self.SCHEMA)
+                    self._add_missing_columns(conn)
+                    try:
+                        conn.executescript(self.SEARCH_SCHEMA)
+                        self._search = True
+                    except sqlite3.OperationalError as e:
+                        logging.warning(f"SQLite без FTS5, поиск по истории отключен: {e}")
+                    self._conn = conn
+        return self._conn
+
+    def _add_missing_columns(self, conn: sqlite3.Connection):
+        """Добавить колонки, появившиеся после создания базы"""
+        for table, columns in self.ADDED_COLUMNS.items():
+            existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for name, definition in columns.items():
+                if name not in existing:
+                    try:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                    except sqlite3.OperationalError as e:
+                        # Колонку мог одновременно добавить другой процесс бота
+                        if "duplicate column" not in str(e):
+                            raise
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция с блокировкой на запись"""
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        """Выполнить одиночный запрос на изменение"""
+        with self._lock:
+            return self.conn.execute(sql, params)
+
+    def query(self, sql: str, params: tuple = ()) -> list:
+        """Выполнить запрос и забрать все строки"""
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def query_one(self, sql: str, params: tuple = ()):
+        """Выполнить запрос и забрать первую строку"""
+        with self._lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    # --- служебное ---
+    def get_meta(self, key: str):
+        row = self.query_one("SELECT value FROM meta WHERE key = ?", (key,))
+        return row["value"] if row else None
+
+    def take_bot_notifications(self) -> list:
+        """Забрать накопившиеся уведомления об остановленных ботах"""
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT user_id, bot_id, crashes FROM bot_notifications ORDER BY id").fetchall()
+            conn.execute("DELETE FROM bot_notifications")
+        return rows
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Взять или продлить аренду: одна копия бота на роль, пока продлевает её вовремя"""
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (f"lease_{name}",)).fetchone()
+            if row is not None:
+                holder, _, expires_at = row["value"].rpartition("|")
+                if holder != owner and float(expires_at) > now:
+                    return False
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (f"lease_{name}", f"{owner}|{now + ttl}")
+            )
+        return True
+
+    def release_lease(self, name: str, owner: str):
+        with self.transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (f"lease_{name}",)).fetchone()
+            if row is not None and row["value"].rpartition("|")[0] == owner:
+                conn.execute("DELETE FROM meta WHERE key = ?", (f"lease_{name}",))
+
+    def set_meta(self, key: str, value: str):
+        self.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+
+    def backup(self, target_path: str):
+        """Согласованная копия базы (SQLite backup API)"""
+        target = sqlite3.connect(target_path)
         try:
-            shutil.copy2(DATABASE_FILE, backup_file)
-        except Exception as e:
-            logging.error(f"Ошибка создания резервной копии: {e}")
-    
-    # Сохраняем новые данные
-    try:
-        with open(DATABASE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.error(f"Ошибка сохранения базы данных: {e}")
-        # Восстанавливаем из резервной копии
-        if os.path.exists(backup_file):
-            shutil.copy2(backup_file, DATABASE_FILE)
-            logging.info("База данных восстановлена из резервной копии")
+            with self._lock:
+                self.conn.backup(target)
+        finally:
+            target.close()
+
+    # --- поиск по истории ---
+    @property
+    def search_available(self) -> bool:
+        return self.conn is not None and self._search
+
+    @staticmethod
+    def _search_rows(user_id, messages) -> list:
+        return [
+            (text_search.index_terms(message["content"], f"u{user_id}"), f"u{user_id}", message["role"],
+             message["timestamp"], message["content"])
+            for message in messages
+        ]
+
+    def index_messages(self, user_id, messages: list):
+        """Добавить сообщения в поисковый индекс"""
+        rows = self._search_rows(user_id, messages)
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO chat_search (terms, owner, role, timestamp, content) VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def import_search(self, histories) -> int:
+        """Однократно проиндексировать историю, сохранённую до появления поиска
+
+        histories - пары (user_id, сообщения). Всё в одной транзакции вместе с отметкой
+        в meta: копии бота не проиндексируют историю дважды, а прерванный импорт не оставит половину.
+        """
+        imported = 0
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'search_indexed'").fetchone():
+                return 0
+            for user_id, messages in histories:
+                rows = self._search_rows(user_id, messages)
+                conn.executemany(
+                    "INSERT INTO chat_search (terms, owner, role, timestamp, content) VALUES (?, ?, ?, ?, ?)", rows
+                )
+                imported += len(rows)
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('search_indexed', ?)", (datetime.now().isoformat(),)
+            )
+        return imported
+
+    def search_messages(self, user_id, stems: list, limit: int, offset: int) -> tuple:
+        """Сообщения пользователя со всеми основами: (всего найдено, строки страницы)"""
+        match = text_search.match_expression(f"u{user_id}", stems)
+        total = self.query_one("SELECT count(*) AS total FROM chat_search WHERE chat_search MATCH ?", (match,))
+        rows = self.query(
+            "SELECT role, timestamp, content FROM chat_search WHERE chat_search MATCH ? "
+            "ORDER BY rank LIMIT ? OFFSET ?",
+            (match, limit, offset)
+        )
+        return total["total"], rows
+
+    def delete_search(self, user_id):
+        """Удалить сообщения пользователя из индекса"""
+        self.execute(
+            "DELETE FROM chat_search WHERE rowid IN "
+            "(SELECT rowid FROM chat_search WHERE chat_search MATCH ?)",
+            (f'owner : "u{user_id}"',)
+        )
+
+    # --- пользователи ---
+    def _user_dict(self, row: sqlite3.Row, model_tokens: dict, bots: list) -> dict:
+        """Собрать пользователя в формате старой JSON базы"""
+        return {
+            "username": row["username"],
+            "model_tokens": model_tokens,
+            "total_requests": row["total_requests"],
+            "last_reset": row["last_reset"],
+            "registration_date": row["registration_date"],
+            "selected_model": row["selected_model"],
+            "merge_messages": bool(row["merge_messages"]),
+            "plan": row["plan"],
+            "bots": bots
+        }
+
+    def get_user(self, user_id: int):
+        """Пользователь или None"""
+        row = self.query_one("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        if row is None:
+            return None
+        if self._is_reset_due(row["last_reset"]):
+            with self.transaction() as conn:
+                self._reset_if_due(conn, user_id)
+            row = self.query_one("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        return self._user_dict(row, self.get_model_tokens(user_id), self.get_bots(user_id))
+
+    def create_user(self, user_id: int, username: str, model_tokens: dict):
+        """Создать пользователя (если его ещё нет)"""
+        now = datetime.now().isoformat()
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO users "
+                "(user_id, username, total_requests, last_reset, registration_date, selected_model) "
+                "VALUES (?, ?, 0, ?, ?, ?)",
+                (user_id, username, now, now, DEFAULT_MODEL)
+            )
+            if cursor.rowcount:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO model_tokens (user_id, model, tokens) VALUES (?, ?, ?)",
+                    [(user_id, model_id, tokens) for model_id, tokens in model_tokens.items()]
+                )
+
+    def set_selected_model(self, user_id: int, model: str):
+        self.execute("UPDATE users SET selected_model = ? WHERE user_id = ?", (model, user_id))
+
+    def set_plan(self, user_id: int, plan: str):
+        self.execute("UPDATE users SET plan = ? WHERE user_id = ?", (plan, user_id))
+
+    def set_merge_messages(self, user_id: int, enabled: bool):
+        self.execute("UPDATE users SET merge_messages = ? WHERE user_id = ?", (int(enabled), user_id))
+
+    def set_last_forwarded(self, user_id: int, text: str):
+        self.execute("UPDATE users SET last_forwarded = ? WHERE user_id = ?", (text, user_id))
+
+    def get_last_forwarded(self, user_id: int):
+        row = self.query_one("SELECT last_forwarded FROM users WHERE user_id = ?", (user_id,))
+        return row["last_forwarded"] if row else None
+
+    def all_users(self) -> dict:
+        """Все пользователи в формате старой JSON базы (для админки)"""
+        with self._lock:
+            tokens = {}
+            for row in self.conn.execute("SELECT user_id, model, tokens FROM model_tokens"):
+                tokens.setdefault(row["user_id"], {})[row["model"]] = row["tokens"]
+            bots = {}
+            for row in self.conn.execute("SELECT * FROM bots ORDER BY rowid"):
+                bots.setdefault(row["user_id"], []).append(self._bot_dict(row))
+            return {
+                str(row["user_id"]): self._user_dict(row, tokens.get(row["user_id"], {}), bots.get(row["user_id"], []))
+                for row in self.conn.execute("SELECT * FROM users ORDER BY rowid")
+            }
+
+    def stats(self) -> dict:
+        """Агрегированная статистика одним проходом по индексам"""
+        row = self.query_one("SELECT COUNT(*) AS total, COALESCE(SUM(total_requests), 0) AS requests FROM users")
+        active = self.query_one("SELECT COUNT(DISTINCT user_id) FROM model_tokens WHERE tokens > 0")[0]
+        return {"total_users": row["total"], "total_requests": row["requests"], "active_users": active}
+
+    # --- токены ---
+    def get_model_tokens(self, user_id: int) -> dict:
+        rows = self.query("SELECT model, tokens FROM model_tokens WHERE user_id = ?", (user_id,))
+        return {row["model"]: row["tokens"] for row in rows}
+
+    def get_balance(self, user_id: int, model_id: str) -> int:
+        with self.transaction() as conn:
+            self._reset_if_due(conn, user_id)
+            row = conn.execute(
+                "SELECT tokens FROM model_tokens WHERE user_id = ? AND model = ?", (user_id, model_id)
+            ).fetchone()
+        return row["tokens"] if row else 0
+
+    def consume_token(self, user_id: int, model_id: str = None) -> bool:
+        """Атомарно списать один токен модели"""
+        with self.transaction() as conn:
+            self._reset_if_due(conn, user_id)
+            if model_id is None:
+                row = conn.execute("SELECT selected_model FROM users WHERE user_id = ?", (user_id,)).fetchone()
+                if row is None:
+                    return False
+                model_id = row["selected_model"]
+
+            cursor = conn.execute(
+                "UPDATE model_tokens SET tokens = tokens - 1 WHERE user_id = ? AND model = ? AND tokens > 0",
+                (user_id, model_id)
+            )
+            if not cursor.rowcount:
+                return False
+            conn.execute("UPDATE users SET total_requests = total_requests + 1 WHERE user_id = ?", (user_id,))
+            return True
+
+    def add_tokens(self, user_id: int, amount: int, model_ids: list):
+        """Начислить токены указанным моделям"""
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is None:
+                return
+            conn.executemany(
+                "INSERT INTO model_tokens (user_id, model, tokens) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id, model) DO UPDATE SET tokens = tokens + excluded.tokens",
+                [(user_id, model_id, amount) for model_id in model_ids]
+            )
+
+    # --- сброс лимитов ---
+    @staticmethod
+    def _reset_cutoff() -> str:
+        """Сбрасываем тех, у кого последний сброс был раньше этого момента"""
+        return (datetime.now() - timedelta(hours=QUOTA_RESET_HOURS)).isoformat()
+
+    def _is_reset_due(self, last_reset: str) -> bool:
+        return last_reset <= self._reset_cutoff()
+
+    def _write_limits(self, conn: sqlite3.Connection, user_ids: list, limits: dict):
+        """Выставить токены всех моделей по лимитам"""
+        conn.executemany(
+            "INSERT INTO model_tokens (user_id, model, tokens) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id, model) DO UPDATE SET tokens = excluded.tokens",
+            [(user_id, model_id, limit) for user_id in user_ids for model_id, limit in limits.items()]
+        )
+
+    def _reset_if_due(self, conn: sqlite3.Connection, user_id: int) -> bool:
+        """Ленивый сброс лимитов одного пользователя (одна строка по первичному ключу)"""
+        cursor = conn.execute(
+            "UPDATE users SET last_reset = ? WHERE user_id = ? AND last_reset <= ?",
+            (datetime.now().isoformat(), user_id, self._reset_cutoff())
+        )
+        if not cursor.rowcount:
+            return False
+        self._write_limits(conn, [user_id], get_model_limits())
+        return True
+
+    def reset_expired(self, limits: dict, batch_size: int) -> int:
+        """Сбросить лимиты одной пачке пользователей, у которых подошёл срок"""
+        now = datetime.now().isoformat()
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT user_id FROM users WHERE last_reset <= ? ORDER BY last_reset LIMIT ?",
+                (self._reset_cutoff(), batch_size)
+            ).fetchall()
+            user_ids = [row["user_id"] for row in rows]
+            if user_ids:
+                conn.executemany("UPDATE users SET last_reset = ? WHERE user_id = ?", [(now, uid) for uid in user_ids])
+                self._write_limits(conn, user_ids, limits)
+        return len(user_ids)
+
+    def next_reset_due(self):
+        """Время ближайшего сброса (timestamp) или None"""
+        row = self.query_one("SELECT MIN(last_reset) AS oldest FROM users")
+        if row is None or row["oldest"] is None:
+            return None
+        return datetime.fromisoformat(row["oldest"]).timestamp() + QUOTA_RESET_HOURS * 3600
+
+    def fill_missing_models(self, limits: dict) -> int:
+        """Добавить всем пользователям недостающие модели"""
+        added = 0
+        with self.transaction() as conn:
+            for model_id, limit in limits.items():
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO model_tokens (user_id, model, tokens) SELECT user_id, ?, ? FROM users",
+                    (model_id, limit)
+                )
+                added += cursor.rowcount
+        return added
+
+    # --- боты ---
+    def _bot_dict(self, row: sqlite3.Row) -> dict:
+        return {
+            "bot_id": row["bot_id"],
+            "token": row["token"],
+            "prompt": row["prompt"],
+            "model": row["model"],
+            "created_at": row["created_at"],
+            "is_running": bool(row["is_running"])
+        }
+
+    def get_bots(self, user_id: int) -> list:
+        rows = self.query("SELECT * FROM bots WHERE user_id = ? ORDER BY rowid", (user_id,))
+        return [self._bot_dict(row) for row in rows]
+
+    def get_bot(self, user_id: int, bot_id: str):
+        row = self.query_one("SELECT * FROM bots WHERE bot_id = ? AND user_id = ?", (bot_id, user_id))
+        return self._bot_dict(row) if row else None
+
+    def add_bot(self, user_id: int, bot: dict):
+        self.execute(
+            "INSERT OR REPLACE INTO bots (bot_id, user_id, token, prompt, model, created_at, is_running) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (bot["bot_id"], user_id, bot["token"], bot["prompt"], bot.get("model", DEFAULT_MODEL),
+             bot.get("created_at", datetime.now().isoformat()), int(bot.get("is_running", False)))
+        )
+
+    def update_bot(self, user_id: int, bot_id: str, **fields):
+        """Обновить поля одного бота"""
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self.execute(
+            f"UPDATE bots SET {columns} WHERE bot_id = ? AND user_id = ?",
+            (*fields.values(), bot_id, user_id)
+        )
+
+    def supervised_bots(self) -> list:
+        """Состояние всех ботов для надзора за процессами"""
+        return self.query("SELECT bot_id, user_id, is_running, pid FROM bots")
+
+    def delete_bot(self, user_id: int, bot_id: str):
+        self.execute("DELETE FROM bots WHERE bot_id = ? AND user_id = ?", (bot_id, user_id))
+
+    # --- импорт ---
+    def import_json(self, data: dict) -> int:
+        """Однократный импорт пользователей и ботов из database.json"""
+        imported = 0
+        with self.transaction() as conn:
+            for user_id_str, user_data in data.get("users", {}).items():
+                user_id = int(user_id_str)
+                now = datetime.now().isoformat()
+                conn.execute(
+                    "INSERT OR IGNORE INTO users "
+                    "(user_id, username, total_requests, last_reset, registration_date, selected_model, last_forwarded) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (user_id, user_data.get("username", "unknown"), user_data.get("total_requests", 0),
+                     user_data.get("last_reset", now), user_data.get("registration_date", now),
+                     user_data.get("selected_model", DEFAULT_MODEL), user_data.get("last_forwarded"))
+                )
+
+                model_tokens = user_data.get("model_tokens")
+                if model_tokens is None and "requests_left" in user_data:
+                    # Старый формат: общий баланс переносим на все модели
+                    model_tokens = {model_id: user_data["requests_left"] for model_id in AVAILABLE_MODELS}
+                conn.executemany(
+                    "INSERT OR IGNORE INTO model_tokens (user_id, model, tokens) VALUES (?, ?, ?)",
+                    [(user_id, model_id, tokens) for model_id, tokens in (model_tokens or {}).items()]
+                )
+
+                for bot in user_data.get("bots", []):
+                    conn.execute(
+                        "INSERT OR IGNORE INTO bots (bot_id, user_id, token, prompt, model, created_at, is_running) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (bot["bot_id"], user_id, bot["token"], bot["prompt"], bot.get("model", DEFAULT_MODEL),
+                         bot.get("created_at", now), int(bot.get("is_running", False)))
+                    )
+                imported += 1
+        return imported
+
+
+user_store = UserStore(SQLITE_FILE)
+
+
+def import_search_index():
+    """Проиндексировать для /search историю и архив, сохранённые до появления поиска"""
+    if not user_store.search_available or user_store.get_meta("search_indexed"):
+        return
+    snapshot = history_store.snapshot()
+
+    def histories():
+        for user_id_str in set(snapshot) | set(history_archive.user_ids()):
+            hot = [message for message in snapshot.get(user_id_str, []) if not message.get("summary")]
+            yield user_id_str, history_archive.read(user_id_str) + hot
+
+    imported = user_store.import_search(histories())
+    logging.info(f"Проиндексировано сообщений для поиска: {imported}")
+
+
+def import_json_database():
+    """Перенести database.json в SQLite (выполняется один раз)"""
+    if user_store.get_meta("json_imported"):
+        return
+    if os.path.exists(DATABASE_FILE):
+        imported = user_store.import_json(load_database())
+        logging.info(f"Импортировано пользователей из {DATABASE_FILE}: {imported}")
+    user_store.set_meta("json_imported", datetime.now().isoformat())
 
 
 def get_user_bots(user_id: int) -> list:
     """Получить ботов пользователя"""
-    db = load_database()
-    user_id_str = str(user_id)
-    if user_id_str in db["users"]:
-        return db["users"][user_id_str].get("bots", [])
-    return []
+    return user_store.get_bots(user_id)
 
 
 def add_bot(user_id: int, bot_token: str, prompt: str, bot_id: str, model: str):
     """Добавить бота"""
-    db = load_database()
-    user_id_str = str(user_id)
-    if user_id_str not in db["users"]:
-        db["users"][user_id_str] = {"bots": []}
-    if "bots" not in db["users"][user_id_str]:
-        db["users"][user_id_str]["bots"] = []
-    
-    db["users"][user_id_str]["bots"].append({
+    user_store.add_bot(user_id, {
         "bot_id": bot_id,
         "token": bot_token,
         "prompt": prompt,
@@ -245,223 +1638,119 @@ def add_bot(user_id: int, bot_token: str, prompt: str, bot_id: str, model: str):
         "created_at": datetime.now().isoformat(),
         "is_running": False
     })
-    save_database(db)
-
-
-def update_bot_status(user_id: int, bot_id: str, is_running: bool):
-    """Обновить статус бота"""
-    db = load_database()
-    user_id_str = str(user_id)
-    if user_id_str in db["users"] and "bots" in db["users"][user_id_str]:
-        for bot in db["users"][user_id_str]["bots"]:
-            if bot["bot_id"] == bot_id:
-                bot["is_running"] = is_running
-                save_database(db)
-                break
 
 
 def delete_bot_from_db(user_id: int, bot_id: str):
     """Удалить бота"""
-    db = load_database()
-    user_id_str = str(user_id)
-    if user_id_str in db["users"] and "bots" in db["users"][user_id_str]:
-        db["users"][user_id_str]["bots"] = [b for b in db["users"][user_id_str]["bots"] if b["bot_id"] != bot_id]
-        save_database(db)
+    user_store.delete_bot(user_id, bot_id)
 
 
 def get_bot_data(user_id: int, bot_id: str):
     """Получить данные бота"""
-    bots = get_user_bots(user_id)
-    for bot in bots:
-        if bot["bot_id"] == bot_id:
-            return bot
-    return None
+    return user_store.get_bot(user_id, bot_id)
 
 
 def update_bot_prompt(user_id: int, bot_id: str, new_prompt: str):
     """Обновить промпт бота"""
-    db = load_database()
-    user_id_str = str(user_id)
-    if user_id_str in db["users"] and "bots" in db["users"][user_id_str]:
-        for bot in db["users"][user_id_str]["bots"]:
-            if bot["bot_id"] == bot_id:
-                bot["prompt"] = new_prompt
-                save_database(db)
-                break
+    user_store.update_bot(user_id, bot_id, prompt=new_prompt)
 
 
 # === РАБОТА С ПОЛЬЗОВАТЕЛЯМИ ===
 def get_user_data(user_id: int, username: str = None):
     """Получить данные пользователя"""
-    db = load_database()
-    user_id_str = str(user_id)
-    needs_save = False
-    
-    if user_id_str not in db["users"]:
+    user_data = user_store.get_user(user_id)
+    if user_data is None:
         # Создаем токены для каждой модели
         model_tokens = {}
         for model_id in AVAILABLE_MODELS.keys():
             model_tokens[model_id] = get_model_limit(model_id)
-        
-        db["users"][user_id_str] = {
-            "username": username or "unknown",
-            "model_tokens": model_tokens,  # Токены для каждой модели
-            "total_requests": 0,
-            "last_reset": datetime.now().isoformat(),
-            "registration_date": datetime.now().isoformat(),
-            "selected_model": DEFAULT_MODEL,
-            "bots": []
-        }
-        needs_save = True
-    
-    # Миграция старых данных
-    if "requests_left" in db["users"][user_id_str] and "model_tokens" not in db["users"][user_id_str]:
-        # Конвертируем старый формат в новый
-        old_balance = db["users"][user_id_str].pop("requests_left", 0)
-        model_tokens = {}
-        for model_id in AVAILABLE_MODELS.keys():
-            model_tokens[model_id] = old_balance  # Переносим старый баланс на все модели
-        db["users"][user_id_str]["model_tokens"] = model_tokens
-        needs_save = True
-    
-    # Добавляем недостающие модели (только если их нет)
-    if "model_tokens" in db["users"][user_id_str]:
-        for model_id in AVAILABLE_MODELS.keys():
-            if model_id not in db["users"][user_id_str]["model_tokens"]:
-                db["users"][user_id_str]["model_tokens"][model_id] = get_model_limit(model_id)
-                needs_save = True
-    
-    if "selected_model" not in db["users"][user_id_str]:
-        db["users"][user_id_str]["selected_model"] = DEFAULT_MODEL
-        needs_save = True
-        
-    if "bots" not in db["users"][user_id_str]:
-        db["users"][user_id_str]["bots"] = []
-        needs_save = True
-    
-    # Сохраняем только если были изменения
-    if needs_save:
-        save_database(db)
-    
-    return db["users"][user_id_str]
+        user_store.create_user(user_id, username or "unknown", model_tokens)
+        user_data = user_store.get_user(user_id)
+    return user_data
+
+
+def find_user(user_id: int):
+    """Найти пользователя без регистрации (None, если его нет)"""
+    return user_store.get_user(user_id)
 
 
 def set_user_model(user_id: int, model: str):
     """Установить модель пользователя"""
-    db = load_database()
-    user_id_str = str(user_id)
-    if user_id_str in db["users"]:
-        db["users"][user_id_str]["selected_model"] = model
-        save_database(db)
+    user_store.set_selected_model(user_id, model)
 
 
-def check_and_reset_limits():
-    """Проверить и сбросить лимиты для всех моделей"""
-    db = load_database()
-    now = datetime.now()
-    updated = False
-    
-    for user_id, user_data in db["users"].items():
-        last_reset = datetime.fromisoformat(user_data["last_reset"])
-        hours_passed = (now - last_reset).total_seconds() / 3600
-        
-        if hours_passed >= 24:
-            # Сбрасываем токены для каждой модели
-            if "model_tokens" not in user_data:
-                user_data["model_tokens"] = {}
-            
-            for model_id in AVAILABLE_MODELS.keys():
-                user_data["model_tokens"][model_id] = get_model_limit(model_id)
-            
-            user_data["last_reset"] = now.isoformat()
-            updated = True
-    
-    if updated:
-        save_database(db)
+def set_merge_messages(user_id: int, enabled: bool):
+    """Включить/отключить объединение сообщений, пришедших во время ответа"""
+    user_store.set_merge_messages(user_id, enabled)
+
+
+def check_and_reset_limits() -> int:
+    """Сбросить лимиты всем пользователям, у которых подошёл срок (пачками по индексу)"""
+    limits = get_model_limits()
+    total = 0
+    while True:
+        count = user_store.reset_expired(limits, QUOTA_RESET_BATCH)
+        total += count
+        if count < QUOTA_RESET_BATCH:
+            return total
+
+
+async def run_quota_reset_scheduler():
+    """Фоновый массовый сброс лимитов по временным корзинам
+
+    Пользователи, у которых срок сброса попадает в одну корзину,
+    сбрасываются вместе на её границе. До этого момента сброс
+    выполняется лениво при обращении к балансу.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            now = time.time()
+            next_due = user_store.next_reset_due()
+            if next_due is not None and next_due <= now:
+                count = await loop.run_in_executor(None, check_and_reset_limits)
+                if count:
+                    logging.info(f"Сброшены лимиты у {count} пользователей")
+                continue
+
+            # Спим до границы корзины, в которую попадает ближайший сброс
+            wake_at = min(next_due or math.inf, now + QUOTA_RESET_BUCKET)
+            wake_at = math.ceil(wake_at / QUOTA_RESET_BUCKET) * QUOTA_RESET_BUCKET
+            await asyncio.sleep(max(wake_at - now, 1))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка сброса лимитов: {e}")
+            await asyncio.sleep(QUOTA_RESET_BUCKET)
 
 
 def use_request(user_id: int, model_id: str = None) -> bool:
     """Использовать запрос для конкретной модели"""
-    check_and_reset_limits()
-    db = load_database()
-    user_id_str = str(user_id)
-    
-    if user_id_str in db["users"]:
-        user_data = db["users"][user_id_str]
-        
-        # Если не указана модель, используем выбранную пользователем
-        if model_id is None:
-            model_id = user_data.get("selected_model", DEFAULT_MODEL)
-        
-        # Проверяем наличие токенов для модели
-        if "model_tokens" in user_data and model_id in user_data["model_tokens"]:
-            if user_data["model_tokens"][model_id] > 0:
-                user_data["model_tokens"][model_id] -= 1
-                user_data["total_requests"] += 1
-                save_database(db)
-                return True
-    return False
+    return user_store.consume_token(user_id, model_id)
 
 
 def add_requests(user_id: int, amount: int, model_id: str = None):
     """Добавить запросы для конкретной модели"""
-    db = load_database()
-    user_id_str = str(user_id)
-    if user_id_str in db["users"]:
-        user_data = db["users"][user_id_str]
-        
-        # Если не указана модель, добавляем ко всем моделям
-        if model_id is None:
-            if "model_tokens" not in user_data:
-                user_data["model_tokens"] = {}
-            for mid in AVAILABLE_MODELS.keys():
-                if mid not in user_data["model_tokens"]:
-                    user_data["model_tokens"][mid] = 0
-                user_data["model_tokens"][mid] += amount
-        else:
-            # Добавляем только к указанной модели
-            if "model_tokens" not in user_data:
-                user_data["model_tokens"] = {}
-            if model_id not in user_data["model_tokens"]:
-                user_data["model_tokens"][model_id] = 0
-            user_data["model_tokens"][model_id] += amount
-        
-        save_database(db)
+    # Если не указана модель, добавляем ко всем моделям
+    model_ids = list(AVAILABLE_MODELS.keys()) if model_id is None else [model_id]
+    user_store.add_tokens(user_id, amount, model_ids)
+    # Пополнение администратором = платный пользователь (приоритет в очереди к API)
+    user_store.set_plan(user_id, "paid")
 
 
 def get_user_model_balance(user_id: int, model_id: str) -> int:
     """Получить баланс токенов для конкретной модели"""
-    db = load_database()
-    user_id_str = str(user_id)
-    if user_id_str in db["users"]:
-        user_data = db["users"][user_id_str]
-        if "model_tokens" in user_data and model_id in user_data["model_tokens"]:
-            return user_data["model_tokens"][model_id]
-    return 0
+    return user_store.get_balance(user_id, model_id)
 
 
 def get_all_users():
     """Получить всех пользователей"""
-    db = load_database()
-    return db.get("users", {})
+    return user_store.all_users()
 
 
 def get_bot_stats():
     """Статистика бота"""
-    users = get_all_users()
-    
-    # Подсчитываем активных пользователей (у кого есть хотя бы 1 токен)
-    active_count = 0
-    for user_data in users.values():
-        model_tokens = user_data.get("model_tokens", {})
-        if any(tokens > 0 for tokens in model_tokens.values()):
-            active_count += 1
-    
-    return {
-        "total_users": len(users),
-        "total_requests": sum(u["total_requests"] for u in users.values()),
-        "active_users": active_count
-    }
+    return user_store.stats()
 
 
 # === РАБОТА С НАСТРОЙКАМИ БОТА ===
@@ -472,6 +1761,7 @@ def load_settings():
             return json.load(f)
     return {
         "bot_creation_enabled": True,
+        "streaming_enabled": True,
         "model_limits": {
             "gpt-5.2-chat": 30,
             "gpt-4o": 50,
@@ -484,17 +1774,40 @@ def load_settings():
 
 def save_settings(settings):
     """Сохранить настройки бота"""
+    global _settings_cache
     with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
         json.dump(settings, f, ensure_ascii=False, indent=2)
+    _settings_cache = (0.0, None)
+
+
+_settings_cache = (0.0, None)  # (время чтения, настройки)
+
+
+def cached_settings() -> dict:
+    """Настройки для чтения на каждом запросе: файл перечитывается раз в SETTINGS_CACHE_TTL
+
+    Результат общий для всех вызовов - не изменять (для изменения есть load_settings/save_settings).
+    """
+    global _settings_cache
+    loaded_at, settings = _settings_cache
+    if settings is None or time.monotonic() - loaded_at > SETTINGS_CACHE_TTL:
+        settings = load_settings()
+        _settings_cache = (time.monotonic(), settings)
+    return settings
 
 
 def get_model_limit(model: str):
     """Получить лимит для конкретной модели"""
-    settings = load_settings()
-    model_limits = settings.get("model_limits", {})
+    model_limits = cached_settings().get("model_limits", {})
     return model_limits.get(model, 30)
 
 
+def get_model_limits() -> dict:
+    """Получить лимиты всех моделей (одно чтение настроек)"""
+    model_limits = cached_settings().get("model_limits", {})
+    return {model_id: model_limits.get(model_id, 30) for model_id in AVAILABLE_MODELS.keys()}
+
+
 def set_model_limit(model: str, limit: int):
     """Установить лимит для конкретной модели"""
     settings = load_settings()
@@ -504,10 +1817,14 @@ def set_model_limit(model: str, limit: int):
     save_settings(settings)
 
 
+def is_streaming_enabled():
+    """Проверить, включен ли потоковый вывод ответов"""
+    return cached_settings().get("streaming_enabled", True)
+
+
 def is_bot_creation_enabled():
     """Проверить, включено ли создание ботов"""
-    settings = load_settings()
-    return settings.get("bot_creation_enabled", True)
+    return cached_settings().get("bot_creation_enabled", True)
 
 
 def set_bot_creation_enabled(enabled: bool):
@@ -518,27 +1835,9 @@ def set_bot_creation_enabled(enabled: bool):
 
 
 # === РАЗБИВКА ДЛИННЫХ СООБЩЕНИЙ ===
-def split_message(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
-    """Разбить длинное сообщение на части"""
-    if len(text) <= max_length:
-        return [text]
-
-    parts = []
-    while text:
-        if len(text) <= max_length:
-            parts.append(text)
-            break
-
-        split_pos = text.rfind('\n', 0, max_length)
-        if split_pos == -1:
-            split_pos = text.rfind(' ', 0, max_length)
-        if split_pos == -1:
-            split_pos = max_length
-
-        parts.append(text[:split_pos])
-        text = text[split_pos:].lstrip()
-
-    return parts
+def split_message(text: str, max_length: int = MAX_MESSAGE_LENGTH, is_html: bool = False) -> list:
+    """Разбить длинное сообщение на части (is_html - не разрывать теги и сущности)"""
+    return formatting.split_message(text, max_length, is_html)
 
 
 async def send_as_file(message: Message, text: str, caption: str = "📄 Ответ в файле"):
@@ -549,233 +1848,733 @@ async def send_as_file(message: Message, text: str, caption: str = "📄 Отв
         f.write(text)
     
     # Отправляем файл
-    file = FSInputFile(filename)
-    await message.answer_document(file, caption=caption)
-    
-    # Удаляем временный файл
-    os.remove(filename)
-
-
-def format_ai_response(text: str) -> str:
-    """Форматировать ответ AI для красивого отображения в Telegram"""
-    
-    # Сохраняем блоки кода
-    code_blocks = []
-    def save_code(match):
-        code_blocks.append(match.group(0))
-        return f"___CODE_BLOCK_{len(code_blocks)-1}___"
-    
-    # Временно заменяем блоки кода (```код```)
-    text = re.sub(r'```[\s\S]*?```', save_code, text)
-    
-    # Убираем ВСЕ математические обертки $$ и $ полностью
-    text = re.sub(r'\$\$([^\$]+)\$\$', r'\1', text)
-    text = re.sub(r'\$([^\$]+)\$', r'\1', text)
-    text = text.replace('$$', '').replace('$', '')
-    
-    # Обрабатываем \frac{числитель}{знаменатель} -> (числитель/знаменатель)
-    text = re.sub(r'\\frac\{([^}]+)\}\{([^}]+)\}', r'(\1/\2)', text)
-    
-    # Обрабатываем \sqrt{число} -> √(число)
-    text = re.sub(r'\\sqrt\{([^}]+)\}', r'√(\1)', text)
-    
-    # Обрабатываем степени: ^{число} или ^число -> используем Unicode
-    def convert_superscript(match):
-        num = match.group(1) if match.lastindex else match.group(0)[1]
-        superscripts = {'0':'⁰','1':'¹','2':'²','3':'³','4':'⁴','5':'⁵','6':'⁶','7':'⁷','8':'⁸','9':'⁹','+':'⁺','-':'⁻','=':'⁼','(':'⁽',')':'⁾'}
-        return ''.join(superscripts.get(c, c) for c in str(num))
-    
-    text = re.sub(r'\^\{([^}]+)\}', convert_superscript, text)
-    text = re.sub(r'\^([0-9])', convert_superscript, text)
-    
-    # Обрабатываем индексы: _{число} -> используем Unicode
-    def convert_subscript(match):
-        num = match.group(1)
-        subscripts = {'0':'₀','1':'₁','2':'₂','3':'₃','4':'₄','5':'₅','6':'₆','7':'₇','8':'₈','9':'₉','+':'₊','-':'₋','=':'₌','(':'₍',')':'₎'}
-        return ''.join(subscripts.get(c, c) for c in str(num))
-    
-    text = re.sub(r'_\{([^}]+)\}', convert_subscript, text)
-    
-    # Полная замена LaTeX команд на понятные символы
-    latex_replacements = {
-        # Операции (ВАЖНО: делаем первыми)
-        r'\\times': ' * ', r'\\cdot': ' * ', r'\\div': ' / ', r'\\pm': ' ± ',
-        r'\\ldots': '...', r'\\dots': '...',
-        
-        # Сравнения
-        r'\\leq': '≤', r'\\geq': '≥', r'\\neq': '≠', r'\\approx': '≈', r'\\equiv': '≡',
-        
-        # Стрелки
-        r'\\rightarrow': '→', r'\\leftarrow': '←', r'\\to': '→',
-        
-        # Греческие буквы
-        r'\\alpha': 'α', r'\\beta': 'β', r'\\gamma': 'γ', r'\\delta': 'δ',
-        r'\\theta': 'θ', r'\\pi': 'π', r'\\sigma': 'σ', r'\\omega': 'ω',
-        
-        # Тригонометрия
-        r'\\sin': 'sin', r'\\cos': 'cos', r'\\tan': 'tan', r'\\cot': 'cot',
-        
-        # Геометрия
-        r'\\angle': '∠', r'\\circ': '°', r'\\degree': '°', r'\\triangle': '△',
-        
-        # Скобки
-        r'\\left\(': '(', r'\\right\)': ')', r'\\left\[': '[', r'\\right\]': ']',
-        r'\\left\{': '{', r'\\right\}': '}',
-        r'\\left': '', r'\\right': '',
-        
-        # Текст
-        r'\\text\{([^}]+)\}': r'\1',
-    }
-    
-    # Применяем все замены
-    for pattern, replacement in latex_replacements.items():
-        text = re.sub(pattern, replacement, text)
-    
-    # Убираем ВСЕ оставшиеся LaTeX команды (начинающиеся с \)
-    text = re.sub(r'\\[a-zA-Z_]+', '', text)
-    
-    # Убираем оставшиеся обратные слеши
-    text = text.replace('\\', '')
-    
-    # Убираем фигурные скобки {} (оставшиеся после обработки)
-    text = text.replace('{', '').replace('}', '')
-    
-    # Форматируем заголовки
-    text = re.sub(r'^###\s*(.+)$', r'\n📌 \1\n', text, flags=re.MULTILINE)
-    text = re.sub(r'^##\s*(.+)$', r'\n📍 \1\n', text, flags=re.MULTILINE)
-    text = re.sub(r'^#\s*(.+)$', r'\n📢 \1\n', text, flags=re.MULTILINE)
-    
-    # Убираем жирный текст (двойные звездочки)
-    text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
-    
-    # Форматируем списки
-    text = re.sub(r'^[-*]\s+(.+)$', r'  • \1', text, flags=re.MULTILINE)
-    
-    # Возвращаем блоки кода
-    for i, code_block in enumerate(code_blocks):
-        text = text.replace(f"___CODE_BLOCK_{i}___", code_block)
-    
-    # Убираем лишние пустые строки
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    
-    return text.strip()
-
-
-def escape_markdown(text: str) -> str:
-    """Экранировать специальные символы Markdown для безопасной отправки"""
-    # Сохраняем блоки кода
-    code_blocks = []
-    def save_code(match):
-        code_blocks.append(match.group(0))
-        return f"___CODE_BLOCK_{len(code_blocks)-1}___"
-    
-    text = re.sub(r'```[\s\S]*?```', save_code, text)
-    text = re.sub(r'`[^`]+`', save_code, text)
-    
-    # Сохраняем жирный текст
-    bold_blocks = []
-    def save_bold(match):
-        bold_blocks.append(match.group(0))
-        return f"___BOLD_BLOCK_{len(bold_blocks)-1}___"
-    
-    text = re.sub(r'\*[^*]+\*', save_bold, text)
-    
-    # Экранируем оставшиеся специальные символы
-    special_chars = ['*', '_', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    for char in special_chars:
-        text = text.replace(char, f'\\{char}')
-    
-    # Возвращаем жирный текст
-    for i, bold_block in enumerate(bold_blocks):
-        text = text.replace(f"___BOLD_BLOCK_{i}___", bold_block)
-    
-    # Возвращаем блоки кода
-    for i, code_block in enumerate(code_blocks):
-        text = text.replace(f"___CODE_BLOCK_{i}___", code_block)
-    
-    return text
+    try:
+        file = FSInputFile(filename)
+        await message_dispatcher.send(message.chat.id, lambda: message.answer_document(file, caption=caption))
+    finally:
+        # Удаляем временный файл
+        os.remove(filename)
 
 
 async def send_long_message(message: Message, text: str, force_file: bool = False):
-    """Отправить длинное сообщение (разбивая на части или отправляя файлом)"""
+    """Отправить длинное сообщение (разбивая на части или отправляя файлом)
+
+    text - HTML из format_ai_response.
+    """
     # Если пользователь явно попросил файл или сообщение очень длинное
     if force_file or len(text) > 10000:
-        await send_as_file(message, text, "📄 Ответ слишком длинный, отправляю файлом" if not force_file else "📄 Ответ в файле")
+        await send_as_file(message, html_to_text(text), "📄 Ответ слишком длинный, отправляю файлом" if not force_file else "📄 Ответ в файле")
     else:
-        # Разбиваем на части как обычно
-        parts = split_message(text)
+        # Разбиваем на части как обычно, темп отправки задаёт message_dispatcher
+        parts = split_message(text, is_html=True)
+        chat_id = message.chat.id
 
-        for i, part in enumerate(parts):
-            if i > 0:
-                await asyncio.sleep(0.5)
+        for part in parts:
             try:
-                # Проверяем, есть ли блоки кода в тексте
-                if '```' in part:
-                    # Если есть блоки кода, используем HTML форматирование
-                    html_part = part
-                    
-                    # Функция для экранирования HTML внутри кода
-                    def escape_html_in_code(match):
-                        code_content = match.group(2) if match.lastindex >= 2 else match.group(1)
-                        # Экранируем HTML символы
-                        code_content = code_content.replace('&', '&amp;')
-                        code_content = code_content.replace('<', '&lt;')
-                        code_content = code_content.replace('>', '&gt;')
-                        
-                        if match.lastindex >= 2:
-                            # Блок с языком
-                            return f'<pre><code class="language-{match.group(1)}">{code_content}</code></pre>'
-                        else:
-                            # Блок без языка
-                            return f'<pre>{code_content}</pre>'
-                    
-                    # Обрабатываем блоки кода с языком
-                    html_part = re.sub(
-                        r'```(\w+)\n([\s\S]*?)```',
-                        escape_html_in_code,
-                        html_part
-                    )
-                    
-                    # Обрабатываем блоки кода без языка
-                    html_part = re.sub(
-                        r'```\n?([\s\S]*?)```',
-                        escape_html_in_code,
-                        html_part
-                    )
-                    
-                    # Обрабатываем инлайн код `код`
-                    def escape_inline_code(match):
-                        code = match.group(1)
-                        code = code.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-                        return f'<code>{code}</code>'
-                    
-                    html_part = re.sub(r'`([^`]+)`', escape_inline_code, html_part)
-                    
-                    await message.answer(html_part, parse_mode='HTML')
-                else:
-                    # Если нет блоков кода, отправляем как обычный текст
-                    await message.answer(part)
+                await message_dispatcher.send(chat_id, lambda: message.answer(part, parse_mode='HTML'))
             except Exception as e:
                 logging.error(f"Ошибка отправки сообщения с HTML: {e}")
                 try:
                     # Пробуем без форматирования
-                    await message.answer(part)
+                    await message_dispatcher.send(chat_id, lambda: message.answer(html_to_text(part)))
                 except Exception as e2:
                     logging.error(f"Ошибка отправки без форматирования: {e2}")
                     try:
                         # В крайнем случае отправляем как текстовый файл
-                        await send_as_file(message, part, "📄 Не удалось отправить сообщение, отправляю файлом")
+                        await send_as_file(message, html_to_text(part), "📄 Не удалось отправить сообщение, отправляю файлом")
                     except Exception as e3:
                         logging.error(f"Ошибка отправки файла: {e3}")
+
+
+# === ПОТОКОВЫЙ ВЫВОД ОТВЕТА ===
+class StreamingReply:
+    """Показывает ответ по мере генерации, редактируя сообщение-заглушку
+
+    Правки идут не чаще раза в STREAM_EDIT_INTERVAL секунд, чтобы не упираться
+    в лимиты Telegram на редактирование. Когда текст перерастает
+    MAX_MESSAGE_LENGTH, вывод продолжается в новом сообщении.
+    """
+
+    CURSOR = " ▌"
+
+    def __init__(self, placeholder: Message):
+        self.messages = [placeholder]
+        self.shown = [placeholder.text or ""]
+        self._chunks = []
+        self._next_edit_at = 0.0
+
+    async def _show(self, index: int, text: str, parse_mode: str = None):
+        """Показать текст в index-м сообщении ответа (отредактировать или отправить новое)"""
+        if index < len(self.messages):
+            if self.shown[index] == text:
+                return
+            try:
+                await self.messages[index].edit_text(text, parse_mode=parse_mode)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    raise
+            self.shown[index] = text
+        else:
+            self.messages.append(await self.messages[0].answer(text, parse_mode=parse_mode))
+            self.shown.append(text)
+
+    async def update(self, delta: str):
+        """Добавить очередной фрагмент ответа"""
+        self._chunks.append(delta)
+        if time.monotonic() < self._next_edit_at:
+            return
+
+        parts = split_message("".join(self._chunks))
+        try:
+            for i, part in enumerate(parts):
+                await self._show(i, part + self.CURSOR if i == len(parts) - 1 else part)
+        except TelegramRetryAfter as e:
+            # Промежуточный вывод не повторяем, только выдерживаем паузу
+            message_dispatcher.pause(self.messages[0].chat.id, e.retry_after)
+            self._next_edit_at = time.monotonic() + e.retry_after
+            return
+        except Exception as e:
+            logging.error(f"Ошибка потокового обновления ответа: {e}")
+        self._next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    async def finish(self, text: str):
+        """Показать итоговый ответ (HTML из format_ai_response)"""
+        parts = split_message(text, is_html=True) if text else ["…"]
+
+        chat_id = self.messages[0].chat.id
+        for i, part in enumerate(parts):
+            try:
+                await message_dispatcher.send(chat_id, lambda: self._show(i, part, 'HTML'))
+            except Exception as e:
+                logging.error(f"Ошибка отправки сообщения с HTML: {e}")
+                try:
+                    # Пробуем без форматирования
+                    await message_dispatcher.send(chat_id, lambda: self._show(i, html_to_text(part)))
                 except Exception as e2:
                     logging.error(f"Ошибка отправки без форматирования: {e2}")
-                    # В крайнем случае отправляем как текстовый файл
-                    await send_as_file(message, part, "📄 Не удалось отправить сообщение, отправляю файлом")
+
+        # Удаляем сообщения, которые остались от промежуточного вывода
+        for extra in self.messages[len(parts):]:
+            try:
+                await extra.delete()
+            except Exception as e:
+                logging.error(f"Ошибка удаления сообщения: {e}")
+
+
+# === ОЧЕРЕДЬ ЗАПРОСОВ ПОЛЬЗОВАТЕЛЕЙ ===
+class UserRequestGate:
+    """Последовательная обработка запросов одного пользователя
+
+    lock(user_id) не даёт запросам одного пользователя читать и дописывать
+    историю одновременно. Пока запрос выполняется (session), новые сообщения
+    можно отложить (defer) и затем отправить модели одним запросом.
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+        self._active = {}
+        self._deferred = {}
+
+    def lock(self, user_id: int) -> asyncio.Lock:
+        """Блокировка пользователя (живёт, пока её кто-то держит или ждёт)"""
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[user_id] = lock
+        return lock
+
+    def is_busy(self, user_id: int) -> bool:
+        return self._active.get(user_id, 0) > 0
+
+    @contextmanager
+    def session(self, user_id: int):
+        """Пользователь ждёт ответа, пока открыта сессия"""
+        self._active[user_id] = self._active.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            self._active[user_id] -= 1
+            if not self._active[user_id]:
+                del self._active[user_id]
+
+    def defer(self, user_id: int, message: Message):
+        self._deferred.setdefault(user_id, []).append(message)
+
+    def take_deferred(self, user_id: int) -> list:
+        return self._deferred.pop(user_id, [])
+
+
+user_gate = UserRequestGate()
+
+
+# === ОЧЕРЕДЬ ЗАПРОСОВ К API ===
+class TokenBucket:
+    """Ведро токенов: пополняется со скоростью rate в секунду, вмещает не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def configure(self, rate: float, capacity: float):
+        """Применить новые настройки, не теряя накопленные токены"""
+        self._refill()
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = min(self.tokens, capacity)
+
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def time_until_token(self) -> float:
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else math.inf
+
+
+class UpstreamScheduler:
+    """Очередь исходящих запросов к API: лимит запросов на модель и приоритеты
+
+    Для каждой модели своё ведро токенов (model_rate_limits в bot_settings.json).
+    Пока ведро пустое, запросы ждут в очереди по приоритету (админ, платные,
+    бесплатные), а не уходят в API за ошибкой 429. Если ждать дольше max_wait
+    или очередь переполнена, запрос отклоняется сразу.
+    """
+
+    CONFIG_TTL = 60  # Как часто перечитывать настройки, секунд
+
+    def __init__(self):
+        self._buckets = {}
+        self._queues = {}
+        self._dispatchers = {}
+        self._metrics = {}
+        self._seq = itertools.count()
+        self._config = {}
+        self._config_loaded_at = 0.0
+
+    def _get_config(self) -> dict:
+        if time.monotonic() - self._config_loaded_at > self.CONFIG_TTL:
+            settings = load_settings()
+            self._config = {
+                "limits": settings.get("model_rate_limits", {}),
+                "queue": {**DEFAULT_UPSTREAM_QUEUE, **settings.get("upstream_queue", {})}
+            }
+            self._config_loaded_at = time.monotonic()
+            for model, bucket in self._buckets.items():
+                bucket.configure(*self._bucket_params(model))
+        return self._config
+
+    def _bucket_params(self, model: str) -> tuple:
+        limit = {**DEFAULT_MODEL_RATE_LIMIT, **self._config["limits"].get(model, {})}
+        return limit["rpm"] / 60, limit["burst"]
+
+    def _get_bucket(self, model: str) -> TokenBucket:
+        self._get_config()
+        if model not in self._buckets:
+            self._buckets[model] = TokenBucket(*self._bucket_params(model))
+        return self._buckets[model]
+
+    def _record(self, model: str, waited: float = None, rejected: bool = False):
+        metrics = self._metrics.setdefault(model, {"sent": 0, "rejected": 0, "wait_total": 0.0, "wait_max": 0.0})
+        if rejected:
+            metrics["rejected"] += 1
+        else:
+            metrics["sent"] += 1
+            metrics["wait_total"] += waited
+            metrics["wait_max"] = max(metrics["wait_max"], waited)
+
+    async def acquire(self, model: str, priority: int) -> bool:
+        """Дождаться разрешения на запрос к модели (False - запрос отклонён)"""
+        bucket = self._get_bucket(model)
+        queue_config = self._config["queue"]
+        queue = self._queues.setdefault(model, [])
+
+        if not queue and bucket.try_take():
+            self._record(model, waited=0.0)
+            return True
+
+        if len(queue) >= queue_config["max_depth"]:
+            self._record(model, rejected=True)
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(queue, (priority, next(self._seq), future))
+        if model not in self._dispatchers:
+            self._dispatchers[model] = asyncio.create_task(self._dispatch(model))
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout=queue_config["max_wait"])
+        except asyncio.TimeoutError:
+            self._record(model, rejected=True)
+            return False
+        self._record(model, waited=time.monotonic() - started)
+        return True
+
+    async def _dispatch(self, model: str):
+        """Выдавать токены ожидающим по мере пополнения ведра"""
+        bucket = self._buckets[model]
+        queue = self._queues[model]
+        try:
+            while queue:
+                if queue[0][2].done():
+                    # Запрос уже отменён или отклонён по таймауту
+                    heapq.heappop(queue)
+                    continue
+                delay = bucket.time_until_token()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                _, _, future = heapq.heappop(queue)
+                if not future.done() and bucket.try_take():
+                    future.set_result(None)
+        finally:
+            del self._dispatchers[model]
+
+    def snapshot(self) -> dict:
+        """Метрики по моделям: глубина очереди, отправлено, отклонено, ожидание"""
+        result = {}
+        for model in sorted(set(self._metrics) | set(self._queues)):
+            metrics = self._metrics.get(model, {"sent": 0, "rejected": 0, "wait_total": 0.0, "wait_max": 0.0})
+            queue = self._queues.get(model, [])
+            result[model] = {
+                "depth": sum(1 for _, _, future in queue if not future.done()),
+                "sent": metrics["sent"],
+                "rejected": metrics["rejected"],
+                "wait_avg": metrics["wait_total"] / metrics["sent"] if metrics["sent"] else 0.0,
+                "wait_max": metrics["wait_max"]
+            }
+        return result
+
+
+upstream_scheduler = UpstreamScheduler()
+
+
+def get_user_priority(user_id: int, user_data: dict = None) -> int:
+    """Приоритет запросов пользователя в очереди к API"""
+    if user_id == ADMIN_ID:
+        return PRIORITY_ADMIN
+    if user_data is None:
+        user_data = find_user(user_id)
+    if user_data and user_data.get("plan") == "paid":
+        return PRIORITY_PAID
+    return PRIORITY_FREE
+
+
+# === ОТПРАВКА СООБЩЕНИЙ ===
+class MessageDispatcher:
+    """Отправка сообщений с учётом лимитов Telegram
+
+    Telegram пропускает около 30 сообщений в секунду на бота, около одного
+    в секунду в личный чат и 20 в минуту в группу. Сообщения одного чата
+    уходят по очереди, разные чаты - параллельно. На RetryAfter чат ставится
+    на паузу на указанное время, сетевые и серверные ошибки повторяются
+    с экспоненциальной задержкой; время ожидания размывается случайной добавкой.
+    """
+
+    def __init__(self, global_rate: float, private_rate: float, group_rate: float, max_retries: int):
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        self._paused_until = {}
+        self._locks = weakref.WeakValueDictionary()
+        self.retries = 0
+
+    def _lock(self, chat_id: int) -> asyncio.Lock:
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[chat_id] = lock
+        return lock
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= SEND_BUCKETS_LIMIT:
+                self._prune()
+            # Отрицательный chat_id - группа или канал
+            rate = self.private_rate if chat_id > 0 else self.group_rate
+            bucket = TokenBucket(rate, SEND_CHAT_BURST)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _prune(self):
+        """Забыть чаты, ведро которых уже полностью восстановилось"""
+        now = time.monotonic()
+        for chat_id, bucket in list(self._buckets.items()):
+            if bucket.time_until_token() == 0 and bucket.tokens >= bucket.capacity:
+                del self._buckets[chat_id]
+        for chat_id, until in list(self._paused_until.items()):
+            if until <= now:
+                del self._paused_until[chat_id]
+
+    def pause(self, chat_id: int, seconds: float):
+        """Не отправлять в чат ближайшие seconds секунд (после RetryAfter)"""
+        until = time.monotonic() + seconds + random.uniform(0, SEND_RETRY_JITTER)
+        self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0.0), until)
+
+    async def _wait_slot(self, chat_id: int):
+        bucket = self._bucket(chat_id)
+        while True:
+            wait = max(
+                self._paused_until.get(chat_id, 0.0) - time.monotonic(),
+                bucket.time_until_token(),
+                self.global_bucket.time_until_token()
+            )
+            if wait <= 0:
+                bucket.try_take()
+                self.global_bucket.try_take()
+                return
+            await asyncio.sleep(wait)
+
+    async def send(self, chat_id: int, action):
+        """Выполнить action() (отправку или правку сообщения) с учётом лимитов и повторами"""
+        async with self._lock(chat_id):
+            attempt = 0
+            while True:
+                await self._wait_slot(chat_id)
+                try:
+                    return await action()
+                except TelegramRetryAfter as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    logging.warning(f"Флуд-контроль в чате {chat_id}: ждём {e.retry_after} сек")
+                    self.pause(chat_id, e.retry_after)
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    logging.warning(f"Ошибка отправки в чат {chat_id}, повтор: {e}")
+                    await asyncio.sleep(2 ** attempt + random.uniform(0, SEND_RETRY_JITTER))
+                attempt += 1
+                self.retries += 1
+
+
+message_dispatcher = MessageDispatcher(
+    SEND_GLOBAL_RATE, SEND_PRIVATE_CHAT_RATE, SEND_GROUP_CHAT_RATE, SEND_MAX_RETRIES
+)
+
+
+# === КЭШ ОТВЕТОВ ===
+class ResponseCache:
+    """Кэш ответов модели по (модель, нормализованные сообщения)
+
+    Память - LRU с TTL, опционально второй уровень на диске (файл на ключ).
+    Используется только для функций, включённых в response_cache.features:
+    такие запросы отправляются без личной истории, поэтому ответ можно
+    безопасно отдавать другим пользователям.
+    """
+
+    PURGE_EVERY = 100  # Чистить просроченные файлы на диске раз в столько записей
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self._memory = OrderedDict()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def config(self) -> dict:
+        return {**DEFAULT_RESPONSE_CACHE, **cached_settings().get("response_cache", {})}
+
+    def enabled_for(self, feature: str) -> bool:
+        config = self.config
+        return bool(feature) and config["enabled"] and config["features"].get(feature, False)
+
+    @staticmethod
+    def make_key(model: str, messages: list) -> str:
+        """Ключ не зависит от регистра ролей и пробелов в концах строк
+
+        Переносы строк и отступы сохраняются: запросы с разной разметкой кода -
+        разные запросы.
+        """
+        normalized = [
+            {"role": m["role"].lower(),
+             "content": "\n".join(line.rstrip() for line in m["content"].splitlines()).strip("\n")}
+            for m in messages
+        ]
+        payload = json.dumps({"model": model, "messages": normalized}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str):
+        """Ответ из кэша или None"""
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry["expires_at"] > now:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry["data"]
+            del self._memory[key]
+
+        if self.config["disk"]:
+            entry = self._read_disk(key)
+            if entry is not None and entry["expires_at"] > now:
+                self._remember(key, entry)
+                self.hits += 1
+                return entry["data"]
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, data: dict):
+        """Сохранить ответ"""
+        config = self.config
+        entry = {"expires_at": time.time() + config["ttl"], "data": data}
+        self._remember(key, entry)
+
+        if config["disk"]:
+            self._write_disk(key, entry)
+            self._puts += 1
+            if self._puts % self.PURGE_EVERY == 0:
+                self.purge_disk()
+
+    def _remember(self, key: str, entry: dict):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        max_items = self.config["max_items"]
+        while len(self._memory) > max_items:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key: str):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if entry["expires_at"] <= time.time():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Удалил параллельный читатель или purge_disk
+            return None
+        return entry
+
+    def _write_disk(self, key: str, entry: dict):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f"Ошибка записи кэша ответов: {e}")
+
+    def purge_disk(self):
+        """Удалить просроченные записи с диска"""
+        now = time.time()
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        expired = json.load(f)["expires_at"] <= now
+                except (OSError, ValueError, KeyError):
+                    expired = True
+                if expired:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "items": len(self._memory)}
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_DIR)
+
+
+# === РЕЗЕРВНЫЕ МОДЕЛИ ===
+class ModelLatencyTracker:
+    """Время ответа моделей по последним успешным запросам"""
+
+    def __init__(self, window: int = 200):
+        self._samples = {}
+        self._window = window
+
+    def record(self, model: str, seconds: float):
+        self._samples.setdefault(model, deque(maxlen=self._window)).append(seconds)
+
+    def percentile(self, model: str, q: float, min_samples: int):
+        """q-й перцентиль или None, если замеров пока мало"""
+        samples = self._samples.get(model)
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+latency_tracker = ModelLatencyTracker()
+
+
+def get_fallback_chain(model: str) -> list:
+    """Выбранная модель и её резервные модели по порядку"""
+    fallbacks = cached_settings().get("model_fallbacks", {}).get(model, [])
+    chain = [model]
+    for candidate in fallbacks:
+        if candidate in AVAILABLE_MODELS and candidate not in chain:
+            chain.append(candidate)
+    return chain
+
+
+def is_retryable(result: dict) -> bool:
+    """Стоит ли повторить запрос на резервной модели (таймаут, 5xx, сеть, перегрузка)"""
+    if result.get("success"):
+        return False
+    status = result.get("status")
+    if status is not None:
+        return status >= 500
+    return bool(result.get("error"))
+
+
+async def timed_onlysq_request(messages: list, model: str, priority: int, cache_feature: str = None) -> dict:
+    """Запрос к модели с замером времени ответа"""
+    started = time.monotonic()
+    result = await make_onlysq_request(messages, model, priority, cache_feature)
+    if result.get("success") and not result.get("cached"):
+        latency_tracker.record(model, time.monotonic() - started)
+    result["model"] = model
+    return result
+
+
+async def hedged_onlysq_request(messages: list, primary: str, backup: str, priority: int,
+                                cache_feature: str = None) -> dict:
+    """Запрос с подстраховкой: если основная модель отвечает дольше своего p95,
+    параллельно спрашиваем резервную и берём первый успешный ответ"""
+    hedging = {**DEFAULT_HEDGING, **cached_settings().get("hedging", {})}
+    delay = latency_tracker.percentile(primary, 0.95, hedging["min_samples"]) or hedging["default_delay"]
+
+    primary_task = asyncio.create_task(timed_onlysq_request(messages, primary, priority, cache_feature))
+    done, _ = await asyncio.wait({primary_task}, timeout=delay)
+    if done:
+        result = primary_task.result()
+        if result.get("success") or not is_retryable(result):
+            return result
+        return await timed_onlysq_request(messages, backup, priority, cache_feature)
+
+    logging.info(f"Hedging: {primary} медленнее {delay:.1f} сек, дублирую запрос в {backup}")
+    pending = {primary_task, asyncio.create_task(timed_onlysq_request(messages, backup, priority, cache_feature))}
+    result = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                if result.get("success"):
+                    return result
+        return result
+    finally:
+        for task in pending:
+            task.cancel()
+        # Даём отменённым обработчикам завершиться до закрытия сессии бота
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def request_with_fallback(messages: list, model: str, priority: int, cache_feature: str = None) -> dict:
+    """Запрос к модели с переходом на резервные при таймауте или ошибке 5xx"""
+    chain = get_fallback_chain(model)
+    hedging_enabled = cached_settings().get("hedging", {}).get("enabled", DEFAULT_HEDGING["enabled"])
+
+    result = None
+    index = 0
+    while index < len(chain):
+        if hedging_enabled and index + 1 < len(chain):
+            result = await hedged_onlysq_request(messages, chain[index], chain[index + 1], priority, cache_feature)
+            index += 2
+        else:
+            result = await timed_onlysq_request(messages, chain[index], priority, cache_feature)
+            index += 1
+
+        if result.get("success") or not is_retryable(result):
+            return result
+        if index < len(chain):
+            logging.warning(f"Модель {result['model']} не ответила ({result.get('status') or result.get('error')}), "
+                            f"пробую {chain[index]}")
+    return result
+
+
+async def stream_with_fallback(messages: list, model: str, on_delta, priority: int) -> dict:
+    """Потоковый запрос с переходом на резервную модель, пока не пришёл первый фрагмент"""
+    started = False
+
+    async def track(delta: str):
+        nonlocal started
+        started = True
+        await on_delta(delta)
+
+    chain = get_fallback_chain(model)
+    result = None
+    for index, candidate in enumerate(chain):
+        result = await stream_onlysq_request(messages, candidate, track, priority)
+        result["model"] = candidate
+        if result.get("success") or started or not is_retryable(result):
+            return result
+        if index + 1 < len(chain):
+            logging.warning(f"Модель {candidate} не ответила ({result.get('status') or result.get('error')}), "
+                            f"пробую {chain[index + 1]}")
+    return result
 
 
 # === РАБОТА С AI ===
-def make_onlysq_request(messages: list, model: str) -> dict:
-    """Запрос к OnlySq API v2"""
+_http_session = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Общая сессия aiohttp с пулом keep-alive соединений"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300
+        )
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=API_TIMEOUT)
+        )
+    return _http_session
+
+
+async def close_http_session():
+    """Закрыть общую сессию aiohttp"""
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+
+async def make_onlysq_request(messages: list, model: str, priority: int = PRIORITY_FREE,
+                              cache_feature: str = None) -> dict:
+    """Запрос к OnlySq API v2 (cache_feature - функция бота, ответы которой можно кэшировать)"""
+    cache_key = None
+    if response_cache.enabled_for(cache_feature):
+        cache_key = response_cache.make_key(model, messages)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            logging.info(f"Response cache hit ({cache_feature}, {model})")
+            return {"success": True, "data": cached, "cached": True}
+    
+    # Ждём своей очереди, чтобы не отправлять запросы сверх лимита модели
+    if not await upstream_scheduler.acquire(model, priority):
+        return {"success": False, "error": "overloaded"}
+    
     try:
         headers = {
             "Authorization": f"Bearer {API_KEY}",
@@ -792,29 +2591,111 @@ def make_onlysq_request(messages: list, model: str) -> dict:
         
         logging.info(f"Request to {API_URL} with model {model}")
         
-        response = requests.post(API_URL, json=data, headers=headers, timeout=60)
+        async with get_http_session().post(API_URL, json=data, headers=headers) as response:
+            logging.info(f"Response status: {response.status}")
+            
+            if response.status == 200:
+                data = await response.json(content_type=None)
+                if cache_key is not None:
+                    response_cache.put(cache_key, data)
+                return {"success": True, "data": data}
+            else:
+                return {"success": False, "status": response.status, "text": await response.text()}
+            
+    except asyncio.TimeoutError:
+        return {"success": False, "error": "timeout"}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+
+async def stream_onlysq_request(messages: list, model: str, on_delta, priority: int = PRIORITY_FREE) -> dict:
+    """Потоковый запрос к OnlySq API v2: фрагменты ответа передаются в on_delta по мере генерации"""
+    if not await upstream_scheduler.acquire(model, priority):
+        return {"success": False, "error": "overloaded"}
+    
+    try:
+        headers = {
+            "Authorization": f"Bearer {API_KEY}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream"
+        }
         
-        logging.info(f"Response status: {response.status_code}")
+        data = {
+            "model": model,
+            "request": {
+                "messages": messages,
+                "stream": True
+            }
+        }
         
-        if response.status_code == 200:
-            return {"success": True, "data": response.json()}
-        else:
-            return {"success": False, "status": response.status_code, "text": response.text}
+        logging.info(f"Streaming request to {API_URL} with model {model}")
+        
+        # Ограничиваем паузу между фрагментами, а не всё время генерации
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=API_TIMEOUT, sock_read=API_TIMEOUT)
+        async with get_http_session().post(API_URL, json=data, headers=headers, timeout=timeout) as response:
+            logging.info(f"Response status: {response.status}")
+            
+            if response.status != 200:
+                return {"success": False, "status": response.status, "text": await response.text()}
+            
+            if response.content_type != "text/event-stream":
+                # API ответил без стрима - отдаём ответ целиком
+                result = await response.json(content_type=None)
+                await on_delta(result['choices'][0]['message']['content'])
+                return {"success": True, "data": result}
             
-    except requests.exceptions.Timeout:
+            chunks = []
+            async for raw_line in response.content:
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                
+                chunk = json.loads(payload)
+                choices = chunk.get("choices") or [{}]
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    chunks.append(delta)
+                    await on_delta(delta)
+            
+            content = "".join(chunks)
+            return {"success": True, "data": {"choices": [{"message": {"role": "assistant", "content": content}}]}}
+            
+    except asyncio.TimeoutError:
         return {"success": False, "error": "timeout"}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 
-async def get_ai_response(user_id: int, user_message: str) -> str:
-    """Получить ответ от AI с историей"""
+async def get_ai_response(user_id: int, user_message: str, on_delta=None, feature: str = None) -> str:
+    """Получить ответ от AI с историей (on_delta - получать ответ по частям)
+
+    Запросы одного пользователя выполняются строго по очереди: каждый следующий
+    читает историю уже с ответом на предыдущий. feature - функция бота
+    ("forward", "ask", "ocr"): если для неё включен кэш ответов, запрос
+    отправляется без истории и может быть взят из кэша.
+    """
+    async with user_gate.lock(user_id):
+        return await request_ai_response(user_id, user_message, on_delta, feature)
+
+
+async def request_ai_response(user_id: int, user_message: str, on_delta=None, feature: str = None) -> str:
+    """Запрос к AI с историей пользователя и сохранение ответа"""
     
     # Получаем выбранную модель пользователя
     user_data = get_user_data(user_id)
     selected_model = user_data.get("selected_model", DEFAULT_MODEL)
 
-    history = get_history(user_id, limit=20)
+    # Кэшируемые запросы не содержат личную историю
+    cache_feature = feature if response_cache.enabled_for(feature) else None
+    if cache_feature:
+        history = []
+    else:
+        memories = await recall_memories(user_id, user_message)
+        # Подсчёт токенов длинных текстов и чтение истории - в потоке
+        history = await asyncio.to_thread(context_builder.build, user_id, selected_model, user_message, memories)
     history.append({
         "role": "user",
         "content": user_message
@@ -825,17 +2706,25 @@ async def get_ai_response(user_id: int, user_message: str) -> str:
     logging.info(f"Model: {selected_model}")
 
     try:
-        # Выполняем запрос в executor
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, make_onlysq_request, history, selected_model)
+        priority = get_user_priority(user_id, user_data)
+        if on_delta is not None:
+            result = await stream_with_fallback(history, selected_model, on_delta, priority)
+        else:
+            result = await request_with_fallback(history, selected_model, priority, cache_feature)
         
         if result.get("success"):
             data = result["data"]
             ai_reply = data['choices'][0]['message']['content']
             
             # Сохраняем в историю
-            save_message(user_id, "user", user_message)
-            save_message(user_id, "assistant", ai_reply)
+            await save_message(user_id, "user", user_message)
+            await save_message(user_id, "assistant", ai_reply)
+
+            # Сообщаем, если ответила резервная модель
+            answered_by = result.get("model", selected_model)
+            if answered_by != selected_model:
+                model_name = AVAILABLE_MODELS.get(answered_by, {}).get("name", answered_by)
+                return f"{ai_reply}\n\n↪️ Ответ от резервной модели {model_name}"
 
             return ai_reply
         else:
@@ -843,6 +2732,12 @@ async def get_ai_response(user_id: int, user_message: str) -> str:
             if "timeout" in result.get("error", ""):
                 return "⏱️ Запрос превысил время ожидания. Попробуйте другую модель или повторите позже."
             
+            if result.get("error") == "overloaded":
+                return (
+                    "⏳ Сейчас к этой модели слишком много запросов\n\n"
+                    "Повторите через минуту или выберите другую модель через /model"
+                )
+            
             status = result.get("status", 0)
             error_text = result.get("text", result.get("error", "Unknown error"))
             
@@ -897,107 +2792,1116 @@ async def get_ai_response(user_id: int, user_message: str) -> str:
         return f"❌ Ошибка: {str(e)[:200]}"
 
 
-async def generate_bot_code(prompt: str, bot_token: str, user_id: int, selected_model: str) -> str:
-    """Сгенерировать код бота через AI"""
-    
-    # Получаем данные пользователя
-    username = f"user_{user_id}"
-    user_data = get_user_data(user_id, username)
-    
-    # Проверяем токены для выбранной модели
-    model_tokens = user_data.get("model_tokens", {})
-    current_balance = model_tokens.get(selected_model, 0)
-    
-    if current_balance <= 0:
-        return None
-    
-    # Используем токен для генерации
-    if not use_request(user_id, selected_model):
-        return None
+async def generate_bot_code(prompt: str, bot_token: str, user_id: int, selected_model: str) -> str:
+    """Сгенерировать код бота через AI"""
+    
+    # Получаем данные пользователя
+    username = f"user_{user_id}"
+    user_data = get_user_data(user_id, username)
+    
+    # Проверяем токены для выбранной модели
+    model_tokens = user_data.get("model_tokens", {})
+    current_balance = model_tokens.get(selected_model, 0)
+    
+    if current_balance <= 0:
+        return None
+    
+    # Используем токен для генерации
+    if not use_request(user_id, selected_model):
+        return None
+
+    system_prompt = f"""Создай код Telegram бота на Python с использованием aiogram 3.x.
+Требования:
+1. Бот должен соответствовать следующему описанию: {prompt}
+2. Используй aiogram 3.x
+3. Токен бота: {bot_token}
+4. Код должен быть полным и готовым к запуску
+5. Добавь базовый функционал и команду /start
+6. Используй async/await
+7. Верни ТОЛЬКО код Python без объяснений, без markdown разметки
+8. Код должен начинаться с import и заканчиваться asyncio.run(main())"""
+
+    try:
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"Создай бота: {prompt}"}
+        ]
+        result = await make_onlysq_request(messages, selected_model, get_user_priority(user_id, user_data))
+        
+        if result.get("success"):
+            data = result["data"]
+            code = data['choices'][0]['message']['content']
+
+            # Очистка кода от markdown
+            code = code.replace('```python', '').replace('```', '').strip()
+
+            return code
+        else:
+            return None
+    except Exception as e:
+        logging.error(f"Ошибка генерации кода: {e}")
+        return None
+
+
+# === РАСПОЗНАВАНИЕ ТЕКСТА ===
+@contextmanager
+def hidden_main_module():
+    """Запуск дочерних процессов без повторного выполнения bot.py
+
+    При spawn и forkserver дочерний процесс заново выполняет главный модуль
+    (aiogram, Bot, Dispatcher, хранилища, настройки). Воркерам OCR нужен только
+    ocr_worker, поэтому на время запуска процессов путь главного модуля скрыт.
+    """
+    main_module = sys.modules["__main__"]
+    path = main_module.__dict__.pop("__file__", None)
+    spec = getattr(main_module, "__spec__", None)
+    main_module.__spec__ = None
+    try:
+        yield
+    finally:
+        main_module.__spec__ = spec
+        if path is not None:
+            main_module.__file__ = path
+
+
+class OCRPool:
+    """Пул процессов для OCR с ограниченной очередью и таймаутом на задачу
+
+    Декодирование, подготовка изображения и Tesseract выполняются в отдельных
+    процессах, поэтому большое фото не блокирует обработку остальных сообщений.
+    """
+
+    def __init__(self, workers: int, max_pending: int, timeout: float):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self._executor = None
+
+    @property
+    def executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._executor is None:
+            # Не fork: не копируем в воркеры состояние бота (цикл событий, соединения).
+            # forkserver один раз импортирует ocr_worker (PIL, pytesseract), воркеры ответвляются от него
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["ocr_worker"])
+            else:
+                context = multiprocessing.get_context("spawn")
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._executor
+
+    async def recognize(self, image_bytes: bytes, known: dict = None) -> dict:
+        """Распознать текст; {"success": False, "error": "busy"} если очередь заполнена
+
+        known - отпечатки уже распознанных изображений (см. ocr_worker.recognize)
+        """
+        # Задача может дождаться, пока освободятся воркеры перед ней
+        deadline = self.timeout * (1 + self.pending // self.workers) + 5
+        return await self._run(deadline, ocr_worker.recognize, image_bytes, self.timeout, known)
+
+    async def _run(self, deadline: float, func, *args) -> dict:
+        if self.pending >= self.max_pending:
+            return {"success": False, "error": "busy"}
+
+        self.pending += 1
+        executor = self.executor
+        future = None
+        try:
+            # Пул запускает процессы по мере надобности - внутри submit
+            with hidden_main_module():
+                future = executor.submit(func, *args)
+            return await asyncio.wait_for(asyncio.wrap_future(future), deadline)
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "timeout"}
+        except concurrent.futures.process.BrokenProcessPool:
+            # Воркер упал (например, из-за нехватки памяти) - пересоздаём пул
+            # Закрываем сломанный пул (его поток управления и уцелевшие воркеры), если
+            # его ещё не заменил другой запрос
+            if self._executor is executor:
+                logging.error("OCR пул процессов аварийно завершился, пересоздаю")
+                self.shutdown()
+            return {"success": False, "error": "Процесс распознавания аварийно завершился"}
+        finally:
+            # Снимаем задачу, если она ещё ждёт в очереди (таймаут или отмена)
+            if future is not None:
+                future.cancel()
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class OCRCache:
+    """Кэш распознанного текста
+
+    Точное совпадение - по file_unique_id Telegram (повтор или пересылка того же
+    файла не требует даже скачивания), общее для всех пользователей. Похожие
+    изображения (пересжатые, с другим размером) ищутся только среди изображений
+    того же пользователя: скриншоты текста с одинаковой вёрсткой дают почти
+    одинаковый dHash, и чужой текст не должен попасть в ответ. Сравнение делает
+    воркер OCR по отпечаткам из known(), не декодируя изображение второй раз.
+    Вытеснение - LRU по числу записей и объёму текста.
+    """
+
+    def __init__(self, max_items: int, max_bytes: int):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # file_unique_id -> {"text", "user_id", "fingerprint", "size"}
+        self._users = {}  # user_id -> {file_unique_id} изображений с отпечатком
+        self.total_bytes = 0
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def get(self, file_unique_id: str):
+        """Текст по file_unique_id или None"""
+        entry = self._entries.get(file_unique_id)
+        if entry is None:
+            return None
+        self._entries.move_to_end(file_unique_id)
+        self.hits += 1
+        return entry["text"]
+
+    def known(self, user_id: int) -> dict:
+        """Отпечатки изображений пользователя: {file_unique_id: отпечаток}"""
+        return {key: self._entries[key]["fingerprint"] for key in self._users.get(user_id, ())}
+
+    def take_similar(self, similar: str, file_unique_id: str, user_id: int, fingerprint: dict):
+        """Текст похожего изображения, найденного воркером, или None (уже вытеснен)
+
+        Новое изображение сохраняется с тем же текстом.
+        """
+        entry = self._entries.get(similar)
+        if entry is None:
+            return None
+        self._entries.move_to_end(similar)
+        self.similar_hits += 1
+        self._store(file_unique_id, entry["text"], user_id, fingerprint)
+        return entry["text"]
+
+    def put(self, file_unique_id: str, text: str, user_id: int, fingerprint: dict = None):
+        """Сохранить распознанный текст (fingerprint - из результата ocr_pool.recognize)"""
+        self.misses += 1
+        self._store(file_unique_id, text, user_id, fingerprint)
+
+    def _store(self, file_unique_id: str, text: str, user_id: int, fingerprint: dict):
+        self._remove(file_unique_id)
+        size = len(text.encode('utf-8')) + len(file_unique_id)
+        self._entries[file_unique_id] = {"text": text, "user_id": user_id, "fingerprint": fingerprint, "size": size}
+        self.total_bytes += size
+        if fingerprint is not None:
+            self._users.setdefault(user_id, set()).add(file_unique_id)
+
+        while self._entries and (len(self._entries) > self.max_items or self.total_bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, file_unique_id: str):
+        entry = self._entries.pop(file_unique_id, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry["size"]
+        keys = self._users.get(entry["user_id"])
+        if keys is not None:
+            keys.discard(file_unique_id)
+            if not keys:
+                del self._users[entry["user_id"]]
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits, "similar_hits": self.similar_hits, "misses": self.misses,
+            "items": len(self._entries), "bytes": self.total_bytes
+        }
+
+
+ocr_pool = OCRPool(OCR_WORKERS, OCR_MAX_PENDING, OCR_TIMEOUT)
+ocr_cache = OCRCache(OCR_CACHE_MAX_ITEMS, OCR_CACHE_MAX_BYTES)
+
+
+# === УПРАВЛЕНИЕ БОТАМИ ===
+def get_bot_file(user_id: int, bot_id: str) -> str:
+    return os.path.join(BOTS_DIR, f"bot_{user_id}_{bot_id}.py")
+
+
+def get_bot_log_file(user_id: int, bot_id: str) -> str:
+    return os.path.join(BOTS_LOG_DIR, f"bot_{user_id}_{bot_id}.log")
+
+
+def get_env_python(env_dir: str) -> str:
+    """Интерпретатор окружения venv"""
+    if os.name == 'nt':
+        return os.path.abspath(os.path.join(env_dir, "Scripts", "python.exe"))
+    return os.path.abspath(os.path.join(env_dir, "bin", "python"))
+
+
+def get_user_bot_python() -> str:
+    """Интерпретатор процессов ботов и хостов: окружение с их пакетами, пока его нет - главного бота"""
+    python = get_env_python(USER_BOT_ENV_DIR)
+    return python if os.path.exists(python) else sys.executable
+
+
+def limit_bot_resources(pid: int, memory_mb: int, cpu_seconds: int, max_files: int):
+    """Ограничить ресурсы запущенного процесса бота (только Linux)
+
+    Лимиты выставляются снаружи через prlimit, а не в preexec_fn: главный бот
+    многопоточный, и код между fork и exec может зависнуть на чужой блокировке.
+    Лимиты ставятся сразу после запуска, пока процесс ещё загружает интерпретатор.
+    """
+    import resource
+    if not hasattr(resource, "prlimit"):
+        logging.warning(f"prlimit недоступен на этой платформе, процесс {pid} запущен без лимитов")
+        return
+    memory = memory_mb * 1024 * 1024
+    resource.prlimit(pid, resource.RLIMIT_AS, (memory, memory))
+    if cpu_seconds:
+        resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 10))
+    resource.prlimit(pid, resource.RLIMIT_NOFILE, (max_files, max_files))
+    # Лог пишет сам бот, поэтому лимит размера файла - с запасом над ротацией
+    file_size = USER_BOT_LOG_MAX_BYTES * 4
+    resource.prlimit(pid, resource.RLIMIT_FSIZE, (file_size, file_size))
+    os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, 0) + USER_BOT_NICE)
+
+
+class BotProcess:
+    """Процесс под надзором: пользовательский бот или хост ботов"""
+
+    def __init__(self, name: str, user_id: int, pid: int, log_path: str, popen: subprocess.Popen = None):
+        self.name = name
+        self.user_id = user_id  # None - хост ботов
+        self.pid = pid
+        self.log_path = log_path
+        self.popen = popen  # None - процесс принят от прошлого запуска главного бота
+        self.started_at = time.monotonic()
+        self.stopping_since = None
+
+    def is_alive(self) -> bool:
+        if self.popen is not None:
+            return self.popen.poll() is None
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def exit_code(self):
+        return self.popen.returncode if self.popen is not None else None
+
+    def signal(self, sig):
+        """Послать сигнал всей группе процессов бота"""
+        try:
+            if os.name == 'nt':  # Windows
+                self.popen.terminate() if sig == signal.SIGTERM else self.popen.kill()
+            else:  # Linux/Unix
+                os.killpg(self.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+class BotSupervisor:
+    """Запуск пользовательских ботов и надзор за ними
+
+    Желаемое состояние - bots.is_running в базе, фактическое - self.processes.
+    Раз в SUPERVISOR_INTERVAL секунд они сверяются: упавший процесс перезапускается
+    с растущей задержкой (бот после USER_BOT_MAX_CRASHES подряд - останавливается),
+    лишний процесс завершается. Вывод пишется в файлы с ротацией, на Linux процессы
+    ограничены по памяти, CPU и файлам. При запуске процессы из прошлого запуска
+    (pid в базе) принимаются под надзор, а не запускаются заново.
+
+    В режиме USER_BOT_RUNTIME=host под надзором не боты, а USER_BOT_HOSTS общих
+    процессов user_bot_host.py: боты в них запускаются и останавливаются по той же
+    отметке is_running, которую хосты сами читают из базы.
+
+    Из нескольких копий бота надзор ведёт одна - владелец аренды "supervisor"
+    в базе. Остальные только меняют is_running; если ведущая копия перестанет
+    продлевать аренду, её процессы примет под надзор следующая.
+    """
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+        self.processes = {}
+        self._crashes = {}  # имя процесса -> подряд неудачных запусков
+        self._restart_at = {}  # имя процесса -> когда можно перезапустить
+        self.restarts = 0
+
+    def _targets(self) -> dict:
+        """Процессы, которые должны существовать: имя -> описание"""
+        targets = {}
+        if USER_BOT_RUNTIME == "host":
+            for worker in range(USER_BOT_HOSTS):
+                name = f"host_{worker}"
+                pid = user_store.get_meta(f"{name}_pid")
+                targets[name] = {
+                    "user_id": None,
+                    "is_running": True,
+                    "pid": int(pid) if pid else None,
+                    "command": [
+                        get_user_bot_python(), USER_BOT_HOST_SCRIPT, "--worker", str(worker),
+                        "--workers", str(USER_BOT_HOSTS), "--db", SQLITE_FILE, "--bots-dir", BOTS_DIR
+                    ],
+                    "log_path": os.path.join(BOTS_LOG_DIR, f"{name}.log"),
+                    "limits": (USER_BOT_HOST_MEMORY_MB, None, USER_BOT_HOST_MAX_FILES),
+                }
+            return targets
+
+        for row in user_store.supervised_bots():
+            targets[row["bot_id"]] = {
+                "user_id": row["user_id"],
+                "is_running": row["is_running"],
+                "pid": row["pid"],
+                "command": [get_user_bot_python(), get_bot_file(row["user_id"], row["bot_id"])],
+                "log_path": get_bot_log_file(row["user_id"], row["bot_id"]),
+                "limits": (USER_BOT_MEMORY_MB, USER_BOT_CPU_SECONDS, USER_BOT_MAX_FILES),
+            }
+        return targets
+
+    def _save_pid(self, name: str, user_id: int, pid):
+        if user_id is None:
+            user_store.set_meta(f"{name}_pid", str(pid) if pid else "")
+        else:
+            user_store.update_bot(user_id, name, pid=pid)
+
+    def _spawn(self, name: str, target: dict):
+        """Запустить процесс"""
+        command = target["command"]
+        if not os.path.exists(command[1]):
+            logging.error(f"Файл {command[1]} не найден")
+            return None
+
+        os.makedirs(BOTS_LOG_DIR, exist_ok=True)
+        with open(target["log_path"], 'ab') as log:
+            log.write(f"\n=== Запуск {datetime.now().isoformat()} ===\n".encode('utf-8'))
+            log.flush()
+            # Код пользователей не должен видеть токен и ключи главного бота
+            env = {key: value for key, value in os.environ.items() if key not in USER_BOT_SECRET_ENV}
+            if os.name == 'nt':  # Windows
+                popen = subprocess.Popen(
+                    command, env=env,
+                    stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                    creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
+                )
+            else:  # Linux/Unix
+                popen = subprocess.Popen(
+                    command, env=env,
+                    stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                    start_new_session=True
+                )
+                try:
+                    limit_bot_resources(popen.pid, *target["limits"])
+                except OSError as e:
+                    # Без лимитов процесс не оставляем
+                    logging.error(f"Не удалось ограничить ресурсы процесса {name}: {e}")
+                    popen.kill()
+                    popen.wait()
+                    return None
+
+        process = BotProcess(name, target["user_id"], popen.pid, target["log_path"], popen)
+        self.processes[name] = process
+        self._save_pid(name, target["user_id"], popen.pid)
+        logging.info(f"Процесс {name} запущен, pid {popen.pid}")
+        return process
+
+    def _adopt(self, name: str, target: dict):
+        """Принять под надзор процесс, оставшийся от прошлого запуска"""
+        pid = target["pid"]
+        if not pid or os.name == 'nt':
+            return None
+        process = BotProcess(name, target["user_id"], pid, target["log_path"])
+        if not process.is_alive():
+            return None
+        # pid мог достаться другому процессу - сверяем командную строку. Без /proc
+        # (не Linux) проверить нечем: чужую группу процессов убивать нельзя, запускаем заново
+        try:
+            with open(f"/proc/{pid}/cmdline", 'rb') as f:
+                if os.path.basename(target["command"][1]).encode() not in f.read():
+                    return None
+        except OSError:
+            logging.warning(f"Процесс {name} (pid {pid}) не проверить, под надзор не принят")
+            return None
+        self.processes[name] = process
+        logging.info(f"Процесс {name} (pid {pid}) принят под надзор")
+        return process
+
+    def start(self, bot_id: str, user_id: int) -> bool:
+        """Запустить бота и отметить, что он должен работать"""
+        if not os.path.exists(get_bot_file(user_id, bot_id)):
+            return False
+        self._crashes.pop(bot_id, None)
+        self._restart_at.pop(bot_id, None)
+        if self.is_leader and USER_BOT_RUNTIME != "host":
+            process = self.processes.get(bot_id)
+            if process is not None and process.stopping_since and process.is_alive():
+                # Остановка ещё не завершилась - не оставляем две копии бота
+                process.signal(getattr(signal, "SIGKILL", signal.SIGTERM))
+            if process is None or not process.is_alive() or process.stopping_since:
+                target = self._targets().get(bot_id)
+                try:
+                    if target is None or self._spawn(bot_id, target) is None:
+                        return False
+                except Exception as e:
+                    logging.error(f"Ошибка запуска бота: {e}")
+                    return False
+        # Если надзор ведёт другая копия бота, она запустит бота при следующей сверке,
+        # в режиме host - хост, которому достался бот
+        user_store.update_bot(user_id, bot_id, is_running=1)
+        return True
+
+    def stop(self, bot_id: str, user_id: int) -> bool:
+        """Остановить бота и отметить, что он не должен работать"""
+        user_store.update_bot(user_id, bot_id, is_running=0)
+        process = self.processes.get(bot_id)
+        if process is not None and process.stopping_since is None:
+            process.signal(signal.SIGTERM)
+            process.stopping_since = time.monotonic()
+        return True
+
+    async def reconcile(self):
+        """Сверить процессы с базой"""
+        now = time.monotonic()
+        targets = self._targets()
+
+        for name, target in targets.items():
+            process = self.processes.get(name)
+            if not target["is_running"]:
+                continue
+            if process is None:
+                process = self._adopt(name, target)
+            if process is not None and process.is_alive():
+                if now - process.started_at > USER_BOT_STABLE_AFTER:
+                    self._crashes.pop(name, None)
+                continue
+            if process is not None and not await self._on_crash(process):
+                continue
+            restart_at = self._restart_at.get(name)
+            if restart_at is not None and now < restart_at:
+                continue
+            if self._spawn(name, target) is not None and restart_at is not None:
+                self._restart_at.pop(name, None)
+                self.restarts += 1
+
+        # Остановленные, удалённые и завершившиеся процессы
+        for name, process in list(self.processes.items()):
+            target = targets.get(name)
+            if target is not None and target["is_running"]:
+                continue
+            if not process.is_alive():
+                del self.processes[name]
+                if target is not None:
+                    self._save_pid(name, process.user_id, None)
+                continue
+            if process.stopping_since is None:
+                process.signal(signal.SIGTERM)
+                process.stopping_since = now
+            elif now - process.stopping_since > USER_BOT_STOP_TIMEOUT:
+                logging.warning(f"Процесс {name} не завершился за {USER_BOT_STOP_TIMEOUT} сек, убиваю")
+                process.signal(getattr(signal, "SIGKILL", signal.SIGTERM))
+
+        self._rotate_logs()
+
+    async def _on_crash(self, process: BotProcess) -> bool:
+        """Процесс завершился сам: запланировать перезапуск (True) или сдаться (False)"""
+        name = process.name
+        del self.processes[name]
+        self._save_pid(name, process.user_id, None)
+        crashes = self._crashes.get(name, 0) + 1
+        self._crashes[name] = crashes
+        logging.warning(f"Процесс {name} завершился (код {process.exit_code()}), падение {crashes} подряд")
+
+        # Хост ботов перезапускаем всегда: от него зависят чужие боты
+        if crashes >= USER_BOT_MAX_CRASHES and process.user_id is not None:
+            self._crashes.pop(name, None)
+            user_store.update_bot(process.user_id, name, is_running=0)
+            logging.error(f"Бот {name} остановлен после {crashes} падений подряд")
+            await self.notify_stopped(process.user_id, name, crashes)
+            return False
+
+        delay = min(USER_BOT_RESTART_MAX_DELAY, USER_BOT_RESTART_DELAY * 2 ** (crashes - 1))
+        self._restart_at[name] = time.monotonic() + delay
+        return True
+
+    @staticmethod
+    async def notify_stopped(user_id: int, bot_id: str, crashes: int):
+        """Сообщить владельцу, что бот остановлен после падений"""
+        try:
+            await bot.send_message(
+                user_id,
+                f"⚠️ Бот {bot_id} остановлен: он {crashes} раз подряд завершился с ошибкой.\n"
+                f"Исправьте его через ✏️ Редактировать и запустите снова."
+            )
+        except Exception as e:
+            logging.error(f"Не удалось уведомить пользователя {user_id}: {e}")
+
+    async def _send_host_notifications(self):
+        """Уведомления о ботах, которые остановили хосты (у хостов нет токена главного бота)"""
+        loop = asyncio.get_running_loop()
+        for row in await loop.run_in_executor(None, user_store.take_bot_notifications):
+            await self.notify_stopped(row["user_id"], row["bot_id"], row["crashes"])
+
+    def _rotate_logs(self):
+        """Ротация логов (copytruncate: процесс продолжает писать в тот же файл)"""
+        for process in self.processes.values():
+            path = process.log_path
+            try:
+                if os.path.getsize(path) <= USER_BOT_LOG_MAX_BYTES:
+                    continue
+                for i in range(USER_BOT_LOG_BACKUPS - 1, 0, -1):
+                    if os.path.exists(f"{path}.{i}"):
+                        os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+                shutil.copyfile(path, f"{path}.1")
+                os.truncate(path, 0)
+            except OSError as e:
+                logging.error(f"Ошибка ротации лога {path}: {e}")
+
+    async def run(self):
+        """Фоновый надзор (только в копии бота, владеющей арендой)"""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    leader = await loop.run_in_executor(
+                        None, user_store.acquire_lease, "supervisor", self.owner, SUPERVISOR_LEASE_TTL
+                    )
+                    if leader != self.is_leader:
+                        logging.info(f"Надзор за ботами {'получен' if leader else 'передан другой копии бота'}")
+                        self.is_leader = leader
+                        if not leader:
+                            # Процессы остаются работать - их примет новая ведущая копия
+                            self.processes.clear()
+                    if leader:
+                        await self.reconcile()
+                        if USER_BOT_RUNTIME == "host":
+                            await self._send_host_notifications()
+                except Exception as e:
+                    logging.error(f"Ошибка надзора за ботами: {e}")
+                await asyncio.sleep(SUPERVISOR_INTERVAL)
+        finally:
+            if self.is_leader:
+                self.is_leader = False
+                user_store.release_lease("supervisor", self.owner)
+
+    def stats(self) -> dict:
+        alive = sum(1 for process in self.processes.values() if process.is_alive())
+        return {"processes": len(self.processes), "alive": alive, "restarts": self.restarts, "leader": self.is_leader}
+
+
+bot_supervisor = BotSupervisor()
+
+
+def start_bot_process(bot_id: str, user_id: int):
+    """Запустить процесс бота"""
+    return bot_supervisor.start(bot_id, user_id)
+
+
+def stop_bot_process(bot_id: str, user_id: int):
+    """Остановить процесс бота"""
+    return bot_supervisor.stop(bot_id, user_id)
+
+
+# === СОЗДАНИЕ БОТОВ ===
+def requirement_name(requirement: str) -> str:
+    """Имя пакета из строки требования: aiogram>=3.0 -> aiogram"""
+    for separator in "<>=!~[; ":
+        requirement = requirement.split(separator, 1)[0]
+    return requirement.strip()
+
+
+# Модули, которые можно ставить для пользовательских ботов: модуль импорта -> пакет PyPI.
+# Остальные сторонние импорты считаются неизвестными и не устанавливаются.
+BOT_PACKAGES = {
+    "aiogram": "aiogram",
+    "aiohttp": "aiohttp",
+    "aiofiles": "aiofiles",
+    "aiosqlite": "aiosqlite",
+    "apscheduler": "APScheduler",
+    "bs4": "beautifulsoup4",
+    "dateutil": "python-dateutil",
+    "dotenv": "python-dotenv",
+    "emoji": "emoji",
+    "feedparser": "feedparser",
+    "httpx": "httpx",
+    "lxml": "lxml",
+    "magic_filter": "magic-filter",
+    "matplotlib": "matplotlib",
+    "numpy": "numpy",
+    "pandas": "pandas",
+    "PIL": "pillow",
+    "pydantic": "pydantic",
+    "pytz": "pytz",
+    "qrcode": "qrcode",
+    "requests": "requests",
+    "yaml": "PyYAML",
+}
+STDLIB_MODULES = set(getattr(sys, "stdlib_module_names", ())) | set(sys.builtin_module_names)
+
+
+class DependencyAnalyzer:
+    """Зависимости кода бота по его импортам (разбор через ast)
+
+    Импорты делятся на стандартную библиотеку, известные пакеты PyPI
+    и неизвестные модули. Импорты внутри try/except ImportError считаются
+    необязательными. Результат кэшируется по хэшу кода.
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()  # analyze вызывается из потоков
+
+    def analyze(self, code: str) -> dict:
+        key = hashlib.sha256(code.encode('utf-8')).hexdigest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        result = self._analyze(code)
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.max_items:
+                self._cache.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _imports(tree: ast.AST):
+        """Пары (модуль верхнего уровня, необязательный ли импорт)"""
+        optional = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Try) and any(
+                isinstance(handler.type, ast.Name) and handler.type.id in ("ImportError", "ModuleNotFoundError")
+                for handler in node.handlers
+            ):
+                optional.update(id(child) for statement in node.body for child in ast.walk(statement))
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    yield alias.name.split(".")[0], id(node) in optional
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                yield node.module.split(".")[0], id(node) in optional
+
+    def _analyze(self, code: str) -> dict:
+        try:
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            return {"success": False, "error": f"синтаксическая ошибка в строке {e.lineno}: {e.msg}"}
+
+        modules = {}
+        for module, optional in self._imports(tree):
+            modules[module] = modules.get(module, True) and optional
+
+        stdlib, packages, unknown = [], [], []
+        for module in sorted(modules, key=str.lower):
+            if module in STDLIB_MODULES:
+                stdlib.append(module)
+            elif module in BOT_PACKAGES:
+                packages.append(BOT_PACKAGES[module])
+            elif not modules[module]:
+                unknown.append(module)
+        return {
+            "success": True,
+            "modules": sorted(modules, key=str.lower),
+            "stdlib": stdlib,
+            "packages": packages,
+            "unknown": unknown,
+        }
+
+
+dependency_analyzer = DependencyAnalyzer(DEPENDENCY_CACHE_SIZE)
+
+
+class DependencyInstaller:
+    """Установка пакетов для пользовательских ботов
+
+    Пакеты ставятся не в интерпретатор главного бота, а в отдельное окружение
+    (venv с доступом к его пакетам): пакет бота может потребовать другую версию
+    aiogram, pydantic или numpy, и она не должна подменить их у работающего
+    главного бота. Процессы ботов и хосты запускаются интерпретатором этого окружения.
+
+    pip запускается отдельным процессом, не блокируя цикл событий. Уже
+    установленные пакеты пропускаются, а одновременные запросы одного
+    пакета ждут одну общую установку. Пакеты ставятся из локального
+    каталога колёс (WHEELHOUSE_DIR): в сеть pip обращается только за
+    пакетом, которого там ещё нет, и сохраняет его колесо для следующих ботов.
+    """
+
+    def __init__(self, timeout: float, wheelhouse: str, env_dir: str):
+        self.timeout = timeout
+        self.wheelhouse = wheelhouse
+        self.env_dir = env_dir
+        self.python = get_env_python(env_dir)
+        self.installed = set()
+        self._installing = {}  # требование -> задача установки
+        self._env_path = None  # sys.path интерпретатора окружения
+        self._env_lock = asyncio.Lock()
+
+    async def prepare(self) -> dict:
+        """Создать окружение (один раз) и узнать, где оно ищет пакеты"""
+        async with self._env_lock:
+            if self._env_path is not None:
+                return {"success": True}
+            if not os.path.exists(self.python):
+                logging.info(f"Создаю окружение пакетов пользовательских ботов в {self.env_dir}")
+                result = await self._run(sys.executable, "-m", "venv", "--system-site-packages", self.env_dir)
+                if not result["success"]:
+                    return result
+            result = await self._run(self.python, "-c", "import json, sys; print(json.dumps(sys.path))")
+            if result["success"]:
+                self._env_path = [entry for entry in json.loads(result["output"]) if entry]
+            return result
+
+    def is_installed(self, requirement: str) -> bool:
+        if requirement in self.installed:
+            return True
+        distributions = importlib.metadata.distributions(name=requirement_name(requirement), path=self._env_path)
+        if next(iter(distributions), None) is None:
+            return False
+        self.installed.add(requirement)
+        return True
+
+    async def ensure(self, requirements: list) -> dict:
+        """Установить недостающие пакеты"""
+        result = await self.prepare()
+        if not result["success"]:
+            return result
+        missing = [requirement for requirement in dict.fromkeys(requirements) if not self.is_installed(requirement)]
+        if not missing:
+            return {"success": True}
+
+        batch = [requirement for requirement in missing if requirement not in self._installing]
+        if batch:
+            task = asyncio.create_task(self._install(batch))
+            for requirement in batch:
+                self._installing[requirement] = task
+            task.add_done_callback(lambda _: [self._installing.pop(requirement, None) for requirement in batch])
+
+        # shield: отмена одного задания не прерывает установку, которую ждут другие
+        tasks = {self._installing[requirement] for requirement in missing}
+        for result in await asyncio.gather(*(asyncio.shield(task) for task in tasks)):
+            if not result["success"]:
+                return result
+        return {"success": True}
+
+    async def _install(self, requirements: list) -> dict:
+        os.makedirs(self.wheelhouse, exist_ok=True)
+        offline = ("install", "-q", "--no-index", "--find-links", self.wheelhouse, *requirements)
+        result = await self._pip(*offline)
+        if result["success"]:
+            self.installed.update(requirements)
+            return result
+
+        # Колёс ещё нет - скачиваем (или собираем) их в каталог и ставим оттуда
+        logging.info(f"Скачиваю пакеты в {self.wheelhouse}: {' '.join(requirements)}")
+        result = await self._pip("wheel", "-q", "--wheel-dir", self.wheelhouse, *requirements)
+        if result["success"]:
+            result = await self._pip(*offline)
+        if result["success"]:
+            self.installed.update(requirements)
+        return result
+
+    async def _pip(self, *args) -> dict:
+        """pip окружения ботов"""
+        return await self._run(self.python, "-m", "pip", *args)
+
+    async def _run(self, *command) -> dict:
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return {"success": False, "error": f"{os.path.basename(command[0])} не уложился в {self.timeout} сек"}
+        if process.returncode != 0:
+            error = stderr.decode('utf-8', errors='replace').strip().splitlines()
+            return {"success": False, "error": error[-1] if error else f"код {process.returncode}"}
+        return {"success": True, "output": stdout.decode('utf-8', errors='replace')}
+
+
+dependency_installer = DependencyInstaller(PIP_INSTALL_TIMEOUT, WHEELHOUSE_DIR, USER_BOT_ENV_DIR)
+
+
+def validate_bot_code(analysis: dict):
+    """Проверить разбор сгенерированного кода; None - код в порядке, иначе текст ошибки"""
+    if not analysis["success"]:
+        return analysis["error"]
+    if "aiogram" not in analysis["modules"]:
+        return "код не использует aiogram"
+    if analysis["unknown"]:
+        return f"код импортирует неизвестные модули: {', '.join(analysis['unknown'])}"
+    return None
+
 
-    system_prompt = f"""Создай код Telegram бота на Python с использованием aiogram 3.x.
-Требования:
-1. Бот должен соответствовать следующему описанию: {prompt}
-2. Используй aiogram 3.x
-3. Токен бота: {bot_token}
-4. Код должен быть полным и готовым к запуску
-5. Добавь базовый функционал и команду /start
-6. Используй async/await
-7. Верни ТОЛЬКО код Python без объяснений, без markdown разметки
-8. Код должен начинаться с import и заканчиваться asyncio.run(main())"""
+class BotBuildJob:
+    """Задание на создание или изменение бота"""
 
-    try:
-        # Выполняем запрос в executor
-        loop = asyncio.get_event_loop()
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Создай бота: {prompt}"}
-        ]
-        result = await loop.run_in_executor(None, make_onlysq_request, messages, selected_model)
-        
-        if result.get("success"):
-            data = result["data"]
-            code = data['choices'][0]['message']['content']
+    _ids = itertools.count(1)
 
-            # Очистка кода от markdown
-            code = code.replace('```python', '').replace('```', '').strip()
+    STATES = {
+        "queued": "🕒 Бот в очереди на создание...",
+        "generating": "🧠 Генерирую код бота... Это может занять минуту.",
+        "validating": "🔍 Проверяю код...",
+        "installing": "📦 Устанавливаю зависимости...",
+    }
 
-            return code
-        else:
-            return None
-    except Exception as e:
-        logging.error(f"Ошибка генерации кода: {e}")
-        return None
+    def __init__(self, user_id: int, status_msg: Message, prompt: str, token: str, model: str, bot_id: str = None):
+        self.job_id = str(next(self._ids))
+        self.user_id = user_id
+        self.status_msg = status_msg
+        self.prompt = prompt
+        self.token = token
+        self.model = model
+        self.bot_id = bot_id  # None - новый бот, иначе изменение существующего
+        self.state = None
+        self.task = None
+
+    def cancel_keyboard(self) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🚫 Отменить", callback_data=f"cancel_build_{self.job_id}")]
+        ])
+
+    async def report(self, text: str, cancellable: bool = False):
+        """Показать состояние в статусном сообщении"""
+        try:
+            await self.status_msg.edit_text(text, reply_markup=self.cancel_keyboard() if cancellable else None)
+        except TelegramBadRequest:
+            pass
+        except Exception as e:
+            logging.error(f"Не удалось обновить статус создания бота: {e}")
 
+    async def set_state(self, state: str):
+        self.state = state
+        await self.report(self.STATES[state], cancellable=True)
 
-# === УПРАВЛЕНИЕ БОТАМИ ===
-def start_bot_process(bot_id: str, user_id: int):
-    """Запустить процесс бота"""
-    bot_file = os.path.join(BOTS_DIR, f"bot_{user_id}_{bot_id}.py")
 
-    if not os.path.exists(bot_file):
-        return False
+class BotBuildQueue:
+    """Очередь создания ботов: ограниченное число одновременных заданий,
+    не больше одного задания на пользователя, прогресс и отмена"""
 
-    try:
-        # Для Windows используем python вместо python3 и без preexec_fn
-        if os.name == 'nt':  # Windows
-            process = subprocess.Popen(
-                ["python", bot_file],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
-            )
-        else:  # Linux/Unix
-            process = subprocess.Popen(
-                ["python3", bot_file],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                preexec_fn=os.setsid
-            )
-        running_bots[bot_id] = process
-        update_bot_status(user_id, bot_id, True)
+    def __init__(self, workers: int, max_pending: int):
+        self.max_pending = max_pending
+        self.semaphore = asyncio.Semaphore(workers)
+        self.jobs = {}  # job_id -> BotBuildJob
+        self.completed = 0
+        self.failed = 0
+
+    def active_job(self, user_id: int):
+        return next((job for job in self.jobs.values() if job.user_id == user_id), None)
+
+    def submit(self, job: BotBuildJob) -> bool:
+        """Поставить задание в очередь; False - очередь заполнена"""
+        if len(self.jobs) >= self.max_pending:
+            return False
+        self.jobs[job.job_id] = job
+        job.task = asyncio.create_task(self._run(job))
         return True
-    except Exception as e:
-        logging.error(f"Ошибка запуска бота: {e}")
-        return False
 
+    def cancel(self, job_id: str, user_id: int) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None or job.user_id != user_id or job.task.done():
+            return False
+        job.task.cancel()
+        return True
 
-def stop_bot_process(bot_id: str, user_id: int):
-    """Остановить процесс бота"""
-    if bot_id in running_bots:
+    async def _run(self, job: BotBuildJob):
         try:
-            process = running_bots[bot_id]
-            if os.name == 'nt':  # Windows
-                process.terminate()
-            else:  # Linux/Unix
-                os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-            del running_bots[bot_id]
-            update_bot_status(user_id, bot_id, False)
-            return True
+            await job.set_state("queued")
+            async with self.semaphore:
+                if await self._build(job):
+                    self.completed += 1
+                else:
+                    self.failed += 1
+        except asyncio.CancelledError:
+            job.state = "cancelled"
+            await job.report("🚫 Создание бота отменено")
         except Exception as e:
-            logging.error(f"Ошибка остановки бота: {e}")
+            self.failed += 1
+            logging.error(f"Ошибка создания бота: {e}")
+            await job.report("❌ Ошибка при создании бота. Попробуйте позже.")
+        finally:
+            self.jobs.pop(job.job_id, None)
+
+    async def _build(self, job: BotBuildJob) -> bool:
+        """Генерация, проверка, установка зависимостей и сохранение"""
+        await job.set_state("generating")
+        bot_code = await generate_bot_code(job.prompt, job.token, job.user_id, job.model)
+        if not bot_code:
+            await job.report(
+                "❌ Ошибка при генерации кода бота\n\n"
+                "Возможные причины:\n"
+                "• Недостаточно токенов для выбранной модели\n"
+                "• Проблема с API\n\n"
+                "Попробуйте позже или выберите другую модель через /model"
+            )
+            return False
+
+        await job.set_state("validating")
+        analysis = await asyncio.to_thread(dependency_analyzer.analyze, bot_code)
+        error = validate_bot_code(analysis)
+        if error:
+            await job.report(f"❌ Сгенерированный код не прошёл проверку: {error}\n\nПопробуйте описать бота иначе.")
             return False
-    return False
+
+        await job.set_state("installing")
+        result = await dependency_installer.ensure(BOT_BASE_REQUIREMENTS + analysis["packages"])
+        if not result["success"]:
+            await job.report(f"❌ Не удалось установить зависимости: {result['error']}")
+            return False
+
+        # Дальше без await: отмена уже не может оставить бота сохранённым наполовину
+        job.state = "ready"
+        if job.bot_id is None:
+            bot_id = f"{job.user_id}_{datetime.now().timestamp()}"
+            with open(get_bot_file(job.user_id, bot_id), 'w', encoding='utf-8') as f:
+                f.write(bot_code)
+            add_bot(job.user_id, job.token, job.prompt, bot_id, job.model)
+            text = (
+                "✅ Бот успешно создан!\n\n"
+                "Ваш бот готов к запуску.\n"
+                "Используйте кнопку 'Мои боты' для управления."
+            )
+        else:
+            bot_data = get_bot_data(job.user_id, job.bot_id)
+            if bot_data and bot_data.get("is_running", False):
+                stop_bot_process(job.bot_id, job.user_id)
+            with open(get_bot_file(job.user_id, job.bot_id), 'w', encoding='utf-8') as f:
+                f.write(bot_code)
+            update_bot_prompt(job.user_id, job.bot_id, job.prompt)
+            text = (
+                "✅ Бот успешно обновлен!\n\n"
+                "Изменения применены. Запустите бота заново."
+            )
+
+        await job.report(text)
+        # Отправляем клавиатуру отдельным сообщением
+        await bot.send_message(job.user_id, "Выберите действие:", reply_markup=get_main_keyboard())
+        return True
+
+    def stats(self) -> dict:
+        states = {}
+        for job in self.jobs.values():
+            states[job.state] = states.get(job.state, 0) + 1
+        return {"active": len(self.jobs), "states": states, "completed": self.completed, "failed": self.failed}
+
+
+bot_build_queue = BotBuildQueue(BOT_BUILD_WORKERS, BOT_BUILD_MAX_PENDING)
+
+
+# === ЭКСПОРТ ДАННЫХ ===
+class ExportWriter:
+    """Запись экспорта в gzip JSONL частями не больше EXPORT_PART_BYTES
+
+    Каждая часть - отдельный gzip-файл из целых строк, читается без остальных.
+    """
+
+    def __init__(self, directory: str, name: str, part_bytes: int):
+        self.directory = directory
+        self.name = name
+        self.part_bytes = part_bytes
+        self.parts = []
+        self.records = 0
+        self._raw = None
+        self._gzip = None
+
+    def _open_part(self):
+        path = os.path.join(self.directory, f"{self.name}.part{len(self.parts) + 1:03d}.jsonl.gz")
+        self.parts.append(path)
+        self._raw = open(path, 'wb')
+        self._gzip = gzip.GzipFile(fileobj=self._raw, mode='wb')
+
+    def _close_part(self):
+        self._gzip.close()
+        self._raw.close()
+        self._gzip = self._raw = None
+
+    def write(self, record: dict):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+        # Сжатые данные копятся в gzip с задержкой - запас в 1 МБ до лимита
+        if self._gzip is not None and self._raw.tell() + len(line) > self.part_bytes - 1024 * 1024:
+            self._close_part()
+        if self._gzip is None:
+            self._open_part()
+        self._gzip.write(line)
+        self.records += 1
+
+    def close(self) -> list:
+        if self._gzip is not None:
+            self._close_part()
+        return self.parts
+
+
+def export_records(database_path: str, history: dict, since: str, until: str):
+    """Записи экспорта из копии SQLite базы, снимка истории и архива
+
+    since - время прошлого экспорта (None - полный экспорт): сообщения берутся
+    только с since < timestamp <= until. Таблицы пользователей, токенов и ботов
+    небольшие и без времени изменения, поэтому выгружаются целиком.
+    """
+    yield {"type": "export", "since": since, "until": until}
+
+    conn = sqlite3.connect(database_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        for table in ("users", "model_tokens", "bots", "meta"):
+            for row in conn.execute(f"SELECT * FROM {table}"):
+                yield {"type": table, "data": dict(row)}
+    finally:
+        conn.close()
+
+    if os.path.exists(SETTINGS_FILE):
+        yield {"type": "settings", "data": load_settings()}
+
+    def changed(message: dict) -> bool:
+        return (since is None or message["timestamp"] > since) and message["timestamp"] <= until
+
+    for user_id_str in sorted(set(history) | set(history_archive.user_ids())):
+        try:
+            archived = history_archive.read(user_id_str)
+        except (OSError, EOFError, json.JSONDecodeError) as e:
+            logging.error(f"Архив истории {user_id_str} не прочитан: {e}")
+            archived = []
+        # Сводка пишет реплики в архив раньше, чем убирает из истории, - повторы отбрасываем
+        archived_until = archived[-1]["timestamp"] if archived else ""
+        for message in archived:
+            if changed(message):
+                yield {"type": "message", "user_id": user_id_str, "archived": True, **message}
+        for message in history.get(user_id_str, []):
+            if message.get("summary"):
+                if since is None:
+                    yield {"type": "summary", "user_id": user_id_str, **message}
+            elif message["timestamp"] > archived_until and changed(message):
+                yield {"type": "message", "user_id": user_id_str, **message}
+
+
+def build_export(incremental: bool) -> dict:
+    """Согласованный снимок данных, записанный частями (выполняется в потоке)"""
+    until = datetime.now().isoformat()
+    since = user_store.get_meta("last_export") if incremental else None
+    name = f"export_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{'changes' if since else 'full'}"
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+
+    database_copy = os.path.join(EXPORT_DIR, f"{name}.db")
+    user_store.backup(database_copy)
+    writer = ExportWriter(EXPORT_DIR, name, EXPORT_PART_BYTES)
+    try:
+        # История снимается после until: сообщения новее попадут в следующий экспорт
+        for record in export_records(database_copy, history_store.snapshot(), since, until):
+            writer.write(record)
+        writer.write({"type": "end", "records": writer.records})
+    except BaseException:
+        for path in writer.close():
+            os.remove(path)
+        raise
+    finally:
+        os.remove(database_copy)
+    return {"parts": writer.close(), "records": writer.records, "since": since, "until": until}
+
+
+export_lock = asyncio.Lock()
 
 
 # === КОМАНДЫ БОТА ===
@@ -1122,7 +4026,9 @@ async def ai_chat_mode_button(message: Message, state: FSMContext):
         "/model - выбрать модель AI\n"
         "/account - проверить баланс\n"
         "/clear - очистить историю\n"
-        "/history - показать историю\n\n"
+        "/history - показать историю\n"
+        "/search - поиск по истории\n"
+        "/merge - объединять сообщения, отправленные во время ответа\n\n"
         f"📊 Токенов для текущей модели: {current_balance}",
         parse_mode='Markdown'
     )
@@ -1231,54 +4137,15 @@ async def process_prompt(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    status_msg = await message.answer("⏳ Создаю бота... Это может занять минуту.")
-
-    # Генерируем код бота
-    bot_code = await generate_bot_code(prompt, token, message.from_user.id, selected_model)
-
-    if not bot_code:
-        await status_msg.edit_text(
-            "❌ Ошибка при генерации кода бота\n\n"
-            "Возможные причины:\n"
-            "• Недостаточно токенов для выбранной модели\n"
-            "• Проблема с API\n\n"
-            "Попробуйте позже или выберите другую модель через /model"
-        )
+    if bot_build_queue.active_job(message.from_user.id):
+        await message.answer("⏳ Предыдущий бот ещё создаётся. Дождитесь завершения или отмените его.")
         await state.clear()
         return
 
-    # Создаем уникальный ID бота
-    bot_id = f"{message.from_user.id}_{datetime.now().timestamp()}"
-    bot_file = os.path.join(BOTS_DIR, f"bot_{message.from_user.id}_{bot_id}.py")
-
-    # Сохраняем код бота
-    with open(bot_file, 'w', encoding='utf-8') as f:
-        f.write(bot_code)
-
-    # Устанавливаем зависимости
-    await status_msg.edit_text("📦 Устанавливаю зависимости...")
-
-    try:
-        subprocess.run(
-            ["pip", "install", "-q", "aiogram", "aiohttp"],
-            check=True,
-            capture_output=True
-        )
-    except:
-        pass  # Зависимости уже установлены
-
-    # Сохраняем в базу
-    add_bot(message.from_user.id, token, prompt, bot_id, selected_model)
-
-    await status_msg.edit_text(
-        "✅ Бот успешно создан!\n\n"
-        "Ваш бот готов к запуску.\n"
-        "Используйте кнопку 'Мои боты' для управления."
-    )
-
-    # Отправляем клавиатуру отдельным сообщением
-    await message.answer("Выберите действие:", reply_markup=get_main_keyboard())
-
+    status_msg = await message.answer("⏳ Создаю бота...")
+    job = BotBuildJob(message.from_user.id, status_msg, prompt, token, selected_model)
+    if not bot_build_queue.submit(job):
+        await status_msg.edit_text("⏳ Сейчас создаётся слишком много ботов. Попробуйте через несколько минут.")
     await state.clear()
 
 
@@ -1444,46 +4311,29 @@ async def process_bot_edit(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    # Останавливаем бота если он запущен
-    if bot_data.get("is_running", False):
-        stop_bot_process(bot_id, message.from_user.id)
-
-    status_msg = await message.answer("⏳ Пересоздаю бота с новыми правками...")
-
-    # Новый промпт с изменениями
-    new_prompt = f"{bot_data['prompt']}\n\nДополнительные изменения: {changes}"
-
-    # Генерируем новый код с проверкой токенов
-    bot_code = await generate_bot_code(new_prompt, bot_data['token'], message.from_user.id, bot_model)
-
-    if not bot_code:
-        await status_msg.edit_text(
-            "❌ Ошибка при генерации кода\n\n"
-            "Возможные причины:\n"
-            "• Недостаточно токенов для выбранной модели\n"
-            "• Проблема с API\n\n"
-            "Попробуйте позже."
-        )
+    if bot_build_queue.active_job(message.from_user.id):
+        await message.answer("⏳ Предыдущий бот ещё создаётся. Дождитесь завершения или отмените его.")
         await state.clear()
         return
 
-    # Перезаписываем файл бота
-    bot_file = os.path.join(BOTS_DIR, f"bot_{message.from_user.id}_{bot_id}.py")
-    with open(bot_file, 'w', encoding='utf-8') as f:
-        f.write(bot_code)
-
-    # Обновляем промпт в базе
-    update_bot_prompt(message.from_user.id, bot_id, new_prompt)
+    status_msg = await message.answer("⏳ Пересоздаю бота с новыми правками...")
 
-    await status_msg.edit_text(
-        "✅ Бот успешно обновлен!\n\n"
-        "Изменения применены. Запустите бота заново."
-    )
+    # Новый промпт с изменениями; бот останавливается только когда новый код готов
+    new_prompt = f"{bot_data['prompt']}\n\nДополнительные изменения: {changes}"
+    job = BotBuildJob(message.from_user.id, status_msg, new_prompt, bot_data['token'], bot_model, bot_id)
+    if not bot_build_queue.submit(job):
+        await status_msg.edit_text("⏳ Сейчас создаётся слишком много ботов. Попробуйте через несколько минут.")
+    await state.clear()
 
-    # Отправляем клавиатуру отдельным сообщением
-    await message.answer("Выберите действие:", reply_markup=get_main_keyboard())
 
-    await state.clear()
+@dp.callback_query(F.data.startswith("cancel_build_"))
+async def cancel_bot_build(callback: CallbackQuery):
+    """Отменить создание бота"""
+    job_id = callback.data.split("_", 2)[2]
+    if bot_build_queue.cancel(job_id, callback.from_user.id):
+        await callback.answer("🚫 Отменяю...")
+    else:
+        await callback.answer("Задание уже завершено")
 
 
 @dp.callback_query(F.data.startswith("delete_"))
@@ -1531,56 +4381,33 @@ async def show_bot_dependencies(callback: CallbackQuery):
     with open(bot_file, 'r', encoding='utf-8') as f:
         code = f.read()
     
-    # Ищем импорты в коде
-    import_lines = [line.strip() for line in code.split('\n') if line.strip().startswith('import ') or line.strip().startswith('from ')]
-    
-    # Базовые зависимости
-    dependencies = []
-    dependencies.append("aiogram>=3.0.0")
-    dependencies.append("aiohttp")
-    
-    # Дополнительные зависимости на основе импортов
-    additional_deps = []
-    if any('requests' in line for line in import_lines):
-        additional_deps.append("requests")
-    if any('pillow' in line.lower() or 'pil' in line for line in import_lines):
-        additional_deps.append("pillow")
-    if any('numpy' in line for line in import_lines):
-        additional_deps.append("numpy")
-    if any('pandas' in line for line in import_lines):
-        additional_deps.append("pandas")
-    
-    # Встроенные модули
-    builtin = []
-    if any('sqlite3' in line for line in import_lines):
-        builtin.append("sqlite3")
-    if any('json' in line for line in import_lines):
-        builtin.append("json")
-    if any('datetime' in line for line in import_lines):
-        builtin.append("datetime")
-    if any('os' in line for line in import_lines):
-        builtin.append("os")
+    analysis = await asyncio.to_thread(dependency_analyzer.analyze, code)
+    if not analysis["success"]:
+        await callback.answer(f"❌ Не удалось разобрать код: {analysis['error']}", show_alert=True)
+        return
+    
+    # Базовые зависимости и пакеты, которые импортирует код
+    dependencies = list(dict.fromkeys(BOT_BASE_REQUIREMENTS + analysis["packages"]))
     
     text = "📦 Зависимости бота:\n\n"
-    text += "🔹 Обязательные:\n"
+    text += "🔹 Пакеты:\n"
     for dep in dependencies:
         text += f"  • {dep}\n"
     
-    if additional_deps:
-        text += "\n🔸 Дополнительные:\n"
-        for dep in additional_deps:
-            text += f"  • {dep}\n"
+    if analysis["unknown"]:
+        text += "\n⚠️ Неизвестные модули (не устанавливаются):\n"
+        for module in analysis["unknown"]:
+            text += f"  • {formatting.escape_html(module)}\n"
     
-    if builtin:
+    if analysis["stdlib"]:
         text += "\n✅ Встроенные (не требуют установки):\n"
-        for dep in builtin:
-            text += f"  • {dep}\n"
+        for module in analysis["stdlib"]:
+            text += f"  • {module}\n"
     
     # Команда для установки
-    all_deps = dependencies + additional_deps
-    text += f"\n💻 Команда для установки:\n`pip install {' '.join(all_deps)}`"
+    text += f"\n💻 Команда для установки:\n<code>pip install {formatting.escape_html(' '.join(dependencies))}</code>"
     
-    await callback.message.answer(text, parse_mode='Markdown')
+    await callback.message.answer(text, parse_mode='HTML')
     await callback.answer()
 
 
@@ -1644,7 +4471,7 @@ async def back_to_bots(callback: CallbackQuery):
 
 
 async def cmd_clear(message: Message):
-    clear_history(message.from_user.id)
+    await clear_history(message.from_user.id)
     await message.answer("🗑️ История очищена!")
 
 
@@ -1671,10 +4498,12 @@ async def cmd_account(message: Message):
     user_bots = user_data.get("bots", [])
     bots_count = len(user_bots)
     
+    plan_name = "💎 Paid" if user_data.get("plan") == "paid" else "🆓 Free"
+    
     # Формируем красивый вывод
     text = (
         f"👤 *ID Пользователя:* `{user_id}`\n"
-        f"⭐️ *Тип подписки:* 🆓 Free\n"
+        f"⭐️ *Тип подписки:* {plan_name}\n"
         f"📅 *Действует до:* -\n"
         f"💳 *Метод оплаты:* -\n"
         f"\n"
@@ -1821,7 +4650,7 @@ async def select_model(callback: CallbackQuery):
 
 @dp.message(F.text == "/history")
 async def cmd_history(message: Message):
-    history = get_history(message.from_user.id, limit=10)
+    history = await get_history(message.from_user.id, limit=10)
 
     if not history:
         await message.answer("📭 История пуста")
@@ -1836,6 +4665,87 @@ async def cmd_history(message: Message):
     await message.answer(text)
 
 
+@dp.message(Command("search"))
+async def cmd_search(message: Message, state: FSMContext, command: CommandObject):
+    """Поиск по своей истории: /search <запрос>"""
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("🔎 Использование: /search <что найти>\n\nНапример: /search рецепт борща")
+        return
+    if not user_store.search_available:
+        await message.answer("❌ Поиск по истории недоступен")
+        return
+    # Запрос - в данных FSM, чтобы кнопки страниц работали в любой копии бота
+    await state.update_data(search_query=query)
+    text, keyboard = await render_search_page(message.from_user.id, query, 0)
+    await message.answer(text, reply_markup=keyboard, parse_mode='HTML')
+
+
+@dp.callback_query(F.data.startswith("search_page_"))
+async def search_page(callback: CallbackQuery, state: FSMContext):
+    """Страница результатов поиска"""
+    query = (await state.get_data()).get("search_query")
+    if not query:
+        await callback.answer("Повторите поиск командой /search")
+        return
+    page = int(callback.data.rsplit("_", 1)[1])
+    text, keyboard = await render_search_page(callback.from_user.id, query, page)
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode='HTML')
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
+
+
+async def render_search_page(user_id: int, query: str, page: int) -> tuple:
+    """Текст и кнопки страницы результатов"""
+    stems = text_search.query_stems(query)
+    if not stems:
+        return "🔎 В запросе нет слов для поиска", None
+
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    total, rows = await loop.run_in_executor(
+        None, user_store.search_messages, user_id, stems, SEARCH_PAGE_SIZE, page * SEARCH_PAGE_SIZE
+    )
+    elapsed = (time.perf_counter() - started) * 1000
+
+    if not total:
+        return f"🔎 По запросу «{formatting.escape_html(query)}» ничего не найдено", None
+
+    pages = math.ceil(total / SEARCH_PAGE_SIZE)
+    text = f"🔎 «{formatting.escape_html(query)}»: найдено {total} ({elapsed:.0f} мс), страница {page + 1} из {pages}\n\n"
+    for row in rows:
+        role = "👤" if row["role"] == "user" else "🤖"
+        date = row["timestamp"][:16].replace("T", " ")
+        text += f"{role} <i>{date}</i>\n{text_search.snippet(row['content'], stems)}\n\n"
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"search_page_{page - 1}"))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton(text="Вперёд ▶️", callback_data=f"search_page_{page + 1}"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return text, keyboard
+
+
+@dp.message(F.text == "/merge")
+async def cmd_merge(message: Message):
+    """Включить/отключить объединение сообщений"""
+    username = message.from_user.username or f"user_{message.from_user.id}"
+    user_data = get_user_data(message.from_user.id, username)
+    enabled = not user_data.get("merge_messages", False)
+    set_merge_messages(message.from_user.id, enabled)
+    
+    if enabled:
+        await message.answer(
+            "🔗 Объединение сообщений включено\n\n"
+            "Сообщения, которые вы отправите, пока я отвечаю, я соберу и отвечу на них одним ответом."
+        )
+    else:
+        await message.answer("🔗 Объединение сообщений отключено\n\nНа каждое сообщение будет отдельный ответ.")
+
+
 @dp.message(F.text.startswith("/ask "))
 async def cmd_ask(message: Message):
     """Команда для работы в группах"""
@@ -1859,7 +4769,7 @@ async def cmd_ask(message: Message):
     
     thinking_msg = await message.answer("💭 Думаю...")
     
-    ai_response = await get_ai_response(message.from_user.id, query)
+    ai_response = await get_ai_response(message.from_user.id, query, feature="ask")
     ai_response = format_ai_response(ai_response)
     
     await thinking_msg.delete()
@@ -1888,12 +4798,8 @@ async def handle_forward(message: Message):
     ])
     
     # Сохраняем текст во временное хранилище (можно использовать state или базу)
-    # Для простоты сохраним в user_data
-    db = load_database()
-    user_id_str = str(message.from_user.id)
-    if user_id_str in db["users"]:
-        db["users"][user_id_str]["last_forwarded"] = forwarded_text
-        save_database(db)
+    # Для простоты сохраним в данных пользователя
+    user_store.set_last_forwarded(message.from_user.id, forwarded_text)
     
     await message.answer(
         f"📨 Получено сообщение ({len(forwarded_text)} символов)\n\n"
@@ -1908,15 +4814,12 @@ async def process_forward_action(callback: CallbackQuery):
     action = callback.data.replace("fwd_", "")
     
     # Получаем сохраненный текст
-    db = load_database()
-    user_id_str = str(callback.from_user.id)
+    forwarded_text = user_store.get_last_forwarded(callback.from_user.id)
     
-    if user_id_str not in db["users"] or "last_forwarded" not in db["users"][user_id_str]:
+    if not forwarded_text:
         await callback.answer("❌ Текст не найден. Перешлите сообщение заново.")
         return
     
-    forwarded_text = db["users"][user_id_str]["last_forwarded"]
-    
     # Проверяем лимит
     username = callback.from_user.username or f"user_{callback.from_user.id}"
     user_data = get_user_data(callback.from_user.id, username)
@@ -1935,7 +4838,7 @@ async def process_forward_action(callback: CallbackQuery):
     
     await callback.message.edit_text("💭 Обрабатываю...")
     
-    ai_response = await get_ai_response(callback.from_user.id, prompts[action])
+    ai_response = await get_ai_response(callback.from_user.id, prompts[action], feature="forward")
     ai_response = format_ai_response(ai_response)
     
     await callback.message.delete()
@@ -1990,14 +4893,14 @@ async def admin_check_api(callback: CallbackQuery):
         # Пробуем отправить тестовый запрос
         logging.info(f"Testing API with key: {API_KEY}")
         
-        loop = asyncio.get_event_loop()
         messages = [{"role": "user", "content": "test"}]
-        result = await loop.run_in_executor(None, make_onlysq_request, messages, "gpt-5.2-chat")
+        started = time.monotonic()
+        result = await make_onlysq_request(messages, "gpt-5.2-chat", PRIORITY_ADMIN)
         
         if result.get("success"):
             status_text = "✅ API работает нормально"
             status_emoji = "🟢"
-            response_time = "< 1 сек"
+            response_time = f"{time.monotonic() - started:.2f} сек"
         else:
             status = result.get("status", 0)
             error_text = result.get("text", result.get("error", "Unknown"))
@@ -2052,32 +4955,67 @@ async def admin_check_api(callback: CallbackQuery):
 
 @dp.callback_query(F.data == "admin_export_db")
 async def admin_export_database(callback: CallbackQuery):
-    """Экспорт базы данных"""
+    """Выбор экспорта: полный или только изменения"""
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("❌ Нет доступа")
+        return
+    
+    last_export = user_store.get_meta("last_export")
+    last_export_text = last_export[:16].replace("T", " ") if last_export else "не было"
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📦 Полный экспорт", callback_data="admin_export_full")],
+        [InlineKeyboardButton(text="🔄 Изменения с прошлого экспорта", callback_data="admin_export_changes")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_back")]
+    ])
+    await callback.message.edit_text(
+        "💾 Экспорт БД\n\n"
+        f"Данные выгружаются в gzip JSONL частями до {EXPORT_PART_BYTES // (1024 * 1024)} МБ.\n"
+        f"Прошлый экспорт: {last_export_text}",
+        reply_markup=keyboard
+    )
+    await callback.answer()
+
+
+@dp.callback_query(F.data.in_({"admin_export_full", "admin_export_changes"}))
+async def admin_export_run(callback: CallbackQuery):
+    """Экспорт базы данных частями"""
     if callback.from_user.id != ADMIN_ID:
         await callback.answer("❌ Нет доступа")
         return
+    if export_lock.locked():
+        await callback.answer("⏳ Экспорт уже выполняется")
+        return
     
     await callback.answer("📦 Готовлю файлы...")
     
-    try:
-        # Отправляем database.json
-        if os.path.exists(DATABASE_FILE):
-            file = FSInputFile(DATABASE_FILE)
-            await callback.message.answer_document(file, caption="📦 database.json")
-        
-        # Отправляем chat_history.json
-        if os.path.exists(DB_FILE):
-            file2 = FSInputFile(DB_FILE)
-            await callback.message.answer_document(file2, caption="📦 chat_history.json")
+    async with export_lock:
+        loop = asyncio.get_running_loop()
+        try:
+            export = await loop.run_in_executor(None, build_export, callback.data == "admin_export_changes")
+        except Exception as e:
+            logging.error(f"Ошибка экспорта: {e}")
+            await callback.message.answer(f"❌ Ошибка экспорта: {e}")
+            return
         
-        # Отправляем bot_settings.json
-        if os.path.exists(SETTINGS_FILE):
-            file3 = FSInputFile(SETTINGS_FILE)
-            await callback.message.answer_document(file3, caption="📦 bot_settings.json")
+        parts = export["parts"]
+        try:
+            for number, path in enumerate(parts, 1):
+                file = FSInputFile(path)
+                await callback.message.answer_document(file, caption=f"📦 Часть {number} из {len(parts)}")
+                os.remove(path)
+        except Exception as e:
+            logging.error(f"Ошибка отправки экспорта: {e}")
+            await callback.message.answer(f"❌ Ошибка отправки экспорта: {e}")
+            return
+        finally:
+            for path in parts:
+                if os.path.exists(path):
+                    os.remove(path)
         
-        await callback.message.answer("✅ Экспорт завершен!")
-    except Exception as e:
-        await callback.message.answer(f"❌ Ошибка экспорта: {e}")
+        # Отметка только после отправки всех частей: иначе изменения не попадут в следующий экспорт
+        user_store.set_meta("last_export", export["until"])
+        since_text = f" с {export['since'][:16].replace('T', ' ')}" if export["since"] else ""
+        await callback.message.answer(f"✅ Экспорт{since_text} завершен: {export['records']} записей, частей {len(parts)}")
 
 
 @dp.callback_query(F.data == "admin_stats")
@@ -2113,6 +5051,65 @@ async def admin_stats(callback: CallbackQuery):
         
         text += f"{i}. {username_display} - {requests} запросов\n"
     
+    # Кэш ответов
+    cache_stats = response_cache.stats()
+    text += (
+        f"\n🗄 Кэш ответов: попаданий {cache_stats['hits']}, "
+        f"промахов {cache_stats['misses']}, записей {cache_stats['items']}\n"
+    )
+    
+    # Сжатие истории
+    summary_stats = history_summarizer.stats()
+    text += (
+        f"🗜 Сводки истории: сделано {summary_stats['summarized']}, "
+        f"ошибок {summary_stats['failed']}, в очереди {summary_stats['pending']}\n"
+    )
+    
+    # Долговременная память
+    if chat_memory is not None:
+        memory_stats = chat_memory.stats()
+        text += f"🧠 Память чатов: пользователей в памяти {memory_stats['users']}, сообщений {memory_stats['items']}\n"
+    
+    # Подсчёт токенов истории
+    token_stats = token_counter.stats()
+    text += (
+        f"🔢 Кэш токенов: попаданий {token_stats['hits']}, "
+        f"подсчётов {token_stats['misses']}, записей {token_stats['items']}\n"
+    )
+    
+    # Кэш распознанного текста
+    ocr_stats = ocr_cache.stats()
+    text += (
+        f"🖼 Кэш OCR: повторов {ocr_stats['hits']}, похожих {ocr_stats['similar_hits']}, "
+        f"распознано {ocr_stats['misses']}, записей {ocr_stats['items']}\n"
+    )
+    
+    # Процессы пользовательских ботов
+    supervisor_stats = bot_supervisor.stats()
+    text += (
+        f"🤖 Процессы ботов: работает {supervisor_stats['alive']} из {supervisor_stats['processes']}, "
+        f"перезапусков {supervisor_stats['restarts']}"
+        f"{'' if supervisor_stats['leader'] else ' (надзор ведёт другая копия бота)'}\n"
+    )
+    
+    # Очередь создания ботов
+    build_stats = bot_build_queue.stats()
+    text += (
+        f"🛠 Создание ботов: в работе {build_stats['active']}, "
+        f"готово {build_stats['completed']}, ошибок {build_stats['failed']}\n"
+    )
+    
+    # Очередь запросов к API по моделям
+    queue_stats = upstream_scheduler.snapshot()
+    if queue_stats:
+        text += "\n🚦 Очередь к API:\n"
+        for model_id, metrics in queue_stats.items():
+            text += (
+                f"• {model_id}: в очереди {metrics['depth']}, "
+                f"отправлено {metrics['sent']}, отклонено {metrics['rejected']}, "
+                f"ожидание ср. {metrics['wait_avg']:.1f} / макс. {metrics['wait_max']:.1f} сек\n"
+            )
+    
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_back")]
     ])
@@ -2183,8 +5180,8 @@ async def admin_get_user_id(message: Message, state: FSMContext):
         user_id = int(message.text)
         
         # Проверяем существование пользователя
-        users_db = get_all_users()
-        if str(user_id) not in users_db:
+        user_data = find_user(user_id)
+        if user_data is None:
             await message.answer(
                 f"❌ Пользователь с ID {user_id} не найден в базе\n\n"
                 f"Пользователь должен сначала написать боту хотя бы одно сообщение.\n"
@@ -2196,7 +5193,6 @@ async def admin_get_user_id(message: Message, state: FSMContext):
         await state.set_state(AdminStates.waiting_for_model_selection)
         
         # Показываем информацию о пользователе и выбор модели
-        user_data = users_db[str(user_id)]
         username = user_data.get("username", "unknown")
         model_tokens = user_data.get("model_tokens", {})
         total_balance = sum(model_tokens.values())
@@ -2270,8 +5266,7 @@ async def admin_get_tokens_amount(message: Message, state: FSMContext):
         target_model = data.get("target_model", DEFAULT_MODEL)
         
         # Проверяем еще раз что пользователь существует
-        users_db = get_all_users()
-        if str(target_user_id) not in users_db:
+        if find_user(target_user_id) is None:
             await message.answer(f"❌ Пользователь {target_user_id} больше не найден в базе")
             await state.clear()
             return
@@ -2280,8 +5275,7 @@ async def admin_get_tokens_amount(message: Message, state: FSMContext):
         add_requests(target_user_id, amount, target_model)
         
         # Получаем обновленные данные
-        users_db = get_all_users()
-        user_data = users_db[str(target_user_id)]
+        user_data = find_user(target_user_id)
         username = user_data.get("username", "unknown")
         new_balance = get_user_model_balance(target_user_id, target_model)
         model_name = AVAILABLE_MODELS[target_model]["name"]
@@ -2463,6 +5457,24 @@ async def admin_back(callback: CallbackQuery):
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
+async def recognize_photo(photo, user_id: int) -> dict:
+    """Скачать и распознать фото с учётом кэша похожих изображений пользователя"""
+    file = await bot.get_file(photo.file_id)
+    file_bytes = await bot.download_file(file.file_path)
+    image_bytes = file_bytes.read()
+    
+    # Воркер сам сверит изображение с уже распознанными у этого пользователя
+    # (пересжатое при пересылке) и запустит OCR, только если похожего нет
+    result = await ocr_pool.recognize(image_bytes, ocr_cache.known(user_id))
+    if result.get("similar") is not None:
+        text = ocr_cache.take_similar(result["similar"], photo.file_unique_id, user_id, result["fingerprint"])
+        if text is not None:
+            return {"success": True, "text": text}
+        result = await ocr_pool.recognize(image_bytes)
+    if result["success"]:
+        ocr_cache.put(photo.file_unique_id, result["text"], user_id, result["fingerprint"])
+    return result
+
 @dp.message(F.photo)
 async def handle_photo(message: Message):
     """Обработка фотографий - распознавание текста"""
@@ -2473,51 +5485,36 @@ async def handle_photo(message: Message):
     try:
         status_msg = await message.answer("📸 Распознаю текст на изображении...")
         
-        # Получаем файл
         photo = message.photo[-1]  # Берем самое большое фото
-        file = await bot.get_file(photo.file_id)
-        file_bytes = await bot.download_file(file.file_path)
-        
-        # Открываем изображение
-        image = Image.open(io.BytesIO(file_bytes.read()))
         
-        # Улучшаем изображение для лучшего распознавания
-        # Конвертируем в оттенки серого и увеличиваем контраст
-        from PIL import ImageEnhance
-        image = image.convert('L')  # Оттенки серого
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(2)  # Увеличиваем контраст
+        # Тот же файл уже распознавали - не скачиваем и не распознаём повторно
+        text = ocr_cache.get(photo.file_unique_id)
+        result = {"success": True, "text": text} if text is not None else await recognize_photo(photo, message.from_user.id)
+        await status_msg.delete()
         
-        # Пробуем разные языки
-        text = ""
-        try:
-            # Проверяем, установлен ли Tesseract
-            import shutil
-            if not shutil.which('tesseract'):
-                raise Exception("Tesseract не установлен")
-            
-            # Сначала пробуем русский + английский
-            text = pytesseract.image_to_string(image, lang='rus+eng')
-        except Exception as e:
-            if "not installed" in str(e).lower() or "tesseract" in str(e).lower():
-                await status_msg.delete()
+        if not result["success"]:
+            error = result["error"]
+            if error == "tesseract_missing":
                 await message.answer(
                     "❌ OCR временно недоступен\n\n"
                     "Функция распознавания текста с изображений отключена.\n"
                     "Пожалуйста, отправьте текст сообщением."
                 )
-                return
-            try:
-                # Если не получилось, пробуем только английский
-                text = pytesseract.image_to_string(image, lang='eng')
-            except:
-                # В крайнем случае без указания языка
-                text = pytesseract.image_to_string(image)
-        
-        await status_msg.delete()
+            elif error == "busy":
+                await message.answer(
+                    "⏳ Сейчас распознаётся слишком много изображений.\n"
+                    "Попробуйте отправить фото через минуту."
+                )
+            elif error == "timeout":
+                await message.answer(
+                    "⏱ Распознавание заняло слишком много времени.\n"
+                    "Попробуйте обрезать изображение до области с текстом."
+                )
+            else:
+                raise Exception(error)
+            return
         
-        # Убираем лишние пробелы и переносы
-        text = text.strip()
+        text = result["text"]
         
         if text and len(text) > 2:  # Минимум 3 символа
             # Если есть подпись к фото, добавляем её как вопрос
@@ -2545,7 +5542,8 @@ async def handle_photo(message: Message):
                 thinking_msg = await message.answer("💭 Думаю...")
                 await bot.send_chat_action(message.chat.id, "typing")
                 
-                ai_response = await get_ai_response(message.from_user.id, user_message)
+                ai_response = await get_ai_response(message.from_user.id, user_message, feature="ocr")
+                ai_response = format_ai_response(ai_response)
                 
                 await thinking_msg.delete()
                 await send_long_message(message, ai_response)
@@ -2587,7 +5585,33 @@ async def handle_message(message: Message, state: FSMContext):
     # Регистрируем пользователя и проверяем лимиты
     username = message.from_user.username or f"user_{message.from_user.id}"
     user_data = get_user_data(message.from_user.id, username)
+    user_id = message.from_user.id
+    
+    # Пока предыдущий запрос выполняется, новые сообщения копим и отправляем одним запросом
+    if user_data.get("merge_messages") and user_gate.is_busy(user_id):
+        user_gate.defer(user_id, message)
+        return
     
+    with user_gate.session(user_id):
+        try:
+            await answer_chat_message(message, message.text, username)
+            
+            while True:
+                deferred = user_gate.take_deferred(user_id)
+                if not deferred:
+                    break
+                merged_text = "\n\n".join(m.text for m in deferred)
+                await answer_chat_message(deferred[-1], merged_text, username)
+        except BaseException:
+            # Отложенные сообщения относились к упавшему запросу - иначе они приклеятся к следующему
+            dropped = user_gate.take_deferred(user_id)
+            if dropped:
+                logging.warning(f"Запрос {user_id} завершился ошибкой, отброшено отложенных сообщений: {len(dropped)}")
+            raise
+
+
+async def answer_chat_message(message: Message, text: str, username: str):
+    """Ответить на сообщение в чате с AI"""
     # Проверяем лимит запросов
     user_data = get_user_data(message.from_user.id, username)
     selected_model = user_data.get("selected_model", DEFAULT_MODEL)
@@ -2608,7 +5632,7 @@ async def handle_message(message: Message, state: FSMContext):
         return
 
     # Проверяем, просит ли пользователь отправить ответ файлом
-    user_text = message.text.lower()
+    user_text = text.lower()
     force_file = any(keyword in user_text for keyword in [
         'отправь файлом', 'пришли файлом', 'скинь файлом',
         'в файле', 'как файл', 'файлом', 'в txt',
@@ -2619,12 +5643,19 @@ async def handle_message(message: Message, state: FSMContext):
     thinking_msg = await message.answer("💭 Думаю...")
     await bot.send_chat_action(message.chat.id, "typing")
 
-    ai_response = await get_ai_response(message.from_user.id, message.text)
-    
-    # Форматируем ответ: добавляем кавычки к цитатам и выделяем код
-    ai_response = format_ai_response(ai_response)
+    if is_streaming_enabled() and not force_file:
+        # Показываем ответ по мере генерации, редактируя сообщение "Думаю..."
+        stream = StreamingReply(thinking_msg)
+        ai_response = await get_ai_response(message.from_user.id, text, on_delta=stream.update)
+        await stream.finish(format_ai_response(ai_response))
+    else:
+        ai_response = await get_ai_response(message.from_user.id, text)
+        
+        # Форматируем ответ: добавляем кавычки к цитатам и выделяем код
+        ai_response = format_ai_response(ai_response)
 
-    await thinking_msg.delete()
+        await thinking_msg.delete()
+        await send_long_message(message, ai_response, force_file=force_file)
     
     # Показываем оставшиеся запросы
     user_data = get_user_data(message.from_user.id, username)
@@ -2632,48 +5663,23 @@ async def handle_message(message: Message, state: FSMContext):
     model_tokens = user_data.get("model_tokens", {})
     requests_left = model_tokens.get(selected_model, 0)
     
-    await send_long_message(message, ai_response, force_file=force_file)
-    
     if requests_left <= 5:
         model_name = AVAILABLE_MODELS[selected_model]["name"]
         await message.answer(f"⚠️ Осталось токенов для {model_name}: {requests_left}")
 
 
 def migrate_database():
-    """Миграция базы данных - добавление новых моделей для существующих пользователей"""
+    """Миграция базы данных - импорт database.json и добавление новых моделей для существующих пользователей"""
     try:
-        db = load_database()
-        updated = False
+        # Однократный перенос старой JSON базы в SQLite
+        import_json_database()
         
-        for user_id, user_data in db.get("users", {}).items():
-            # Проверяем, есть ли model_tokens
-            if "model_tokens" not in user_data:
-                user_data["model_tokens"] = {}
-                updated = True
-            
-            # Добавляем недостающие модели
-            for model_id in AVAILABLE_MODELS.keys():
-                if model_id not in user_data["model_tokens"]:
-                    user_data["model_tokens"][model_id] = get_model_limit(model_id)
-                    updated = True
-                    logging.info(f"Добавлена модель {model_id} для пользователя {user_id}")
-            
-            # Проверяем другие поля
-            if "selected_model" not in user_data:
-                user_data["selected_model"] = DEFAULT_MODEL
-                updated = True
-            
-            if "bots" not in user_data:
-                user_data["bots"] = []
-                updated = True
-            
-            if "total_requests" not in user_data:
-                user_data["total_requests"] = 0
-                updated = True
+        # Добавляем недостающие модели
+        limits = {model_id: get_model_limit(model_id) for model_id in AVAILABLE_MODELS.keys()}
+        added = user_store.fill_missing_models(limits)
         
-        if updated:
-            save_database(db)
-            logging.info("✅ База данных успешно обновлена")
+        if added:
+            logging.info(f"✅ База данных успешно обновлена: добавлено {added} записей токенов")
         else:
             logging.info("✅ База данных актуальна")
             
@@ -2681,12 +5687,154 @@ def migrate_database():
         logging.error(f"Ошибка миграции базы данных: {e}")
 
 
+# === ПРИЁМ ОБНОВЛЕНИЙ ЧЕРЕЗ WEBHOOK ===
+class UpdateLimiter:
+    """Обработка обновлений в фоне с ограничением одновременных задач"""
+
+    def __init__(self, max_concurrency: int, max_pending: int):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_pending = max_pending
+        self.tasks = set()
+
+    def is_full(self) -> bool:
+        return len(self.tasks) >= self.max_pending
+
+    def submit(self, update: Update):
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _process(self, update: Update):
+        async with self.semaphore:
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                logging.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+
+    async def drain(self, timeout: float):
+        """Дождаться начатых обновлений, остальные отменить"""
+        if not self.tasks:
+            return
+        logging.info(f"Ожидаю завершения {len(self.tasks)} обновлений...")
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        # Даём отменённым обработчикам завершиться до закрытия сессии бота
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+update_limiter = UpdateLimiter(WEBHOOK_MAX_CONCURRENCY, WEBHOOK_MAX_PENDING)
+
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    """Приём обновления от Telegram: ответ сразу, обработка в фоне"""
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    # Сравниваем байты: на str с не-ASCII символами compare_digest бросает TypeError
+    if not hmac.compare_digest(secret.encode("utf-8", "surrogateescape"), WEBHOOK_SECRET.encode("utf-8")):
+        return web.Response(status=401)
+    
+    if update_limiter.is_full():
+        # Перегружены - Telegram повторит доставку позже
+        return web.Response(status=503)
+    
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except ValueError:
+        return web.Response(status=400)
+    
+    update_limiter.submit(update)
+    return web.Response()
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    """Проверка для балансировщика"""
+    return web.json_response({"status": "ok", "pending_updates": len(update_limiter.tasks)})
+
+
+async def run_webhook():
+    """Работа через webhook: несколько копий бота могут стоять за балансировщиком"""
+    if not WEBHOOK_SECRET:
+        logging.error("❌ Для режима webhook задайте WEBHOOK_SECRET")
+        return
+    
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    app.router.add_get("/health", handle_health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    
+    await dp.emit_startup(bot=bot)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(100, WEBHOOK_MAX_CONCURRENCY)
+        )
+    logging.info(f"🌐 Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    # Останавливаемся по SIGTERM/SIGINT (на Windows - по Ctrl+C через отмену задачи)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    
+    try:
+        await stop.wait()
+    finally:
+        # Сначала перестаём принимать обновления, потом дожидаемся начатых
+        logging.info("Останавливаю приём обновлений...")
+        await runner.cleanup()
+        await update_limiter.drain(WEBHOOK_SHUTDOWN_TIMEOUT)
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
 async def main():
     # Выполняем миграцию базы данных при запуске
     migrate_database()
     
+    # Загружаем историю чатов и запускаем фоновое сжатие журнала
+    history_store.load()
+    await asyncio.get_running_loop().run_in_executor(None, import_search_index)
+    # Кодировки tiktoken скачиваются при первом использовании - заранее и не в цикле событий
+    await asyncio.get_running_loop().run_in_executor(None, token_counter.preload)
+    # Процессы ботов запускаются интерпретатором их окружения - создаём его до надзора
+    result = await dependency_installer.prepare()
+    if not result["success"]:
+        logging.error(f"Окружение пакетов ботов не создано, боты запускаются интерпретатором главного бота: "
+                      f"{result['error']}")
+    compactor = asyncio.create_task(history_store.run_compactor())
+    summarizer = asyncio.create_task(history_summarizer.run())
+    memory_saver = asyncio.create_task(run_memory_saver()) if chat_memory is not None else None
+    # Пользовательские боты: сверка с базой сразу при запуске, затем периодически
+    supervisor = asyncio.create_task(bot_supervisor.run()) if SUPERVISOR_ENABLED else None
+    quota_scheduler = asyncio.create_task(run_quota_reset_scheduler())
+    
     logging.info("🚀 Мультифункциональный бот запущен!")
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        compactor.cancel()
+        summarizer.cancel()
+        if memory_saver:
+            memory_saver.cancel()
+            chat_memory.save_dirty()
+        quota_scheduler.cancel()
+        if supervisor:
+            # Процессы ботов не останавливаем: при следующем запуске они будут приняты под надзор
+            supervisor.cancel()
+        await close_http_session()
+        ocr_pool.shutdown()
+        history_store.flush()
+        await dp.storage.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+"""Поддельный Telegram для локальной проверки режима webhook
+
+Поднимает сервер, который отвечает боту вместо Bot API (и вместо OnlySq API),
+дожидается регистрации webhook и отправляет на него записанные обновления,
+затем печатает, за сколько бот ответил в каждый чат.
+
+    python fake_telegram.py updates.jsonl --port 8081
+    TELEGRAM_API_URL=http://localhost:8081 API_URL=http://localhost:8081/ai/v2 \\
+        BOT_MODE=webhook WEBHOOK_URL=http://localhost:8080 WEBHOOK_SECRET=test python bot.py
+
+updates.jsonl - по одному обновлению Telegram (JSON) в строке. Без файла
+отправляются сгенерированные текстовые сообщения от --users пользователей.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import statistics
+import time
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+
+class FakeTelegram:
+    """Минимальный Bot API: запоминает вызовы и возвращает правдоподобные ответы"""
+
+    def __init__(self, reply_text: str):
+        self.reply_text = reply_text
+        self.calls = Counter()
+        self.message_ids = itertools.count(1000)
+        self.webhook = asyncio.Event()
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.sent_at = {}  # chat_id -> время отправки последнего обновления
+        self.latencies = []
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+
+        if method == "setWebhook":
+            self.webhook_url = params.get("url")
+            self.webhook_secret = params.get("secret_token", "")
+            self.webhook.set()
+            return self.ok(True)
+        if method == "getMe":
+            return self.ok({"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"})
+        if method in ("sendMessage", "editMessageText", "sendDocument", "sendPhoto"):
+            chat_id = int(params.get("chat_id", 0))
+            self.record_reply(chat_id)
+            return self.ok(self.message(chat_id, params.get("text", "")))
+        return self.ok(True)
+
+    async def handle_ai(self, request: web.Request) -> web.Response:
+        """Ответ вместо OnlySq API"""
+        self.calls["ai"] += 1
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": self.reply_text}}]})
+
+    def record_reply(self, chat_id: int):
+        """Первый ответ в чат после обновления - задержка обработки"""
+        sent_at = self.sent_at.pop(chat_id, None)
+        if sent_at is not None:
+            self.latencies.append(time.monotonic() - sent_at)
+
+    def message(self, chat_id: int, text: str) -> dict:
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+
+def load_updates(path: str) -> list:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def generate_updates(users: int, per_user: int) -> list:
+    """Текстовые сообщения от нескольких пользователей"""
+    updates = []
+    update_ids = itertools.count(1)
+    for n in range(per_user):
+        for user_id in range(100001, 100001 + users):
+            user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+            updates.append({
+                "update_id": next(update_ids),
+                "message": {
+                    "message_id": n + 1,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": user,
+                    "text": f"Сообщение номер {n + 1}",
+                },
+            })
+    return updates
+
+
+async def replay(fake: FakeTelegram, updates: list, url: str, secret: str, concurrency: int) -> Counter:
+    """Отправить обновления на webhook и собрать коды ответов"""
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+
+    async with aiohttp.ClientSession() as session:
+        async def post(update: dict):
+            chat = (update.get("message") or {}).get("chat") or {}
+            async with semaphore:
+                if chat:
+                    fake.sent_at[chat["id"]] = time.monotonic()
+                async with session.post(url, json=update, headers=headers) as response:
+                    statuses[response.status] += 1
+
+        await asyncio.gather(*(post(update) for update in updates))
+    return statuses
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("updates", nargs="?", help="JSONL с записанными обновлениями")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--webhook-url", help="Куда отправлять обновления (иначе ждём setWebhook от бота)")
+    parser.add_argument("--secret", default="", help="Секрет webhook, если --webhook-url задан вручную")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--per-user", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=20, help="Одновременных POST на webhook")
+    parser.add_argument("--wait", type=float, default=10, help="Сколько ждать ответов бота, секунд")
+    parser.add_argument("--reply", default="Тестовый ответ модели", help="Текст ответа вместо OnlySq API")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.reply)
+    app = web.Application()
+    app.router.add_post("/ai/v2", fake.handle_ai)
+    app.router.add_post("/bot{token}/{method}", fake.handle_method)
+    app.router.add_get("/bot{token}/{method}", fake.handle_method)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", args.port).start()
+    print(f"Поддельный Telegram на http://localhost:{args.port}")
+
+    if args.webhook_url:
+        url, secret = args.webhook_url, args.secret
+    else:
+        print("Жду регистрации webhook от бота...")
+        await fake.webhook.wait()
+        url, secret = fake.webhook_url, fake.webhook_secret
+        # Бот регистрирует webhook уже после запуска своего сервера
+        await asyncio.sleep(0.5)
+
+    updates = load_updates(args.updates) if args.updates else generate_updates(args.users, args.per_user)
+    print(f"Отправляю {len(updates)} обновлений на {url}")
+    started = time.monotonic()
+    statuses = await replay(fake, updates, url, secret, args.concurrency)
+    print(f"Доставлено за {time.monotonic() - started:.2f} сек, коды ответов: {dict(statuses)}")
+
+    await asyncio.sleep(args.wait)
+    print(f"Вызовы Bot API: {dict(fake.calls)}")
+    if fake.latencies:
+        latencies = sorted(fake.latencies)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(
+            f"Первый ответ бота: медиана {statistics.median(latencies) * 1000:.0f} мс, "
+            f"p95 {p95 * 1000:.0f} мс ({len(latencies)} чатов)"
+        )
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
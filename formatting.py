@@ -0,0 +1,417 @@
+"""Форматирование ответов AI в HTML для Telegram
+
+Ответ разбирается за один проход одним скомпилированным регулярным выражением:
+блоки кода, LaTeX, заголовки, жирный текст и списки распознаются как токены,
+а обычный текст между ними копируется без изменений. Здесь же разбивка
+готового HTML на сообщения. Модуль не зависит от aiogram, чтобы его можно было
+замерять отдельно (benchmark_formatting.py).
+"""
+import html
+import re
+from bisect import bisect_left
+
+SUPERSCRIPTS = str.maketrans('0123456789+-=()', '⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾')
+SUBSCRIPTS = str.maketrans('0123456789+-=()', '₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎')
+
+# Замена LaTeX команд на понятные символы, остальные команды удаляются
+LATEX_COMMANDS = {
+    # Операции
+    'times': ' * ', 'cdot': ' * ', 'div': ' / ', 'pm': ' ± ',
+    'ldots': '...', 'dots': '...',
+
+    # Сравнения
+    'leq': '≤', 'geq': '≥', 'neq': '≠', 'approx': '≈', 'equiv': '≡',
+
+    # Стрелки
+    'rightarrow': '→', 'leftarrow': '←', 'to': '→',
+
+    # Греческие буквы
+    'alpha': 'α', 'beta': 'β', 'gamma': 'γ', 'delta': 'δ',
+    'theta': 'θ', 'pi': 'π', 'sigma': 'σ', 'omega': 'ω',
+
+    # Тригонометрия
+    'sin': 'sin', 'cos': 'cos', 'tan': 'tan', 'cot': 'cot',
+
+    # Геометрия
+    'angle': '∠', 'circ': '°', 'degree': '°', 'triangle': '△',
+}
+
+HEADINGS = {1: '📢 ', 2: '📍 ', 3: '📌 '}
+HTML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+
+# Токены, которые могут встретиться внутри \frac{...}, \sqrt{...} и т.п.
+_INLINE_TOKENS = [
+    r'(?P<frac>\\frac\{(?P<numerator>[^}]+)\}\{(?P<denominator>[^}]+)\})',
+    r'(?P<sqrt>\\sqrt\{(?P<radicand>[^}]+)\})',
+    r'(?P<text>\\text\{(?P<plain>[^}]+)\})',
+    r'(?P<sup>\^\{(?P<sup_text>[^}]+)\}|\^(?P<sup_digit>[0-9]))',
+    r'(?P<sub>_\{(?P<sub_text>[^}]+)\})',
+    r'(?P<delimiter>\\(?:left|right)(?![a-zA-Z])(?P<bracket>[()\[\]])?)',
+    r'(?P<command>\\(?P<name>[a-zA-Z]+)(?:_(?!\{))?)',
+    r'(?P<drop>[{}$]+|\\(?![a-zA-Z]))',
+    r'(?P<escape>[&<>])',
+]
+
+# Полный набор: блоки кода и жирный текст проверяются раньше LaTeX
+_BLOCK_TOKENS = [
+    r'(?P<fence>```(?:(?P<lang>\w+)\n)?\n?(?P<code>[\s\S]*?)(?:```|\Z))',
+    r'(?P<inline_code>`(?P<inline>[^`\n]+)`)',
+    r'(?P<newlines>\n{3,}|\n+(?=[#*-]))',
+    r'(?P<bold>\*\*)',
+]
+
+# Опережающая проверка первого символа позволяет re пропускать обычный текст
+# без перебора всех альтернатив в каждой позиции
+_FIRST_CHARS = r'(?=[`\n*\\^_{}$&<>])'
+BLOCK_PATTERN = re.compile(_FIRST_CHARS + '(?:' + '|'.join(_BLOCK_TOKENS + _INLINE_TOKENS) + ')')
+INLINE_PATTERN = re.compile(_FIRST_CHARS + '(?:' + '|'.join(_INLINE_TOKENS) + ')')
+
+# Разметка начала строки: проверяется только после переводов строк перед # * -
+LINE_START_PATTERN = re.compile(r'(?P<level>\#{1,3})[ \t]*(?=\S)|[-*][ \t]+(?=\S)')
+
+
+def escape_html(text: str) -> str:
+    """Экранировать текст для parse_mode HTML"""
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def render_inline(text: str) -> str:
+    """LaTeX и экранирование для фрагмента без блочной разметки"""
+    out = []
+    position = 0
+    for match in INLINE_PATTERN.finditer(text):
+        out.append(text[position:match.start()])
+        out.append(_render_inline_token(match))
+        position = match.end()
+    out.append(text[position:])
+    return ''.join(out)
+
+
+def _render_inline_token(match) -> str:
+    kind = match.lastgroup
+    if kind == 'command':
+        return LATEX_COMMANDS.get(match.group('name'), '')
+    if kind == 'drop':
+        return ''
+    if kind == 'escape':
+        return HTML_ESCAPES[match.group()]
+    if kind == 'sup':
+        sup = match.group('sup_digit') or render_inline(match.group('sup_text'))
+        return sup.translate(SUPERSCRIPTS)
+    if kind == 'sub':
+        return render_inline(match.group('sub_text')).translate(SUBSCRIPTS)
+    if kind == 'frac':
+        return f"({render_inline(match.group('numerator'))}/{render_inline(match.group('denominator'))})"
+    if kind == 'sqrt':
+        return f"√({render_inline(match.group('radicand'))})"
+    if kind == 'text':
+        return render_inline(match.group('plain'))
+    if kind == 'delimiter':
+        return match.group('bracket') or ''
+    return match.group()
+
+
+def format_ai_response(text: str) -> str:
+    """Форматировать ответ AI для красивого отображения в Telegram (HTML)"""
+    out = []
+    position = 0
+    length = len(text)
+    newlines = 0  # Переводы строк перед заголовком копятся и выводятся не более двух подряд
+    heading_end = None  # Конец строки текущего заголовка
+    bold_open = False
+
+    def start_line():
+        """Заголовок или пункт списка в начале строки"""
+        nonlocal position, newlines, heading_end
+        match = LINE_START_PATTERN.match(text, position)
+        if match is None:
+            return
+        position = match.end()
+        level = match.group('level')
+        if level:
+            newlines += 1
+            marker = HEADINGS[len(level)]
+            heading_end = text.find('\n', position)
+            if heading_end == -1:
+                heading_end = length
+        else:
+            marker = '  • '
+        if newlines:
+            if out:
+                out.append('\n' * min(newlines, 2))
+            newlines = 0
+        out.append(marker)
+
+    search = BLOCK_PATTERN.search
+    start_line()
+    while True:
+        # Строку заголовка разбираем отдельно, чтобы после неё добавить пустую строку
+        end = heading_end if heading_end is not None else length
+        match = search(text, position, end)
+        if match is None:
+            if heading_end is None:
+                break
+            if newlines:
+                out.append('\n' * min(newlines, 2))
+                newlines = 0
+            out.append(text[position:heading_end])
+            position = heading_end
+            while position < length and text[position] == '\n':
+                position += 1
+            newlines = position - heading_end + 1
+            heading_end = None
+            start_line()
+            continue
+
+        start = match.start()
+        if newlines:
+            if out:
+                out.append('\n' * min(newlines, 2))
+            newlines = 0
+        if start > position:
+            out.append(text[position:start])
+        position = match.end()
+        kind = match.lastgroup
+
+        if kind == 'drop':
+            pass
+        elif kind == 'newlines':
+            newlines = position - start
+            start_line()
+        elif kind == 'bold':
+            if bold_open:
+                out.append('</b>')
+                bold_open = False
+            else:
+                line_end = text.find('\n', position)
+                if text.find('**', position, line_end if line_end != -1 else length) != -1:
+                    out.append('<b>')
+                    bold_open = True
+                else:
+                    out.append('**')
+        elif kind == 'fence':
+            if bold_open:
+                out.append('</b>')
+                bold_open = False
+            code = escape_html(match.group('code'))
+            lang = match.group('lang')
+            if lang:
+                out.append(f'<pre><code class="language-{lang}">{code}</code></pre>')
+            else:
+                out.append(f'<pre>{code}</pre>')
+        elif kind == 'inline_code':
+            out.append(f"<code>{escape_html(match.group('inline'))}</code>")
+        else:
+            out.append(_render_inline_token(match))
+
+    if newlines and position < length:
+        out.append('\n' * min(newlines, 2))
+    out.append(text[position:])
+    if bold_open:
+        out.append('</b>')
+
+    return ''.join(out).strip()
+
+
+_HTML_TAG = re.compile(r'<pre><code class="language-(\w+)">|<pre>|</code></pre>|</pre>|</?code>|<[^>]+>')
+
+
+def html_to_text(text: str) -> str:
+    """Обратное преобразование HTML ответа в обычный текст (для файла и отправки без разметки)"""
+    def replace_tag(match):
+        tag = match.group()
+        if tag.startswith('<pre'):
+            return f"```{match.group(1) or ''}\n"
+        if tag.endswith('</pre>'):
+            return '```'
+        if tag in ('<code>', '</code>'):
+            return '`'
+        return ''
+
+    return html.unescape(_HTML_TAG.sub(replace_tag, text))
+
+
+# === РАЗБИВКА НА СООБЩЕНИЯ ===
+_HTML_TOKEN = re.compile(r'<[^>]*>|&(?:#\d+|#x[0-9a-fA-F]+|[a-zA-Z]+);|[^<&]+|[<&]')
+_TAG_NAME = re.compile(r'</?\s*([a-zA-Z0-9-]+)')
+_ASTRAL = re.compile('[\U00010000-\U0010ffff]')  # Символы из двух UTF-16 единиц
+
+
+def utf16_length(text: str) -> int:
+    """Длина текста так, как её считает Telegram"""
+    return len(text) + len(_ASTRAL.findall(text))
+
+
+class MessageSplitter:
+    """Разбивка текста или HTML на части не длиннее limit за один проход
+
+    Длина считается в UTF-16 единицах видимого текста: теги не учитываются,
+    сущность (&amp;) - один символ. Части режутся по последнему переводу строки,
+    иначе по пробелу, если он не слишком близко к началу части, иначе по limit.
+    Сущности не разрываются, а открытые теги (<pre>, <code>, <b>)
+    закрываются в конце части и заново открываются в следующей.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.parts = []
+        self.stack = []  # Открытые теги: (имя, исходный тег)
+        self._start_part()
+
+    def _start_part(self):
+        self.prefix = ''.join(raw for _, raw in self.stack)
+        self.tokens = []  # (вид, текст) текущей части
+        self.length = 0
+        self.newline_break = None  # Последние места разрыва: (номер токена, смещение, длина до него, теги)
+        self.space_break = None
+        self.at_start = True
+
+    def _in_pre(self) -> bool:
+        return any(name == 'pre' for name, _ in self.stack)
+
+    def _flush(self, tokens: list, length: int, stack: list):
+        """Закрыть часть из tokens и начать следующую с тегами stack"""
+        if length:
+            closing = ''.join(f'</{name}>' for name, _ in reversed(stack))
+            self.parts.append(self.prefix + ''.join(text for _, text in tokens) + closing)
+        self.stack = list(stack)
+        self._start_part()
+
+    def _usable(self, point) -> bool:
+        """Место разрыва не слишком близко к началу части"""
+        return point is not None and point[2] >= self.limit // 2
+
+    def _cut_at(self, point):
+        """Закрыть часть по запомненному месту разрыва, остаток перенести в следующую"""
+        index, offset, length, stack = point
+        tokens = self.tokens
+        kind, text = tokens[index]
+        head = tokens[:index] + [(kind, text[:offset])]
+        tail = [(kind, text[offset + 1:])] + tokens[index + 1:]
+        self._flush(head, length, stack)
+        for kind, text in tail:
+            if kind == 'text':
+                self.feed_text(text)
+            elif kind == 'tag':
+                self.feed_tag(text)
+            else:
+                self.feed_entity(text)
+
+    def feed_tag(self, raw: str):
+        self.tokens.append(('tag', raw))
+        match = _TAG_NAME.match(raw)
+        if match is None:
+            return
+        name = match.group(1).lower()
+        if raw.startswith('</'):
+            for i in range(len(self.stack) - 1, -1, -1):
+                if self.stack[i][0] == name:
+                    del self.stack[i]
+                    break
+        elif not raw.endswith('/>'):
+            self.stack.append((name, raw))
+
+    def feed_entity(self, raw: str):
+        if self.length + 1 > self.limit:
+            if self._usable(self.newline_break):
+                self._cut_at(self.newline_break)
+            elif self._usable(self.space_break):
+                self._cut_at(self.space_break)
+            else:
+                self._flush(self.tokens, self.length, self.stack)
+        self.tokens.append(('entity', raw))
+        self.length += 1
+        self.at_start = False
+
+    def feed_text(self, text: str):
+        astral = [match.start() for match in _ASTRAL.finditer(text)]
+        start, end = 0, len(text)
+        half = self.limit // 2
+
+        def units(a: int, b: int) -> int:
+            if not astral:
+                return b - a
+            return b - a + bisect_left(astral, b) - bisect_left(astral, a)
+
+        while start < end:
+            if self.at_start and not self._in_pre():
+                # Пробелы в начале части не показываются, пропускаем их
+                while start < end and text[start] in ' \n\t':
+                    start += 1
+                if start == end:
+                    return
+
+            room = self.limit - self.length
+            if units(start, end) <= room:
+                self._append_text(text[start:end])
+                return
+
+            # Сколько символов помещается в оставшееся место
+            cut = min(end, start + room)
+            while cut > start and units(start, cut) > room:
+                cut -= 1
+            if cut == start and not self.length:
+                cut = start + 1  # Символ длиннее лимита - не зацикливаемся
+
+            # Ищем разрыв: перевод строки в этом фрагменте или раньше в части, затем пробел
+            position = text.rfind('\n', start, cut + 1)
+            if position == -1 or self.length + units(start, position) < half:
+                if self._usable(self.newline_break):
+                    self._cut_at(self.newline_break)
+                    continue
+                position = text.rfind(' ', start, cut + 1)
+                if position == -1 or self.length + units(start, position) < half:
+                    if self._usable(self.space_break):
+                        self._cut_at(self.space_break)
+                        continue
+                    position = -1
+
+            if position != -1:
+                # Символ, по которому режем, в части не остаётся
+                self._append_text(text[start:position])
+                start = position + 1
+            else:
+                self._append_text(text[start:cut])
+                start = cut
+            self._flush(self.tokens, self.length, self.stack)
+
+    def _append_text(self, text: str):
+        if not text:
+            return
+        index = len(self.tokens)
+        newline = text.rfind('\n')
+        space = text.rfind(' ')
+        if newline != -1:
+            self.newline_break = (index, newline, self.length + utf16_length(text[:newline]), list(self.stack))
+        if space != -1:
+            self.space_break = (index, space, self.length + utf16_length(text[:space]), list(self.stack))
+        self.tokens.append(('text', text))
+        self.length += utf16_length(text)
+        self.at_start = False
+
+    def finish(self) -> list:
+        if self.length:
+            self._flush(self.tokens, self.length, self.stack)
+        return self.parts
+
+
+def split_message(text: str, limit: int, is_html: bool = False) -> list:
+    """Разбить сообщение на части не длиннее limit (в UTF-16, как считает Telegram)"""
+    if is_html:
+        if len(text) <= limit and utf16_length(text) <= limit:
+            return [text]
+        splitter = MessageSplitter(limit)
+        for match in _HTML_TOKEN.finditer(text):
+            token = match.group()
+            if token[0] == '<' and len(token) > 1:
+                splitter.feed_tag(token)
+            elif token[0] == '&' and len(token) > 1:
+                splitter.feed_entity(token)
+            else:
+                splitter.feed_text(token)
+    else:
+        if utf16_length(text) <= limit:
+            return [text]
+        splitter = MessageSplitter(limit)
+        splitter.feed_text(text)
+    return splitter.finish()
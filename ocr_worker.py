@@ -0,0 +1,184 @@
+"""Распознавание текста с изображений в отдельных процессах
+
+Модуль импортируется дочерними процессами пула, поэтому не зависит от bot.py
+и не подключает aiogram.
+"""
+import io
+import os
+import shutil
+
+from PIL import Image, ImageOps
+import pytesseract
+
+# Настройка пути к Tesseract
+if os.name == 'nt':  # Windows
+    # Проверяем стандартные пути установки Tesseract
+    possible_paths = [
+        r'C:\Program Files\Tesseract-OCR\tesseract.exe',
+        r'C:\Program Files (x86)\Tesseract-OCR\tesseract.exe',
+        r'C:\Tesseract-OCR\tesseract.exe'
+    ]
+    for path in possible_paths:
+        if os.path.exists(path):
+            pytesseract.pytesseract.tesseract_cmd = path
+            break
+else:
+    # На Linux (Railway, Heroku и т.д.) Tesseract устанавливается через apt
+    # и доступен в PATH, поэтому явно указывать путь не нужно
+    pass
+
+MAX_SIDE = 2000  # Большие фото уменьшаем: точность не растёт, а время растёт квадратично
+MIN_SIDE = 600  # Мелкие скриншоты увеличиваем, чтобы буквы были не меньше ~20px
+HASH_SIZE = 8  # Сторона сетки dHash: 8x8 = 64 бита
+DETAIL_HASH_SIZE = 16  # Сторона сетки проверочного dHash: 16x16 = 256 бит
+HASH_DISTANCE = 3  # Максимум различающихся бит dHash у "того же" изображения
+DETAIL_DISTANCE = 16  # Максимум различающихся бит проверочного dHash (из 256)
+ASPECT_TOLERANCE = 0.02  # Допустимое относительное отличие соотношения сторон
+
+_languages = None  # Языки Tesseract, определяются один раз на процесс
+
+
+def tesseract_available() -> bool:
+    """Проверка, что Tesseract установлен"""
+    cmd = pytesseract.pytesseract.tesseract_cmd
+    return bool(shutil.which(cmd) or os.path.exists(cmd))
+
+
+def get_language() -> str:
+    """Лучший доступный набор языков: rus+eng, eng или язык по умолчанию"""
+    global _languages
+    if _languages is None:
+        try:
+            _languages = set(pytesseract.get_languages(config=''))
+        except Exception:
+            _languages = set()
+    wanted = [lang for lang in ("rus", "eng") if lang in _languages]
+    return "+".join(wanted) if wanted else None
+
+
+def open_image(image_bytes: bytes) -> Image.Image:
+    """Декодировать изображение, повернуть по EXIF и перевести в оттенки серого"""
+    image = Image.open(io.BytesIO(image_bytes))
+    return ImageOps.exif_transpose(image).convert('L')
+
+
+def prepare_image(image: Image.Image) -> Image.Image:
+    """Масштаб под OCR и бинаризация"""
+    # Приводим размер к разумному для Tesseract
+    longest = max(image.size)
+    if longest > MAX_SIDE:
+        scale = MAX_SIDE / longest
+    elif longest < MIN_SIDE:
+        scale = MIN_SIDE / longest
+    else:
+        scale = 1
+    if scale != 1:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+
+    # Растягиваем контраст и переводим в чёрно-белое по порогу Оцу
+    image = ImageOps.autocontrast(image, cutoff=1)
+    threshold = otsu_threshold(image.histogram())
+    return image.point(lambda p: 255 if p > threshold else 0, mode='1')
+
+
+def otsu_threshold(histogram: list) -> int:
+    """Порог бинаризации по методу Оцу"""
+    total = sum(histogram)
+    if not total:
+        return 127
+    sum_all = sum(i * count for i, count in enumerate(histogram))
+    sum_background = 0
+    weight_background = 0
+    best_threshold, best_variance = 127, 0.0
+    for i, count in enumerate(histogram):
+        weight_background += count
+        if weight_background == 0:
+            continue
+        weight_foreground = total - weight_background
+        if weight_foreground == 0:
+            break
+        sum_background += i * count
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = i, variance
+    return best_threshold
+
+
+def recognize(image_bytes: bytes, timeout: float, known: dict = None) -> dict:
+    """Распознать текст на изображении (выполняется в процессе пула)
+
+    Изображение декодируется один раз: по нему же считается отпечаток. Если он
+    совпал с одним из known ({ключ: отпечаток} уже распознанных изображений),
+    OCR не запускается и возвращается ключ похожего изображения (similar).
+
+    timeout передаётся Tesseract: по его истечении процесс tesseract
+    завершается, и воркер освобождается для следующей задачи.
+    """
+    try:
+        image = open_image(image_bytes)
+    except Exception as e:
+        return {"success": False, "error": f"Не удалось открыть изображение: {e}"}
+
+    image_fingerprint = fingerprint(image)
+    similar = closest(image_fingerprint, known or {})
+    if similar is not None:
+        return {"success": True, "similar": similar, "fingerprint": image_fingerprint}
+
+    if not tesseract_available():
+        return {"success": False, "error": "tesseract_missing"}
+
+    try:
+        text = pytesseract.image_to_string(prepare_image(image), lang=get_language(), timeout=timeout)
+    except RuntimeError as e:
+        if "timeout" in str(e).lower():
+            return {"success": False, "error": "timeout"}
+        return {"success": False, "error": str(e)}
+    except pytesseract.TesseractNotFoundError:
+        return {"success": False, "error": "tesseract_missing"}
+    except pytesseract.TesseractError as e:
+        return {"success": False, "error": str(e)}
+
+    return {"success": True, "text": text.strip(), "fingerprint": image_fingerprint}
+
+
+def dhash(image: Image.Image, size: int) -> int:
+    """dHash: size x size бит, сравнение соседних пикселей по строкам"""
+    pixels = list(image.resize((size + 1, size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def fingerprint(image: Image.Image) -> dict:
+    """Перцептивные хэши для поиска повторно присланных изображений
+
+    hash (64 бита) - для отбора кандидатов, detail (256 бит) - для проверки,
+    aspect - соотношение сторон.
+    """
+    # Хэши считаются по уменьшенной копии: сжатие BOX быстрое и не даёт шума
+    small = image.resize((DETAIL_HASH_SIZE * 4, DETAIL_HASH_SIZE * 4), Image.BOX)
+    return {
+        "hash": dhash(small, HASH_SIZE),
+        "detail": dhash(small, DETAIL_HASH_SIZE),
+        "aspect": image.width / image.height,
+    }
+
+
+def closest(image_fingerprint: dict, known: dict):
+    """Ключ самого похожего из known изображения или None"""
+    best_key, best_distance = None, HASH_DISTANCE + 1
+    for key, candidate in known.items():
+        distance = bin(candidate["hash"] ^ image_fingerprint["hash"]).count("1")
+        if distance >= best_distance:
+            continue
+        if abs(candidate["aspect"] - image_fingerprint["aspect"]) > ASPECT_TOLERANCE * image_fingerprint["aspect"]:
+            continue
+        if bin(candidate["detail"] ^ image_fingerprint["detail"]).count("1") <= DETAIL_DISTANCE:
+            best_key, best_distance = key, distance
+    return best_key
@@ -0,0 +1,106 @@
+"""Подготовка текста для полнотекстового поиска по истории (SQLite FTS5)
+
+В индекс попадают не слова, а их основы: лёгкий стеммер отбрасывает
+русские и английские окончания, поэтому "борщ", "борща" и "борщом" находятся
+одним запросом. Тот же стеммер применяется к запросу. Каждая основа
+записывается с префиксом владельца (u123_борщ): поиск идёт только по словам
+самого пользователя, и его время зависит от размера его истории, а не от
+того, насколько слово частое у всех. Модуль не зависит от aiogram и от базы.
+"""
+import html
+import re
+
+WORD = re.compile(r"\w+")
+MIN_STEM = 3  # Короче основа не обрезается
+MAX_QUERY_TERMS = 8  # Слов запроса, остальные отбрасываются
+MIN_PREFIX = 3  # Основы от этой длины ищутся как префиксы (короткий префикс совпадает почти со всем)
+
+# Окончания по убыванию длины: отрезается самое длинное подходящее
+RUSSIAN_REFLEXIVE = ("ся", "сь")
+RUSSIAN_ENDINGS = tuple(sorted({
+    # Прилагательные и причастия
+    "ими", "ыми", "его", "ого", "ему", "ому", "ее", "ие", "ые", "ое", "ей", "ий", "ый", "ой", "ем", "им", "ым",
+    "ом", "их", "ых", "ую", "юю", "ая", "яя", "ею", "ою",
+    "ивш", "ывш", "ующ", "ащ", "ящ", "ущ", "ющ",
+    # Глаголы
+    "ла", "на", "ете", "йте", "ли", "ло", "но", "ет", "ют", "ны", "ть", "ешь", "нно", "ила", "ыла", "ена",
+    "ейте", "уйте", "ите", "или", "ыли", "ило", "ыло", "ено", "ят", "ует", "уют", "ит", "ыт", "ены",
+    "ить", "ыть", "ишь", "ать", "ять", "ал", "ял", "ил", "ыл",
+    # Существительные
+    "а", "ев", "ов", "ье", "е", "иями", "ями", "ами", "еи", "ии", "и", "ией", "иям", "ям", "ием", "ам",
+    "о", "у", "ах", "иях", "ях", "ы", "ь", "ию", "ью", "ю", "ия", "ья", "я", "й",
+    # Словообразование
+    "ость", "ост", "ейше", "ейш",
+}, key=len, reverse=True))
+ENGLISH_ENDINGS = (
+    "ational", "ization", "fulness", "ousness", "iveness", "ations", "ation", "ments", "ment", "ness",
+    "ings", "ing", "edly", "ies", "ied", "ers", "er", "ed", "es", "ly", "s",
+)
+
+
+def is_cyrillic(word: str) -> bool:
+    return any("а" <= char <= "я" for char in word)
+
+
+def strip_ending(word: str, endings: tuple) -> str:
+    for ending in endings:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def stem(word: str) -> str:
+    """Основа слова (слово уже в нижнем регистре)"""
+    if len(word) <= MIN_STEM or word.isdigit():
+        return word
+    if is_cyrillic(word):
+        word = word.replace("ё", "е")
+        word = strip_ending(word, RUSSIAN_REFLEXIVE)
+        return strip_ending(word, RUSSIAN_ENDINGS)
+    if word.endswith("ss"):
+        return word
+    return strip_ending(word, ENGLISH_ENDINGS)
+
+
+def index_terms(text: str, owner: str) -> str:
+    """Основы всех слов текста с префиксом владельца через пробел - то, что записывается в индекс"""
+    return " ".join(f"{owner}_{stem(word)}" for word in WORD.findall(text.lower()))
+
+
+def query_stems(query: str) -> list:
+    """Основы слов запроса без повторов (однобуквенные слова - предлоги, союзы - пропускаются)"""
+    stems = dict.fromkeys(stem(word) for word in WORD.findall(query.lower()) if len(word) > 1)
+    return list(stems)[:MAX_QUERY_TERMS]
+
+
+def match_expression(owner: str, stems: list) -> str:
+    """Выражение FTS5: все основы среди сообщений владельца"""
+    terms = " ".join(
+        f'"{owner}_{term}"*' if len(term) >= MIN_PREFIX else f'"{owner}_{term}"' for term in stems
+    )
+    return f'terms : ({terms})'
+
+
+def snippet(content: str, stems: list, width: int = 160) -> str:
+    """Фрагмент сообщения вокруг первого совпадения, совпадения выделены (HTML)"""
+    matches = [
+        match for match in WORD.finditer(content)
+        if any(stem(match.group().lower()).startswith(term) for term in stems)
+    ]
+    if not matches:
+        text = content[:width]
+        return html.escape(text, quote=False) + ("…" if len(content) > width else "")
+
+    start = max(0, matches[0].start() - width // 3)
+    end = min(len(content), start + width)
+    parts = ["…" if start else ""]
+    position = start
+    for match in matches:
+        if match.start() < start or match.end() > end:
+            continue
+        parts.append(html.escape(content[position:match.start()], quote=False))
+        parts.append(f"<b>{html.escape(match.group(), quote=False)}</b>")
+        position = match.end()
+    parts.append(html.escape(content[position:end], quote=False))
+    parts.append("…" if end < len(content) else "")
+    return " ".join("".join(parts).split())
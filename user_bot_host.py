@@ -0,0 +1,355 @@
+"""Общий процесс для пользовательских ботов
+
+Вместо отдельного процесса на каждого бота (и отдельного импорта aiogram)
+один процесс-хост загружает код нескольких ботов в изолированные модули
+и запускает их на одном цикле событий. Хостов несколько: бот попадает
+в хост номер crc32(bot_id) % workers.
+
+Хост сам следит за базой: запускает ботов с is_running = 1, останавливает
+остальных и перезапускает бота, если его файл изменился. Поэтому запуск
+и остановка из главного бота - это только запись в базу. Бота, который
+падает раз за разом, хост останавливает и оставляет в bot_notifications
+запись, по которой главный бот уведомляет владельца.
+
+Изоляции между ботами хоста нет: общие память, лимиты процесса и цикл
+событий, поэтому бот, блокирующий цикл, задерживает соседей. Для кода,
+которому нельзя доверять, нужен режим USER_BOT_RUNTIME=process.
+
+    python user_bot_host.py --worker 0 --workers 2 --db bot_data.db --bots-dir user_bots
+"""
+import argparse
+import ast
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import signal
+import sqlite3
+import sys
+import time
+import types
+import zlib
+from datetime import datetime
+
+from aiogram import Bot, Dispatcher
+
+POLL_INTERVAL = 1  # Проверка базы, секунд: с такой задержкой применяются запуск и остановка
+STOP_TIMEOUT = 5  # Ожидание завершения бота при остановке
+RESTART_DELAY = 5  # Первая пауза перед перезапуском упавшего бота
+RESTART_MAX_DELAY = 300  # Максимальная пауза перед перезапуском
+MAX_CRASHES = 5  # Падений подряд, после которых бот останавливается
+STABLE_AFTER = 60  # Проработав столько секунд, бот считается стабильным
+LOG_MAX_BYTES = 1024 * 1024  # Размер лога бота до ротации
+LOG_BACKUPS = 3  # Сколько старых логов хранить
+
+current_bot = contextvars.ContextVar("current_bot", default=None)  # Бот, в чьей задаче пишется лог
+
+# Вызовы запуска на верхнем уровне модуля: (объект, метод). run_polling - у любого Dispatcher
+ENTRY_CALLS = {("asyncio", "run"), ("executor", "start_polling")}
+
+
+def is_entry_point(node: ast.stmt) -> bool:
+    """asyncio.run(...), executor.start_polling(...), dp.run_polling(...) или блок
+    if __name__ == "__main__" на верхнем уровне модуля"""
+    if isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+        func = node.value.func
+        if not isinstance(func, ast.Attribute) or not isinstance(func.value, ast.Name):
+            return False
+        return (func.value.id, func.attr) in ENTRY_CALLS or func.attr == "run_polling"
+    if isinstance(node, ast.If) and isinstance(node.test, ast.Compare):
+        names = [node.test.left, *node.test.comparators]
+        return any(isinstance(item, ast.Name) and item.id == "__name__" for item in names)
+    return False
+
+
+def load_module(bot_id: str, path: str, print_func) -> types.ModuleType:
+    """Выполнить код бота в отдельном модуле, не запуская его"""
+    with open(path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+    tree.body = [node for node in tree.body if not is_entry_point(node)]
+
+    module = types.ModuleType(f"user_bot_{bot_id}")
+    module.__file__ = path
+    module.print = print_func
+    exec(compile(tree, path, "exec"), module.__dict__)
+    return module
+
+
+def entry_point(module: types.ModuleType):
+    """Корутина запуска бота: его main() или polling найденных Dispatcher и Bot"""
+    main = getattr(module, "main", None)
+    if inspect.iscoroutinefunction(main):
+        return main()
+    values = list(vars(module).values())
+    dp = next((value for value in values if isinstance(value, Dispatcher)), None)
+    bot = next((value for value in values if isinstance(value, Bot)), None)
+    if dp is None or bot is None:
+        raise RuntimeError("В коде бота нет main() и пары Dispatcher/Bot")
+    return dp.start_polling(bot)
+
+
+def rotate_log(path: str):
+    """Переименовать разросшийся лог в path.1, path.2, ..."""
+    for i in range(LOG_BACKUPS - 1, 0, -1):
+        if os.path.exists(f"{path}.{i}"):
+            os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+    os.replace(path, f"{path}.1")
+
+
+class TenantLogHandler(logging.Handler):
+    """Записи logging из задач бота - в его лог, остальные - в вывод хоста"""
+
+    def __init__(self, host: "UserBotHost"):
+        super().__init__()
+        self.host = host
+        self.fallback = logging.StreamHandler(sys.stderr)
+
+    def emit(self, record: logging.LogRecord):
+        tenant = self.host.tenants.get(current_bot.get())
+        if tenant is None:
+            self.fallback.handle(record)
+            return
+        tenant.write(self.format(record) + "\n")
+
+
+class Tenant:
+    """Пользовательский бот внутри хоста"""
+
+    def __init__(self, bot_id: str, user_id: int, path: str, log_path: str):
+        self.bot_id = bot_id
+        self.user_id = user_id
+        self.path = path
+        self.log_path = log_path
+        self.mtime = None
+        self.task = None
+        self.started_at = 0
+        self.crashes = 0
+        self.restart_at = 0
+        self.log = None
+
+    def write(self, text: str):
+        if self.log is None:
+            self.log = open(self.log_path, 'a', encoding='utf-8')
+        self.log.write(text)
+        self.log.flush()
+        if self.log.tell() > LOG_MAX_BYTES:
+            self.log.close()
+            self.log = None
+            rotate_log(self.log_path)
+
+    def print(self, *args, sep=" ", end="\n", file=None, flush=False):
+        """print() в коде бота пишет в его лог"""
+        if file not in (None, sys.stdout, sys.stderr):
+            print(*args, sep=sep, end=end, file=file, flush=flush)
+            return
+        self.write((" " if sep is None else sep).join(map(str, args)) + ("\n" if end is None else end))
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+class UserBotHost:
+    """Запуск и остановка ботов своей доли по состоянию в базе"""
+
+    def __init__(self, db_path: str, bots_dir: str, worker: int, workers: int):
+        self.db_path = db_path
+        self.bots_dir = bots_dir
+        self.log_dir = os.path.join(bots_dir, "logs")
+        self.worker = worker
+        self.workers = workers
+        self.tenants = {}
+
+    def owns(self, bot_id: str) -> bool:
+        return zlib.crc32(bot_id.encode()) % self.workers == self.worker
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def wanted(self) -> dict:
+        """Боты этого хоста, которые должны работать"""
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT bot_id, user_id FROM bots WHERE is_running = 1").fetchall()
+        finally:
+            conn.close()
+        return {row["bot_id"]: row["user_id"] for row in rows if self.owns(row["bot_id"])}
+
+    def give_up(self, tenant: Tenant):
+        """Бот падает раз за разом - снимаем отметку о запуске и просим уведомить владельца"""
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("UPDATE bots SET is_running = 0 WHERE bot_id = ?", (tenant.bot_id,))
+                conn.execute(
+                    "INSERT INTO bot_notifications (user_id, bot_id, crashes, created_at) VALUES (?, ?, ?, ?)",
+                    (tenant.user_id, tenant.bot_id, tenant.crashes, datetime.now().isoformat())
+                )
+        finally:
+            conn.close()
+
+    async def start(self, tenant: Tenant):
+        """Загрузить код бота и запустить его задачу"""
+        tenant.mtime = os.path.getmtime(tenant.path)
+        tenant.started_at = time.monotonic()
+        token = current_bot.set(tenant.bot_id)
+        try:
+            tenant.write(f"\n=== Запуск в хосте {self.worker} ===\n")
+            module = load_module(tenant.bot_id, tenant.path, tenant.print)
+            # Задача наследует контекст, поэтому логи бота попадают в его файл
+            tenant.task = asyncio.create_task(entry_point(module))
+        except Exception as e:
+            tenant.write(f"Ошибка загрузки: {e!r}\n")
+            tenant.task = None
+        finally:
+            current_bot.reset(token)
+        if tenant.task is None:
+            self.crashed(tenant)
+        else:
+            logging.info(f"Бот {tenant.bot_id} запущен")
+
+    async def stop(self, tenant: Tenant):
+        """Остановить задачу бота; сессия Bot закрывается в start_polling"""
+        task = tenant.task
+        if task is not None:
+            if not task.done():
+                task.cancel()
+                await asyncio.wait([task], timeout=STOP_TIMEOUT)
+            # Забираем ошибку задачи, иначе asyncio напишет "Task exception was never
+            # retrieved" в вывод хоста, а не в лог бота
+            if task.done():
+                self.finished(tenant, task)
+            else:
+                task.add_done_callback(lambda done: self.finished(tenant, done, close=True))
+        tenant.task = None
+        logging.info(f"Бот {tenant.bot_id} остановлен")
+
+    @staticmethod
+    def finished(tenant: Tenant, task: asyncio.Task, close: bool = False):
+        """Записать в лог бота ошибку, с которой завершилась остановленная задача
+
+        close - задача завершилась уже после остановки, бот мог быть удалён из хоста:
+        не оставляем его лог открытым.
+        """
+        if not task.cancelled() and task.exception() is not None:
+            tenant.write(f"Бот завершился: {task.exception()!r}\n")
+            if close:
+                tenant.close()
+
+    def crashed(self, tenant: Tenant):
+        """Запланировать перезапуск с растущей паузой"""
+        tenant.crashes += 1
+        delay = min(RESTART_MAX_DELAY, RESTART_DELAY * 2 ** (tenant.crashes - 1))
+        tenant.restart_at = time.monotonic() + delay
+        logging.warning(f"Бот {tenant.bot_id} упал, падение {tenant.crashes} подряд")
+
+    async def reconcile(self):
+        """Сверить запущенных ботов с базой"""
+        wanted = self.wanted()
+        now = time.monotonic()
+
+        for bot_id in list(self.tenants):
+            if bot_id not in wanted:
+                tenant = self.tenants.pop(bot_id)
+                await self.stop(tenant)
+                tenant.close()
+
+        for bot_id, user_id in wanted.items():
+            tenant = self.tenants.get(bot_id)
+            if tenant is None:
+                path = os.path.join(self.bots_dir, f"bot_{user_id}_{bot_id}.py")
+                if not os.path.exists(path):
+                    continue
+                tenant = Tenant(bot_id, user_id, path, os.path.join(self.log_dir, f"bot_{user_id}_{bot_id}.log"))
+                self.tenants[bot_id] = tenant
+                await self.start(tenant)
+                continue
+
+            # Файл бота переписан (редактирование) - перезапускаем с новым кодом
+            try:
+                changed = os.path.getmtime(tenant.path) != tenant.mtime
+            except OSError:
+                continue
+            if changed:
+                await self.stop(tenant)
+                tenant.crashes = 0
+                await self.start(tenant)
+                continue
+
+            if tenant.task is not None and tenant.task.done():
+                error = None if tenant.task.cancelled() else tenant.task.exception()
+                tenant.write(f"Бот завершился: {error!r}\n")
+                tenant.task = None
+                self.crashed(tenant)
+            if tenant.task is None:
+                if tenant.crashes >= MAX_CRASHES:
+                    logging.error(f"Бот {bot_id} остановлен после {tenant.crashes} падений подряд")
+                    self.give_up(tenant)
+                elif now >= tenant.restart_at:
+                    await self.start(tenant)
+            elif now - tenant.started_at > STABLE_AFTER:
+                tenant.crashes = 0
+
+    async def run(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        stopping = asyncio.Event()
+        if os.name != 'nt':
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stopping.set)
+
+        logging.info(f"Хост ботов {self.worker}/{self.workers} запущен")
+        while not stopping.is_set():
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logging.error(f"Ошибка хоста ботов: {e}")
+            try:
+                await asyncio.wait_for(stopping.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+        for tenant in self.tenants.values():
+            await self.stop(tenant)
+            tenant.close()
+
+
+def patch_dispatcher():
+    """Боты делят цикл событий: обработку сигналов оставляем хосту"""
+    start_polling = Dispatcher.start_polling
+
+    @functools.wraps(start_polling)
+    async def start_polling_without_signals(self, *bots, **kwargs):
+        kwargs["handle_signals"] = False
+        return await start_polling(self, *bots, **kwargs)
+
+    Dispatcher.start_polling = start_polling_without_signals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--worker", type=int, required=True, help="Номер хоста, с нуля")
+    parser.add_argument("--workers", type=int, required=True, help="Всего хостов")
+    parser.add_argument("--db", default="bot_data.db")
+    parser.add_argument("--bots-dir", default="user_bots")
+    args = parser.parse_args()
+
+    host = UserBotHost(args.db, args.bots_dir, args.worker, args.workers)
+    handler = TenantLogHandler(host)
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    handler.setFormatter(formatter)
+    handler.fallback.setFormatter(formatter)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    patch_dispatcher()
+    asyncio.run(host.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Долговременная память чата: поиск похожих старых сообщений
+
+Сообщения переводятся в векторы хэширующим векторизатором (без обучения
+и внешних моделей): слова, их буквенные триграммы (совпадают у разных форм
+слова: "борщ" и "борща") и пары соседних слов раскладываются по DIM ячейкам хэшем. Векторы
+пользователя лежат в одной матрице NumPy float32, поиск - одно умножение
+матрицы на вектор запроса. Модуль не зависит от aiogram.
+"""
+import json
+import logging
+import math
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+DIM = 1024  # Размер вектора: 4 КБ на сообщение
+TRIGRAM_WEIGHT = 0.5  # Вес триграмм относительно целых слов
+MAX_TEXT = 4000  # Символов сообщения, по которым строится вектор
+INITIAL_CAPACITY = 64  # Строк матрицы при создании, дальше удваивается
+
+WORD = re.compile(r"\w+")
+
+
+def features(text: str) -> dict:
+    """Признаки текста с весами: слова, триграммы слов и пары слов"""
+    words = WORD.findall(text[:MAX_TEXT].lower().replace("ё", "е"))
+    counts = {}
+    previous = None
+    for word in words:
+        counts[word] = counts.get(word, 0) + 1
+        if len(word) > 3:
+            marked = f"<{word}>"
+            for i in range(len(marked) - 2):
+                trigram = "#" + marked[i:i + 3]
+                counts[trigram] = counts.get(trigram, 0) + TRIGRAM_WEIGHT
+        if previous is not None:
+            pair = previous + " " + word
+            counts[pair] = counts.get(pair, 0) + 1
+        previous = word
+    return counts
+
+
+def embed(text: str) -> np.ndarray:
+    """Нормированный вектор текста (нулевой, если слов нет)"""
+    vector = np.zeros(DIM, dtype=np.float32)
+    for feature, weight in features(text).items():
+        digest = zlib.crc32(feature.encode('utf-8'))
+        sign = 1.0 if digest & 0x80000000 else -1.0  # Знак из старшего бита гасит коллизии
+        vector[digest % DIM] += sign * math.log1p(weight)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+class UserIndex:
+    """Векторы и сообщения одного пользователя"""
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self.vectors = np.zeros((INITIAL_CAPACITY, DIM), dtype=np.float32)
+        self.messages = []  # {"role", "content", "timestamp"} в порядке добавления
+        self.dirty = False
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def add(self, message: dict, vector: np.ndarray):
+        size = len(self.messages)
+        if size >= self.max_items:
+            # Самая старая половина вытесняется разом, чтобы не сдвигать матрицу на каждой записи
+            keep = self.max_items // 2
+            self.vectors[:keep] = self.vectors[size - keep:size]
+            self.messages = self.messages[size - keep:]
+            size = keep
+        if size >= len(self.vectors):
+            grown = np.zeros((min(len(self.vectors) * 2, self.max_items), DIM), dtype=np.float32)
+            grown[:size] = self.vectors[:size]
+            self.vectors = grown
+        self.vectors[size] = vector
+        self.messages.append(message)
+        self.dirty = True
+
+    def search(self, query: np.ndarray, limit: int, min_score: float, before: str = None) -> list:
+        """Самые похожие сообщения (старше before), по убыванию сходства"""
+        size = len(self.messages)
+        if not size:
+            return []
+        scores = self.vectors[:size] @ query
+        if before is not None:
+            # Сообщения добавлены по порядку - отсекаем хвост, который уже в контексте
+            cutoff = next((i for i in range(size - 1, -1, -1) if self.messages[i]["timestamp"] < before), -1) + 1
+            scores = scores[:cutoff]
+        if not len(scores):
+            return []
+        count = min(limit, len(scores))
+        best = np.argpartition(-scores, count - 1)[:count]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), self.messages[i]) for i in best if scores[i] >= min_score]
+
+    def snapshot(self) -> tuple:
+        """Копия данных для записи на диск без блокировки индекса"""
+        size = len(self.messages)
+        self.dirty = False
+        return self.vectors[:size].copy(), list(self.messages)
+
+    @staticmethod
+    def write(path: str, vectors: np.ndarray, messages: list):
+        with open(path + '.npy.tmp', 'wb') as f:
+            np.save(f, vectors)
+        with open(path + '.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump(messages, f, ensure_ascii=False)
+        os.replace(path + '.npy.tmp', path + '.npy')
+        os.replace(path + '.json.tmp', path + '.json')
+
+    @classmethod
+    def load(cls, path: str, max_items: int):
+        index = cls(max_items)
+        with open(path + '.json', 'r', encoding='utf-8') as f:
+            messages = json.load(f)
+        vectors = np.load(path + '.npy')
+        if len(vectors) != len(messages) or vectors.shape[1:] != (DIM,):
+            raise ValueError(f"повреждён индекс {path}")
+        index.vectors = np.zeros((max(INITIAL_CAPACITY, len(vectors)), DIM), dtype=np.float32)
+        index.vectors[:len(vectors)] = vectors
+        index.messages = messages
+        return index
+
+
+class VectorMemory:
+    """Индексы пользователей: в памяти - последние использованные, остальные на диске
+
+    Индекс пользователя, которого ещё нет на диске, строится из backfill(user_id) -
+    списка его старых сообщений. Изменения записываются на диск в save_dirty
+    (из фонового потока); вытесненные из памяти несохранённые индексы ждут
+    записи в _unsaved.
+
+    Все методы вызываются из потоков. Загрузка и построение индекса (чтение
+    архива, векторизация тысяч сообщений) идут под блокировкой пользователя,
+    а общая блокировка держится только на время работы со словарями, поэтому
+    холодный индекс одного пользователя не задерживает остальных.
+    """
+
+    USER_LOCKS = 256  # Блокировок пользователей (по хэшу id): постоянное число вместо словаря, который только растёт
+
+    def __init__(self, directory: str, max_items: int, max_users: int, backfill=None):
+        self.directory = directory
+        self.max_items = max_items
+        self.max_users = max_users
+        self.backfill = backfill
+        self._indexes = OrderedDict()
+        self._unsaved = {}
+        self._lock = threading.Lock()  # Только словари _indexes и _unsaved
+        self._user_locks = [threading.Lock() for _ in range(self.USER_LOCKS)]
+
+    def _path(self, user_id) -> str:
+        return os.path.join(self.directory, str(user_id))
+
+    def _user_lock(self, user_id) -> threading.Lock:
+        return self._user_locks[zlib.crc32(str(user_id).encode()) % self.USER_LOCKS]
+
+    def _index(self, user_id) -> UserIndex:
+        """Индекс пользователя (вызывается под его блокировкой)"""
+        user_id = str(user_id)
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None:
+                self._indexes.move_to_end(user_id)
+                return index
+            index = self._unsaved.pop(user_id, None)
+
+        path = self._path(user_id)
+        if index is None and os.path.exists(path + '.json'):
+            try:
+                index = UserIndex.load(path, self.max_items)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Индекс памяти {user_id} будет перестроен: {e}")
+        if index is None:
+            index = UserIndex(self.max_items)
+            for message in (self.backfill(user_id) if self.backfill else []):
+                index.add(message, embed(message["content"]))
+
+        with self._lock:
+            self._indexes[user_id] = index
+            while len(self._indexes) > self.max_users:
+                evicted_id, evicted = self._indexes.popitem(last=False)
+                # Индексом может прямо сейчас пользоваться другой поток - он изменит его уже после вытеснения
+                if evicted.dirty or self._user_lock(evicted_id).locked():
+                    self._unsaved[evicted_id] = evicted
+        return index
+
+    def add(self, user_id, message: dict):
+        """Добавить сообщение {"role", "content", "timestamp"}"""
+        vector = embed(message["content"])
+        with self._user_lock(user_id):
+            index = self._index(user_id)
+            # Новый индекс мог уже получить это сообщение из backfill
+            if index.messages and index.messages[-1]["timestamp"] >= message["timestamp"]:
+                return
+            index.add(message, vector)
+
+    def search(self, user_id, text: str, limit: int, min_score: float, before: str = None) -> list:
+        """Похожие старые сообщения: [(сходство, сообщение)]"""
+        query = embed(text)
+        if not query.any():
+            return []
+        with self._user_lock(user_id):
+            return self._index(user_id).search(query, limit, min_score, before)
+
+    def clear(self, user_id):
+        """Удалить память пользователя"""
+        user_id = str(user_id)
+        with self._user_lock(user_id):
+            with self._lock:
+                self._indexes.pop(user_id, None)
+                self._unsaved.pop(user_id, None)
+                # Пустой индекс, иначе при следующем обращении память восстановится из backfill
+                self._indexes[user_id] = UserIndex(self.max_items)
+                self._indexes[user_id].dirty = True
+            for suffix in ('.npy', '.json'):
+                try:
+                    os.remove(self._path(user_id) + suffix)
+                except FileNotFoundError:
+                    pass
+
+    def save_dirty(self) -> int:
+        """Записать на диск изменённые индексы"""
+        with self._lock:
+            # Вытесненные под блокировкой, но так и не изменённые индексы больше не нужны
+            for user_id in [user_id for user_id, index in self._unsaved.items()
+                            if not index.dirty and not self._user_lock(user_id).locked()]:
+                del self._unsaved[user_id]
+            dirty = [
+                (user_id, index)
+                for user_id, index in [*self._unsaved.items(), *self._indexes.items()] if index.dirty
+            ]
+        os.makedirs(self.directory, exist_ok=True)
+        saved = 0
+        for user_id, index in dirty:
+            # Под блокировкой пользователя: иначе поток, загружающий его индекс, прочитал бы
+            # с диска старую версию, а очистка памяти - получила бы обратно удалённые файлы
+            with self._user_lock(user_id):
+                with self._lock:
+                    if self._indexes.get(user_id) is not index and self._unsaved.get(user_id) is not index:
+                        continue  # Память очищена или индекс уже загружен заново
+                vectors, messages = index.snapshot()
+                UserIndex.write(self._path(user_id), vectors, messages)
+                with self._lock:
+                    if self._unsaved.get(user_id) is index:
+                        del self._unsaved[user_id]
+            saved += 1
+        return saved
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"users": len(self._indexes), "items": sum(len(index) for index in self._indexes.values())}